@@ -0,0 +1,150 @@
+"""
+Plumbing for the async views: a bounded pool the synchronous machine code runs on, and wake-ups for requests
+waiting on a machine's state.
+
+Every database call of the async path goes through `run_sync`, so however many connections the event loop holds
+open, at most `MACHINE_ASYNC_DB_THREADS` requests touch the database at once, each on its own thread and connection.
+"""
+import asyncio
+import contextvars
+import functools
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+from django.dispatch import receiver
+
+from machine import cache, metrics
+from machine.catalog import STATE, state_changed
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.MACHINE_ASYNC_DB_THREADS,
+                                           thread_name_prefix='machine-db')
+        return _executor
+
+
+async def run_sync(func, *args, **kwargs):
+    """
+    Awaits `func(*args, **kwargs)` run on the pool, in a copy of the caller's context so the request's metrics
+    sample follows it.
+    """
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, _call, func, args, kwargs)
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), call)
+
+
+def _call(func, args, kwargs):
+    # what request_started/request_finished do for a synchronous request, per call since a pool thread serves many
+    close_old_connections()
+    try:
+        sample = metrics.current_sample()
+        with ExitStack() as stack:
+            if sample is not None:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(sample))
+            return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+class StateWaiters(object):
+    """
+    Futures of the requests waiting for a machine's state to change, resolved on their own event loop when a
+    change commits in this process. One watcher task per event loop also reads the state cache versions of the
+    machines waited on every `MACHINE_LONG_POLL_RECHECK_SECONDS`, so its cost grows with the machines watched rather
+    than the requests waiting. Those versions only move for other processes' changes when the cache is shared by
+    every worker (the redis backend); on the per-process locmem default such a change is not seen and the request
+    waits out its full wait. Requests waiting on the legacy routes (`machine_id` None) wake on any machine.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiting = defaultdict(set)
+        self._watchers = {}
+        self._versions = {}
+
+    def listen(self, machine_id):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            self._waiting[machine_id].add(future)
+            if loop not in self._watchers:
+                self._watchers[loop] = loop.create_task(self._watch(loop))
+        return future
+
+    def discard(self, machine_id, future):
+        with self._lock:
+            waiting = self._waiting.get(machine_id)
+            if waiting is not None:
+                waiting.discard(future)
+                if not waiting:
+                    del self._waiting[machine_id]
+
+    def notify(self, machine_id):
+        with self._lock:
+            futures = self._waiting.pop(machine_id, set()) | self._waiting.pop(None, set())
+        for future in futures:
+            future.get_loop().call_soon_threadsafe(_resolve, future)
+
+    def count(self):
+        with self._lock:
+            return sum(len(waiting) for waiting in self._waiting.values())
+
+    def watched(self, loop):
+        with self._lock:
+            return {machine_id for machine_id, futures in self._waiting.items()
+                    if machine_id is not None and any(future.get_loop() is loop for future in futures)}
+
+    async def _watch(self, loop):
+        try:
+            while True:
+                await asyncio.sleep(settings.MACHINE_LONG_POLL_RECHECK_SECONDS)
+                machine_ids = self.watched(loop)
+                if not machine_ids:
+                    if self._retire(loop):
+                        return
+                    continue
+                versions = await run_sync(state_versions, machine_ids)
+                for machine_id, version in versions.items():
+                    if self._versions.setdefault(machine_id, version) != version:
+                        self._versions[machine_id] = version
+                        self.notify(machine_id)
+        finally:
+            with self._lock:
+                if self._watchers.get(loop) is asyncio.current_task():
+                    del self._watchers[loop]
+
+    def _retire(self, loop):
+        # under the lock listen() takes, so a request arriving now either keeps this watcher or starts a new one
+        with self._lock:
+            if any(future.get_loop() is loop for futures in self._waiting.values() for future in futures):
+                return False
+            del self._watchers[loop]
+            return True
+
+
+def state_versions(machine_ids):
+    return {machine_id: cache.current_version(STATE, machine_id) for machine_id in machine_ids}
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+state_waiters = StateWaiters()
+
+
+@receiver(state_changed)
+def wake_state_waiters(sender, machine_id, **kwargs):
+    state_waiters.notify(machine_id)
@@ -1,5 +1,10 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class MachineConfig(AppConfig):
     name = 'machine'
+
+    def ready(self):
+        from machine.db import configure_sqlite
+        connection_created.connect(configure_sqlite, dispatch_uid='machine.configure_sqlite')
@@ -0,0 +1,122 @@
+"""
+Retention for the ledger: entries older than `MACHINE_ARCHIVE_AFTER_DAYS` move from `MachineTransaction` to
+`ArchivedTransaction` in small batches, each its own short transaction, so the hot table is never locked for long.
+
+Only entries every reader can do without are moved: ones already folded into the rollups (at or below the rollup
+watermark), covered by a ledger snapshot of their machine, and not a machine's `last_transaction`.
+"""
+import heapq
+import time
+from datetime import timedelta
+from operator import attrgetter, itemgetter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from machine import ledger, projection, rollups
+from machine.models import ArchivedTransaction, Machine, MachineTransaction, RollupWatermark
+
+ARCHIVE_FIELDS = [field.attname for field in ArchivedTransaction._meta.concrete_fields]
+
+
+def archive(older_than_days=None, batch_size=1000, pause=0, machine_ids=None):
+    """
+    Moves the archivable entries of the given (default all) machines, returns how many were moved.
+    """
+    if older_than_days is None:
+        older_than_days = settings.MACHINE_ARCHIVE_AFTER_DAYS
+    cutoff = timezone.now() - timedelta(days=older_than_days)
+    rollups.compact()
+    watermark = RollupWatermark.objects.filter(pk=1).values_list('last_event_id', flat=True).first() or 0
+    machines = Machine.objects.order_by('id')
+    if machine_ids:
+        machines = machines.filter(pk__in=machine_ids)
+    moved = 0
+    for machine_id in machines.values_list('id', flat=True):
+        horizon = min(snapshot_horizon(machine_id, cutoff), watermark)
+        while True:
+            batch = move_batch(machine_id, horizon, cutoff, batch_size)
+            moved += batch
+            if batch < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+    return moved
+
+
+def snapshot_horizon(machine_id, cutoff):
+    """
+    The id up to which the machine's ledger is covered by a snapshot, snapshotting it first when entries past its
+    latest snapshot are old enough to archive.
+    """
+    covered = Machine.objects.filter(pk=machine_id).aggregate(last=Max('snapshots__last_event_id'))['last'] or 0
+    if MachineTransaction.objects.filter(machine_id=machine_id, id__gt=covered, created_at__lt=cutoff).exists():
+        with transaction.atomic():
+            covered = ledger.take_snapshot(Machine.objects.lock(machine_id)).last_event_id
+    return covered
+
+
+def move_batch(machine_id, horizon, cutoff, batch_size):
+    with transaction.atomic():
+        rows = list(MachineTransaction.objects
+                    .filter(machine_id=machine_id, id__lte=horizon, created_at__lt=cutoff)
+                    .exclude(pk__in=Machine.objects.exclude(last_transaction=None).values('last_transaction'))
+                    .order_by('id').values_list(*ARCHIVE_FIELDS)[:batch_size])
+        if not rows:
+            return 0
+        ArchivedTransaction.objects.bulk_create([ArchivedTransaction(**dict(zip(ARCHIVE_FIELDS, row)))
+                                                 for row in rows])
+        MachineTransaction.objects.filter(pk__in=[row[0] for row in rows]).delete_archived()
+    projection.mark_archived([row[0] for row in rows])
+    return len(rows)
+
+
+class CombinedHistory(object):
+    """
+    Read-only, queryset-like view over a ledger queryset and the same query on the archive, ordered by id. Supports
+    what the transaction listing and export use: `filter`, `order_by('id' | '-id')`, slicing, `values_list` and
+    `iterator`; each page or chunk is merged from both tables, both read through their `id` indexes.
+    """
+
+    def __init__(self, querysets, ordering='id', fields=None):
+        self.querysets = querysets
+        self.ordering = ordering
+        self.fields = fields
+
+    def clone(self, querysets, **changes):
+        options = {'ordering': self.ordering, 'fields': self.fields}
+        options.update(changes)
+        return CombinedHistory(querysets, **options)
+
+    def filter(self, *args, **kwargs):
+        return self.clone([queryset.filter(*args, **kwargs) for queryset in self.querysets])
+
+    def order_by(self, *fields):
+        if fields not in (('id',), ('-id',)):
+            raise TypeError("CombinedHistory can only be ordered by id")
+        return self.clone([queryset.order_by(*fields) for queryset in self.querysets], ordering=fields[0])
+
+    def values_list(self, *fields):
+        return self.clone([queryset.values_list(*fields) for queryset in self.querysets], fields=fields)
+
+    def merge(self, iterables):
+        if self.fields is None:
+            key = attrgetter('id')
+        else:
+            key = itemgetter(self.fields.index('id'))
+        return heapq.merge(*iterables, key=key, reverse=self.ordering.startswith('-'))
+
+    def iterator(self, chunk_size=2000):
+        return self.merge([queryset.iterator(chunk_size=chunk_size) for queryset in self.querysets])
+
+    def __iter__(self):
+        return self.iterator()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.step is not None or index.stop is None:
+            raise TypeError("CombinedHistory only supports bounded slices")
+        start = index.start or 0
+        rows = list(self.merge([list(queryset[:index.stop]) for queryset in self.querysets]))
+        return rows[start:index.stop]
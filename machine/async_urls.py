@@ -0,0 +1,10 @@
+from django.urls import path
+
+from machine import urls
+from machine.async_views import as_async
+
+# the routes of machine/urls.py, each served by the async version of its view
+urlpatterns = [
+    path(str(pattern.pattern), as_async(pattern.callback), name=pattern.name)
+    for pattern in urls.urlpatterns
+]
@@ -0,0 +1,114 @@
+"""
+Async front for the machine API, served by the ASGI entry point (see `machine/async_urls.py`).
+
+Each view runs its synchronous DRF view on the `machine.aio` pool and hands back a response that needs nothing more
+from the database, so the event loop only holds on to a request while the pool works on it. `state` also long-polls:
+with `If-None-Match` and `?wait=<seconds>` an unchanged state is held open until it changes or the wait runs out.
+Writes wait for their machine's turn (`machine.mailboxes`) before they take a pool thread.
+"""
+import asyncio
+import tempfile
+from functools import update_wrapper
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
+
+from machine import aio, mailboxes
+from machine.views import MachineStateApiView, MachineUpdateApiView, latest_machine_id
+
+# streamed responses (the transaction export) are written out on the pool first, to memory up to this size and to
+# a temporary file past it, since Django 3.1 iterates a streaming response on the event loop
+SPOOL_MAX_MEMORY = 1024 * 1024
+
+
+def as_async(view):
+    """
+    The async version of a view function from `machine/urls.py`.
+    """
+    view_class = getattr(view, 'view_class', None)
+    if view_class is MachineStateApiView:
+        async_view = long_poll(view)
+    elif view_class is not None and issubclass(view_class, MachineUpdateApiView):
+        async_view = queued(view)
+    else:
+        async def async_view(request, *args, **kwargs):
+            return await aio.run_sync(finalize, view, request, *args, **kwargs)
+    # keeps csrf_exempt and view_class
+    return update_wrapper(async_view, view)
+
+
+def finalize(view, request, *args, **kwargs):
+    response = view(request, *args, **kwargs)
+    if response.streaming:
+        return spool(response)
+    if hasattr(response, 'render') and callable(response.render):
+        # a plain copy, the handler would otherwise render it again on its own thread
+        response.render()
+        plain = HttpResponse(response.content, status=response.status_code)
+        for header, value in response.items():
+            plain[header] = value
+        return plain
+    return response
+
+
+def spool(response):
+    body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    try:
+        for chunk in response.streaming_content:
+            body.write(chunk)
+    except BaseException:
+        body.close()
+        raise
+    finally:
+        response.close()
+    body.seek(0)
+    spooled = FileResponse(body, status=response.status_code)
+    for header, value in response.items():
+        spooled[header] = value
+    return spooled
+
+
+def queued(view):
+
+    async def async_view(request, *args, **kwargs):
+        if kwargs.get('machine_id') is None:
+            # the legacy routes look their machine up first and hand it to the view, so they queue with the
+            # `machine/<id>/` writes to the same machine
+            kwargs['machine_id'] = await aio.run_sync(latest_machine_id)
+        # waits for the machine's turn on the event loop, a pool thread is only taken once it is there
+        async with mailboxes.async_turn(kwargs['machine_id']):
+            return await aio.run_sync(finalize, view, request, *args, **kwargs)
+
+    return async_view
+
+
+def wait_seconds(request):
+    try:
+        wait = float(request.GET.get('wait', 0))
+    except ValueError:
+        return 0
+    return min(max(wait, 0), settings.MACHINE_LONG_POLL_MAX_WAIT)
+
+
+def long_poll(view):
+
+    async def async_view(request, *args, **kwargs):
+        machine_id = kwargs.get('machine_id')
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait_seconds(request)
+        while True:
+            # listening before reading, a change committing in between still wakes us
+            changed = aio.state_waiters.listen(machine_id)
+            try:
+                response = await aio.run_sync(finalize, view, request, *args, **kwargs)
+                remaining = deadline - loop.time()
+                if response.status_code != 304 or remaining <= 0:
+                    return response
+                try:
+                    await asyncio.wait_for(changed, remaining)
+                except asyncio.TimeoutError:
+                    pass
+            finally:
+                aio.state_waiters.discard(machine_id, changed)
+
+    return async_view
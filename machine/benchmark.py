@@ -0,0 +1,227 @@
+import http.client
+import json
+import math
+import os
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
+# one cycle of the flows in machine/urls.py, built so the machine ends every cycle where it started: the sale's
+# takings are withdrawn and the sold item restocked, so cycles can repeat (and run in parallel) for ever
+CYCLE = (
+    ('GET', 'products', None),
+    ('GET', 'state', None),
+    ('PATCH', 'user_insert_currency', {'denomination': 20}),
+    ('PATCH', 'user_insert_currency', {'denomination': 10}),
+    ('PATCH', 'user_dispense_product', lambda product: {'product': product}),
+    ('PATCH', 'user_insert_currency', {'denomination': 10}),
+    ('PATCH', 'user_cancel_transaction', {}),
+    ('PATCH', 'admin_withdraw', {'withdraw_amount': '20.00'}),
+    ('PATCH', 'admin_restock', lambda product: {'items': [{'product': product, 'quantity': 1}]}),
+)
+
+# the writes of a sale alone, for comparing write throughput (e.g. across database profiles)
+DISPENSE_CYCLE = (
+    ('PATCH', 'user_insert_currency', {'denomination': 20}),
+    ('PATCH', 'user_insert_currency', {'denomination': 10}),
+    ('PATCH', 'user_dispense_product', lambda product: {'product': product}),
+    ('PATCH', 'admin_withdraw', {'withdraw_amount': '20.00'}),
+    ('PATCH', 'admin_restock', lambda product: {'items': [{'product': product, 'quantity': 1}]}),
+)
+
+# several kiosks on one machine (`--clients`): whatever order their requests reach it in, every cancel returns all
+# the notes inserted so far and the machine ends up where it started; a cancel beaten to it by another client's is
+# refused with a 400, which is the flow working, only 5xx answers are failures
+CONTENTION_CYCLE = (
+    ('PATCH', 'user_insert_currency', {'denomination': 10}),
+    ('PATCH', 'user_cancel_transaction', {}),
+)
+
+FLOWS = {
+    'all': CYCLE,
+    'dispense': DISPENSE_CYCLE,
+    'contention': CONTENTION_CYCLE,
+}
+
+# FIXTURE_MACHINES machines, each with a single product priced at the sale above and sharing its machine's id; a
+# machine serves one customer at a time, so every load driver process gets a machine of its own
+FIXTURE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'fixture.json')
+FIXTURE_MACHINES = 8
+
+
+def request_body(body, product):
+    if callable(body):
+        body = body(product)
+    return None if body is None else json.dumps(body)
+
+
+def percentile(samples, percent):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not samples:
+        return None
+    return samples[max(int(math.ceil(percent / 100.0 * len(samples))) - 1, 0)]
+
+
+class Recorder(object):
+    """
+    Collects one latency sample (and optionally its query count) per request, keyed by route.
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.server_errors = defaultdict(int)
+
+    def record(self, route, seconds, status, queries=None):
+        self.latencies[route].append(seconds)
+        if queries is not None:
+            self.queries[route].append(queries)
+        if status >= 400:
+            self.errors[route] += 1
+        if status >= 500:
+            self.server_errors[route] += 1
+
+    def merge(self, other):
+        for route, samples in other.latencies.items():
+            self.latencies[route].extend(samples)
+        for route, counts in other.queries.items():
+            self.queries[route].extend(counts)
+        for route, count in other.errors.items():
+            self.errors[route] += count
+        for route, count in other.server_errors.items():
+            self.server_errors[route] += count
+
+    def summary(self, elapsed):
+        routes = {route: self._summarize(samples, self.queries.get(route), self.errors[route],
+                                         self.server_errors[route], elapsed)
+                  for route, samples in sorted(self.latencies.items())}
+        total = self._summarize(sum(self.latencies.values(), []), sum(self.queries.values(), []),
+                                sum(self.errors.values()), sum(self.server_errors.values()), elapsed)
+        return {'elapsed': round(elapsed, 3), 'total': total, 'routes': routes}
+
+    def _summarize(self, samples, queries, errors, server_errors, elapsed):
+        samples = sorted(samples)
+        milliseconds = lambda value: round(value * 1000, 3)
+        return {
+            'requests': len(samples),
+            'errors': errors,
+            'server_errors': server_errors,
+            'rps': round(len(samples) / elapsed, 1) if elapsed else None,
+            'p50_ms': milliseconds(percentile(samples, 50)),
+            'p95_ms': milliseconds(percentile(samples, 95)),
+            'p99_ms': milliseconds(percentile(samples, 99)),
+            'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+        }
+
+
+def run_client_cycles(client, machine_id, product_id, cycles, recorder, count_queries, cycle=CYCLE):
+    """
+    In-process driver: requests go through the Django test client, `count_queries` is a context manager factory
+    that yields a list of captured queries (e.g. `CaptureQueriesContext`).
+    """
+    for _ in range(cycles):
+        for method, route, body in cycle:
+            path = '/machine/{}/{}'.format(machine_id, route)
+            data = request_body(body, product_id)
+            with count_queries() as queries:
+                started = time.perf_counter()
+                if method == 'GET':
+                    response = client.get(path)
+                else:
+                    response = client.patch(path, data, content_type='application/json')
+                seconds = time.perf_counter() - started
+            recorder.record(route, seconds, response.status_code, len(queries))
+
+
+def asgi_headers(body=None, etag=None):
+    """
+    Raw ASGI headers for `AsyncClient`: Django 3.1's sends a broken content-length for bodies and does not turn
+    `HTTP_*` keyword arguments into headers.
+    """
+    headers = [(b'host', b'testserver')]
+    if body is not None:
+        headers += [(b'content-length', str(len(body)).encode()), (b'content-type', b'application/json')]
+    if etag is not None:
+        headers.append((b'if-none-match', etag.encode()))
+    return headers
+
+
+async def run_async_cycles(client, machine_id, product_id, cycles, recorder, cycle=CYCLE):
+    """
+    The same cycles through Django's async test client, i.e. through the ASGI handler and the async views.
+    """
+    for _ in range(cycles):
+        for method, route, body in cycle:
+            path = '/machine/{}/{}'.format(machine_id, route)
+            data = request_body(body, product_id)
+            started = time.perf_counter()
+            response = await client.generic(method, path, data or '', headers=asgi_headers(data))
+            recorder.record(route, time.perf_counter() - started, response.status_code)
+
+
+async def hold_long_poll(client, machine_id, wait, answers):
+    """
+    A kiosk watching its machine: long-polls the state with the ETag of the last answer, over and over until
+    cancelled, counting the answers per status code in `answers`.
+    """
+    etag = None
+    while True:
+        response = await client.get('/machine/{}/state?wait={}'.format(machine_id, wait),
+                                    headers=asgi_headers(etag=etag))
+        answers[response.status_code] += 1
+        etag = response.get('ETag', etag)
+
+
+class HttpDriver(object):
+    """
+    Live-server driver, one keep-alive connection per process.
+    """
+
+    def __init__(self, url, machine_id, cycle=CYCLE):
+        location = urlparse(url)
+        self.host = location.netloc
+        self.prefix = '{}/machine/{}'.format(location.path.rstrip('/'), machine_id)
+        self.product_id = machine_id
+        self.cycle = cycle
+        self.connection = None
+
+    def request(self, method, route, body):
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, timeout=30)
+            try:
+                self.connection.request(method, '{}/{}'.format(self.prefix, route), body, headers)
+                response = self.connection.getresponse()
+                response.read()
+                if response.getheader('Connection', '').lower() == 'close':
+                    self.close()
+                return response.status
+            except (ConnectionError, http.client.HTTPException):
+                # the server dropped the keep-alive connection, retry once on a new one
+                self.close()
+                if attempt:
+                    raise
+
+    def run(self, cycles):
+        recorder = Recorder()
+        for _ in range(cycles):
+            for method, route, body in self.cycle:
+                started = time.perf_counter()
+                status = self.request(method, route, request_body(body, self.product_id))
+                recorder.record(route, time.perf_counter() - started, status)
+        self.close()
+        return recorder
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def run_http_worker(args):
+    url, machine_id, cycles, flow = args
+    return HttpDriver(url, machine_id, FLOWS[flow]).run(cycles)
@@ -0,0 +1,100 @@
+import hashlib
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.http import quote_etag
+
+VERSION_KEY = 'machine:{}:{}:version'
+ENTRY_KEY = 'machine:{}:{}:{}'
+
+
+class CacheStats(object):
+    """
+    Hit/miss counters per cached view, kept per process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(lambda: {'hits': 0, 'misses': 0})
+
+    def record(self, namespace, hit):
+        with self._lock:
+            self._counts[namespace]['hits' if hit else 'misses'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {namespace: dict(counts) for namespace, counts in self._counts.items()}
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+stats = CacheStats()
+
+
+def get_cache():
+    return caches[settings.MACHINE_CACHE_ALIAS]
+
+
+def current_version(namespace, machine_id):
+    cache = get_cache()
+    version_key = VERSION_KEY.format(machine_id, namespace)
+    version = cache.get(version_key)
+    if version is None:
+        # seeded from the clock, so a version key lost to eviction can never come back pointing at old entries
+        cache.add(version_key, time.time_ns(), None)
+        version = cache.get(version_key)
+    return version
+
+
+def get_rendered(namespace, machine_id, render):
+    """
+    Returns `(etag, body)` for a per-machine rendered response. `render` is only called on a miss and must return
+    the response body as bytes, or `(body, timeout)` for a body that may only be cached for `timeout` seconds.
+    """
+    cache = get_cache()
+    entry_key = ENTRY_KEY.format(machine_id, namespace, current_version(namespace, machine_id))
+    entry = cache.get(entry_key)
+    stats.record(namespace, entry is not None)
+    if entry is None:
+        body = render()
+        timeout = settings.MACHINE_CACHE_TIMEOUTS.get(namespace)
+        if isinstance(body, tuple):
+            body, timeout = body
+        entry = (etag_for(body), body)
+        cache.set(entry_key, entry, timeout)
+    return entry
+
+
+def etag_for(body):
+    return quote_etag(hashlib.sha1(body).hexdigest())
+
+
+def invalidate(namespace, machine_id, body=None):
+    """
+    Bumps the machine's version now for this request and again on commit, a read that raced the open transaction may
+    have cached the pre-commit data under the first bump. `body`, the response as it reads once committed, is cached
+    under the committed version, unless another write bumped the version in between and may have committed later.
+    """
+    version = _bump_version(namespace, machine_id)
+
+    def committed():
+        latest = _bump_version(namespace, machine_id)
+        if body is not None and version is not None and latest == version + 1:
+            get_cache().set(ENTRY_KEY.format(machine_id, namespace, latest), (etag_for(body), body),
+                            settings.MACHINE_CACHE_TIMEOUTS.get(namespace))
+
+    transaction.on_commit(committed)
+
+
+def _bump_version(namespace, machine_id):
+    try:
+        return get_cache().incr(VERSION_KEY.format(machine_id, namespace))
+    except ValueError:
+        # a new seed is as good as a bump
+        return current_version(namespace, machine_id)
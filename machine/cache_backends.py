@@ -0,0 +1,167 @@
+import pickle
+import socket
+import threading
+from urllib.parse import urlparse
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisConnection(object):
+    """
+    Just enough of the RESP protocol for a cache: one blocking socket, commands sent as arrays of bulk strings.
+    """
+
+    def __init__(self, host, port, db, socket_timeout):
+        self.sock = socket.create_connection((host, port), timeout=socket_timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+        if db:
+            self.execute('SELECT', db)
+
+    def execute(self, *args):
+        self.sock.sendall(self.encode(args))
+        return self.read_reply()
+
+    def encode(self, args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError('connection closed by server')
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload
+        if kind == b'-':
+            raise RedisError(payload.decode())
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length == -1:
+                return None
+            return self.reader.read(length + 2)[:-2]
+        if kind == b'*':
+            length = int(payload)
+            if length == -1:
+                return None
+            return [self.read_reply() for _ in range(length)]
+        raise RedisError('unknown reply {!r}'.format(line))
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+class RedisCache(BaseCache):
+    """
+    Shared cache backend for any server speaking the Redis protocol, `LOCATION` is `redis://host:port/db`.
+    Integers are stored as plain numbers so `incr()` maps onto INCRBY, everything else is pickled.
+    """
+
+    def __init__(self, server, params):
+        super(RedisCache, self).__init__(params)
+        location = urlparse(server if '://' in server else 'redis://' + server)
+        self._host = location.hostname or '127.0.0.1'
+        self._port = location.port or 6379
+        self._db = int(location.path.strip('/') or 0)
+        self._socket_timeout = params.get('OPTIONS', {}).get('SOCKET_TIMEOUT', 1)
+        self._local = threading.local()
+
+    def _execute(self, *args):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            try:
+                return connection.execute(*args)
+            except (OSError, ConnectionError):
+                # stale socket after a server restart, retry once on a fresh one
+                self._disconnect()
+        self._local.connection = RedisConnection(self._host, self._port, self._db, self._socket_timeout)
+        return self._local.connection.execute(*args)
+
+    def _key(self, key, version):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key
+
+    def _ttl_args(self, timeout):
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        if timeout is None:
+            return []
+        return ['PX', max(int(timeout * 1000), 1)]
+
+    def _dumps(self, value):
+        if isinstance(value, int) and not isinstance(value, bool):
+            return str(value).encode()
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _loads(self, value):
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            return pickle.loads(value)
+
+    def _is_expired_timeout(self, timeout):
+        return timeout is not DEFAULT_TIMEOUT and timeout is not None and timeout <= 0
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        if self._is_expired_timeout(timeout):
+            return False
+        return self._execute('SET', key, self._dumps(value), 'NX', *self._ttl_args(timeout)) is not None
+
+    def get(self, key, default=None, version=None):
+        value = self._loads(self._execute('GET', self._key(key, version)))
+        return default if value is None else value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        if self._is_expired_timeout(timeout):
+            self._execute('DEL', key)
+            return
+        self._execute('SET', key, self._dumps(value), *self._ttl_args(timeout))
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        ttl_args = self._ttl_args(timeout)
+        if not ttl_args:
+            self._execute('PERSIST', key)
+            return bool(self._execute('EXISTS', key))
+        return bool(self._execute('PEXPIRE', key, ttl_args[1]))
+
+    def delete(self, key, version=None):
+        return bool(self._execute('DEL', self._key(key, version)))
+
+    def has_key(self, key, version=None):
+        return bool(self._execute('EXISTS', self._key(key, version)))
+
+    def incr(self, key, delta=1, version=None):
+        key = self._key(key, version)
+        if not self._execute('EXISTS', key):
+            raise ValueError("Key '%s' not found" % key)
+        try:
+            return self._execute('INCRBY', key, delta)
+        except RedisError as error:
+            raise ValueError(str(error))
+
+    def clear(self):
+        self._execute('FLUSHDB')
+
+    def _disconnect(self):
+        # not close(): Django calls that after every request and the socket is meant to outlive requests
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
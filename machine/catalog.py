@@ -0,0 +1,32 @@
+from django.db import transaction
+from django.dispatch import Signal
+
+from machine import cache
+
+CATALOG = 'catalog'
+STATE = 'state'
+
+# sent with `machine_id` once a transaction that changed the machine's state commits, and the new state's `body`
+# when the writer rendered it
+state_changed = Signal()
+
+
+def get_catalog(machine_id, render):
+    return cache.get_rendered(CATALOG, machine_id, render)
+
+
+def invalidate_catalog(machine_id):
+    cache.invalidate(CATALOG, machine_id)
+
+
+def get_state(machine_id, render):
+    return cache.get_rendered(STATE, machine_id, render)
+
+
+def invalidate_state(machine_id, body=None):
+    """
+    Called by every write to a machine. `body`, the state as it reads once the write commits, is cached straight
+    away rather than rendered again by the next read.
+    """
+    cache.invalidate(STATE, machine_id, body)
+    transaction.on_commit(lambda: state_changed.send(sender=None, machine_id=machine_id, body=body))
@@ -0,0 +1,54 @@
+"""
+Change-making over the machine's fixed set of denominations.
+
+`make_change` picks the fewest notes that add up to an amount out of the notes a machine holds. Amounts are counted
+in units of the smallest denomination and counts beyond what an amount could use are capped, so the work is bounded by
+the amount whatever the machine holds.
+"""
+from math import gcd
+
+from machine.models import MachineTransaction
+
+DENOMINATIONS = tuple(sorted(MachineTransaction.DENOMINATOION_CHOICES_DICT))
+UNIT = DENOMINATIONS[0]
+for _denomination in DENOMINATIONS:
+    UNIT = gcd(UNIT, _denomination)
+
+
+def make_change(amount, cash):
+    """
+    The fewest notes making up `amount` out of `cash` (`{denomination: count}`), as `{denomination: count}`, or None
+    when the notes held cannot make it exactly.
+    """
+    if amount < 0 or amount % UNIT:
+        return None
+    units = int(amount) // UNIT
+    inventory = tuple((denomination // UNIT, min(cash.get(denomination, 0), units * UNIT // denomination))
+                      for denomination in DENOMINATIONS)
+    payout = _payout(units, inventory)
+    if payout is None:
+        return None
+    return {value * UNIT: count for value, count in payout}
+
+
+def _payout(units, inventory):
+    # bounded coin change: fewest[total] is the fewest notes making `total` out of the denominations seen so far, and
+    # taken[i][total] how many of denomination i that answer uses
+    fewest = [0] + [None] * units
+    taken = []
+    for value, count in inventory:
+        previous, fewest, used = fewest, [None] * (units + 1), [0] * (units + 1)
+        for total in range(units + 1):
+            for notes in range(min(count, total // value) + 1):
+                before = previous[total - notes * value]
+                if before is not None and (fewest[total] is None or before + notes < fewest[total]):
+                    fewest[total], used[total] = before + notes, notes
+        taken.append(used)
+    if fewest[units] is None:
+        return None
+    payout = []
+    for (value, _), used in reversed(list(zip(inventory, taken))):
+        if used[units]:
+            payout.append((value, used[units]))
+        units -= used[units] * value
+    return tuple(payout)
@@ -0,0 +1,12 @@
+from django.conf import settings
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    `connection_created` receiver applying `MACHINE_SQLITE_PRAGMAS`. Run on the raw connection so the PRAGMAs stay
+    out of the query log and the per-request query counts.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    for name, value in settings.MACHINE_SQLITE_PRAGMAS.items():
+        connection.connection.execute('PRAGMA {} = {}'.format(name, value))
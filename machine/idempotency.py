@@ -0,0 +1,87 @@
+"""
+Replays of retried writes. A kiosk that timed out waiting for an answer sends the same request again with the same
+`Idempotency-Key` header: the first request to use a key on a route claims it and stores its response under it, and
+every retry is answered with that response without touching the database or the machine.
+
+Claims and responses live in the machine cache, so they expire after `MACHINE_CACHE_TIMEOUTS['idempotency']` seconds
+or earlier when the cache culls them for room, and are shared by the workers only on a shared backend (redis).
+"""
+import hashlib
+
+from django.conf import settings
+from django.http import HttpResponse
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+
+from machine.cache import get_cache
+
+HEADER = 'Idempotency-Key'
+KEY = 'idempotency:{}:{}'
+MAX_KEY_LENGTH = 255
+# a claim still without a response frees the key after this, should its request have died half way
+CLAIM_TIMEOUT = 60
+IN_PROGRESS = 'in progress'
+
+
+class RequestInProgress(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'A request with this Idempotency-Key is still being processed. Please retry'
+    default_code = 'request_in_progress'
+
+
+class KeyReused(APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = 'This Idempotency-Key was already used for a different request'
+    default_code = 'idempotency_key_reused'
+
+
+class Claim(object):
+    """
+    A request's hold on its idempotency key. Keys are scoped to the route, and a key sent again with a different
+    body is refused rather than answered with the other request's response.
+    """
+
+    def __init__(self, path, key, body):
+        self.cache_key = KEY.format(path, hashlib.sha1(key.encode()).hexdigest())
+        self.fingerprint = hashlib.sha1(body).hexdigest()
+
+    @classmethod
+    def of(cls, request):
+        key = request.headers.get(HEADER)
+        if key is None:
+            return None
+        if not key or len(key) > MAX_KEY_LENGTH:
+            raise ValidationError({HEADER: ["Please send a key of 1 to {} characters".format(MAX_KEY_LENGTH)]})
+        return cls(request.path, key, request.body)
+
+    def acquire(self):
+        """
+        Returns None once the key is claimed for this request, or the response of the request that claimed it first.
+        """
+        cache = get_cache()
+        while not cache.add(self.cache_key, (self.fingerprint, IN_PROGRESS), CLAIM_TIMEOUT):
+            stored = cache.get(self.cache_key)
+            if stored is None:
+                # expired between the two calls
+                continue
+            fingerprint, response = stored
+            if fingerprint != self.fingerprint:
+                raise KeyReused()
+            if response == IN_PROGRESS:
+                raise RequestInProgress()
+            status_code, content_type, content = response
+            replay = HttpResponse(content, status=status_code, content_type=content_type)
+            replay['Idempotent-Replayed'] = 'true'
+            return replay
+        return None
+
+    def complete(self, response):
+        # a server error may not have applied anything, its retry runs again
+        if response.status_code >= 500:
+            return self.release()
+        get_cache().set(self.cache_key, (self.fingerprint, (response.status_code, response['Content-Type'],
+                                                            response.content)),
+                        settings.MACHINE_CACHE_TIMEOUTS['idempotency'])
+
+    def release(self):
+        get_cache().delete(self.cache_key)
@@ -0,0 +1,97 @@
+"""
+Replays of the machine ledger (`MachineTransaction`) on top of its snapshots (`MachineSnapshot`).
+"""
+from collections import namedtuple
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Max, Sum
+from django.utils import timezone
+
+from machine.models import ArchivedTransaction, Machine, MachineSnapshot, MachineTransaction
+
+LedgerState = namedtuple('LedgerState', ['balance', 'stock', 'last_event_id'])
+
+
+def snapshot_state(snapshot):
+    if snapshot is None:
+        return LedgerState(Decimal(0), {}, 0)
+    return LedgerState(snapshot.balance, {int(product): quantity for product, quantity in snapshot.stock.items()},
+                       snapshot.last_event_id)
+
+
+def apply_entries(machine_id, state, upto=None, archived=False):
+    """
+    Folds the entries recorded after `state` (up to and including `upto`) into it, with two aggregate queries per
+    table. Entries past a machine's latest snapshot are never archived, `archived` is only needed for older ranges.
+    """
+    balance, stock, last_event_id = state.balance, dict(state.stock), state.last_event_id
+    for model in (MachineTransaction, ArchivedTransaction) if archived else (MachineTransaction,):
+        entries = model.objects.filter(machine_id=machine_id, id__gt=state.last_event_id)
+        if upto is not None:
+            entries = entries.filter(id__lte=upto)
+        totals = entries.aggregate(amount=Sum('amount'), last_event_id=Max('id'))
+        if totals['last_event_id'] is None:
+            continue
+        balance += totals['amount']
+        last_event_id = max(last_event_id, totals['last_event_id'])
+        for product_id, quantity in entries.exclude(quantity=0).values_list('product').annotate(Sum('quantity')) \
+                .order_by():
+            stock[product_id] = stock.get(product_id, 0) + quantity
+    return LedgerState(balance, stock, upto if upto is not None else last_event_id)
+
+
+def state_at(machine_id, event_id=None):
+    """
+    The machine's balance and stock right after ledger entry `event_id` (now, when not given), rebuilt from the
+    closest snapshot at or before it.
+    """
+    snapshots = MachineSnapshot.objects.filter(machine_id=machine_id)
+    if event_id is not None:
+        snapshots = snapshots.filter(last_event_id__lte=event_id)
+    return apply_entries(machine_id, snapshot_state(snapshots.order_by('-last_event_id', '-id').first()), event_id,
+                         archived=event_id is not None)
+
+
+def current_state(machine):
+    stock = dict(machine.products.values_list('id', 'quantity'))
+    return LedgerState(machine.amount, stock, None)
+
+
+def differences(expected, actual):
+    """
+    Human readable list of where two states disagree, products missing on one side count as 0 units.
+    """
+    found = []
+    if expected.balance != actual.balance:
+        found.append("balance {} != {}".format(expected.balance, actual.balance))
+    for product_id in sorted(set(expected.stock) | set(actual.stock)):
+        if expected.stock.get(product_id, 0) != actual.stock.get(product_id, 0):
+            found.append("product {} stock {} != {}".format(
+                product_id, expected.stock.get(product_id, 0), actual.stock.get(product_id, 0)))
+    return found
+
+
+def take_snapshot(machine, verified=False):
+    """
+    Snapshots a locked machine's current balance and stock.
+    """
+    last_event_id = machine.transactions.aggregate(last=Max('id'))['last'] or 0
+    state = current_state(machine)
+    snapshot = MachineSnapshot.objects.create(
+        machine=machine, last_event_id=last_event_id, balance=state.balance,
+        stock={str(product_id): quantity for product_id, quantity in state.stock.items()},
+        verified_at=timezone.now() if verified else None)
+    machine.events_since_snapshot = 0
+    Machine.objects.filter(pk=machine.pk).update(events_since_snapshot=0)
+    return snapshot
+
+
+def snapshot_if_due(machine):
+    """
+    Called by the write path once a locked machine is saved, snapshots it every `MACHINE_LEDGER_SNAPSHOT_EVERY`
+    entries so a replay never has more than that many entries to read.
+    """
+    if machine.events_since_snapshot >= settings.MACHINE_LEDGER_SNAPSHOT_EVERY:
+        return take_snapshot(machine)
+    return None
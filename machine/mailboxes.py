@@ -0,0 +1,138 @@
+"""
+Per-machine command queues. Every write to a machine waits for its turn in the machine's mailbox, so one machine's
+commands run one at a time in the order they arrived while commands for different machines run side by side on the
+threads serving them, at most `MACHINE_WRITE_PARALLELISM` at once when set: sqlite lets one writer in at a time
+whatever the machine, so there the machines take turns as well. A command runs on its own request's thread, with its
+own connection and transaction.
+
+Waiting happens in process, a request thread sleeps on an event and an async request on a future of its event loop,
+without holding a pool thread, instead of in the database's lock wait, where sqlite's busy handler polls with growing
+sleeps and keeps no order. The row lock every command still takes orders the writers of other processes.
+"""
+import asyncio
+import contextvars
+import threading
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+
+# the writers' mailbox, shared by every machine
+WRITERS = 'writers'
+
+
+class Mailboxes(object):
+    """
+    A queue of wake-ups per key; the first `capacity` of a queue have their turn and pass it on when leaving. A
+    context holding a turn does not queue again, so the synchronous view run for an async request that already has
+    its turn never waits on a pool thread the holder needs.
+    """
+
+    def __init__(self, capacity=1):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._holding = contextvars.ContextVar('mailbox_turn_{}'.format(id(self)), default=False)
+
+    @contextmanager
+    def turn(self, key):
+        if self._holding.get():
+            yield
+            return
+        ready = threading.Event()
+        wake = ready.set
+        if not self._enter(key, wake):
+            ready.wait()
+        token = self._holding.set(True)
+        try:
+            yield
+        finally:
+            self._holding.reset(token)
+            self._leave(key, wake)
+
+    @asynccontextmanager
+    async def async_turn(self, key):
+        if self._holding.get():
+            yield
+            return
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(_resolve, ready)
+
+        try:
+            if not self._enter(key, wake):
+                await ready
+        except asyncio.CancelledError:
+            # gave up waiting, passing the turn on should it have come meanwhile
+            self._leave(key, wake)
+            raise
+        token = self._holding.set(True)
+        try:
+            yield
+        finally:
+            self._holding.reset(token)
+            self._leave(key, wake)
+
+    def queued(self, key):
+        with self._lock:
+            return len(self._queues.get(key, ()))
+
+    def _enter(self, key, wake):
+        # True when the turn is there for the taking
+        with self._lock:
+            queue = self._queues.setdefault(key, deque())
+            queue.append(wake)
+            return len(queue) <= self.capacity
+
+    def _leave(self, key, wake):
+        with self._lock:
+            queue = self._queues[key]
+            position = queue.index(wake)
+            del queue[position]
+            following = None
+            if position < self.capacity and len(queue) >= self.capacity:
+                following = queue[self.capacity - 1]
+            if not queue:
+                del self._queues[key]
+        if following is not None:
+            following()
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+machines = Mailboxes()
+writers = Mailboxes(capacity=max(settings.MACHINE_WRITE_PARALLELISM, 1))
+
+
+@contextmanager
+def turn(machine_id):
+    """
+    Waits for the machine's turn, then for a writer's, for a write made on this thread.
+    """
+    if not settings.MACHINE_WRITE_QUEUE:
+        yield
+        return
+    with machines.turn(machine_id):
+        if settings.MACHINE_WRITE_PARALLELISM:
+            with writers.turn(WRITERS):
+                yield
+        else:
+            yield
+
+
+@asynccontextmanager
+async def async_turn(machine_id):
+    if not settings.MACHINE_WRITE_QUEUE:
+        yield
+        return
+    async with machines.async_turn(machine_id):
+        if settings.MACHINE_WRITE_PARALLELISM:
+            async with writers.async_turn(WRITERS):
+                yield
+        else:
+            yield
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from machine import archive
+
+
+class Command(BaseCommand):
+    help = ("Moves ledger entries older than MACHINE_ARCHIVE_AFTER_DAYS from MachineTransaction to "
+            "ArchivedTransaction in small batches, compacting the sales rollups first")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, help='Override MACHINE_ARCHIVE_AFTER_DAYS')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Entries moved per transaction')
+        parser.add_argument('--pause', type=float, default=0, help='Seconds to sleep between batches')
+        parser.add_argument('--machine', type=int, action='append', dest='machines',
+                            help='Only archive these machine ids (repeatable)')
+
+    def handle(self, *args, **options):
+        moved = archive.archive(older_than_days=options['older_than_days'], batch_size=options['batch_size'],
+                                pause=options['pause'], machine_ids=options['machines'])
+        self.stdout.write(self.style.SUCCESS("archived {} ledger entries".format(moved)))
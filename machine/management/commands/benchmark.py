@@ -0,0 +1,209 @@
+import asyncio
+import json
+import multiprocessing
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import AsyncClient, Client
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment, \
+    teardown_test_environment
+
+from machine import benchmark
+from machine.catalog import invalidate_catalog, invalidate_state
+
+
+def count_queries():
+    # the query log is capped, start every request on an empty one so the counts stay exact
+    connection.queries_log.clear()
+    return CaptureQueriesContext(connection)
+
+
+class Command(BaseCommand):
+    help = ("Benchmarks the machine endpoints (insert -> select -> refund, cancel, withdraw, restock and the reads). "
+            "Without --url the flows run in process through the test client against a throwaway test database; with "
+            "--url they are driven over HTTP by several processes against a running server loaded with "
+            "benchmarks/fixture.json. --asgi runs the in-process flows through the ASGI handler and the async views "
+            "instead of the WSGI handler")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cycles', type=int, default=200, help='Cycles per process (default 200)')
+        parser.add_argument('--warmup', type=int, default=10, help='Unrecorded cycles run first (default 10)')
+        parser.add_argument('--url', help='Live server base url, e.g. http://127.0.0.1:8000')
+        parser.add_argument('--processes', type=int, default=4,
+                            help='Load driver processes for --url, one fixture machine each (default 4)')
+        parser.add_argument('--asgi', action='store_true',
+                            help='In process, drive the async views through the ASGI handler instead of WSGI')
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='In process, fixture machines driven at once: threads under WSGI, tasks under ASGI '
+                                 '(default 1)')
+        parser.add_argument('--clients', type=int, default=1,
+                            help='In process, clients driving each machine at once, measuring latency under '
+                                 'contention for the same machine (default 1; see --flow contention)')
+        parser.add_argument('--long-polls', type=int, default=0,
+                            help='With --asgi, kiosk long-polls kept open during the run on the state of the fixture '
+                                 'machines not driven')
+        parser.add_argument('--flow', choices=sorted(benchmark.FLOWS), default='all',
+                            help="Requests per cycle: 'all' flows and reads, only the writes of a sale with "
+                                 "'dispense', or insert and cancel with 'contention', which any number of --clients "
+                                 "can share a machine with (default all)")
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+        parser.add_argument('--baseline', help='Compare against results previously written with --output')
+
+    def handle(self, *args, **options):
+        if options['url']:
+            results = self.run_http(options)
+        else:
+            results = self.run_client(options)
+        self.report(results)
+        if options['baseline']:
+            self.compare(results, options['baseline'])
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+                output.write('\n')
+
+    def run_client(self, options):
+        concurrency = options['concurrency']
+        if not 1 <= concurrency <= benchmark.FIXTURE_MACHINES:
+            raise CommandError('--concurrency must be between 1 and {}'.format(benchmark.FIXTURE_MACHINES))
+        if options['clients'] < 1:
+            raise CommandError('--clients must be at least 1')
+        if options['long_polls'] and not options['asgi']:
+            raise CommandError('--long-polls needs --asgi, under WSGI every open poll would hold a thread')
+        if options['long_polls'] and concurrency == benchmark.FIXTURE_MACHINES:
+            raise CommandError('--long-polls needs a fixture machine left idle, lower --concurrency')
+        drive = self.drive_asgi if options['asgi'] else self.drive_wsgi
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            call_command('loaddata', benchmark.FIXTURE, verbosity=0)
+            # a shared cache backend may still hold entries for these ids from an earlier run
+            for machine_id in range(1, benchmark.FIXTURE_MACHINES + 1):
+                invalidate_catalog(machine_id)
+                invalidate_state(machine_id)
+            cycle = benchmark.FLOWS[options['flow']]
+            drive(options['warmup'], concurrency, cycle, clients=options['clients'])
+            recorder, elapsed, long_polls = drive(options['cycles'], concurrency, cycle, options['long_polls'],
+                                                  options['clients'])
+            results = recorder.summary(elapsed)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+        results['driver'] = {'mode': 'asgi' if options['asgi'] else 'client', 'cycles': options['cycles'],
+                             'concurrency': concurrency, 'clients': options['clients'], 'flow': options['flow'],
+                             'database': settings.DB_PROFILE, 'write_queue': settings.MACHINE_WRITE_QUEUE}
+        if long_polls is not None:
+            results['long_polls'] = long_polls
+        return results
+
+    def drive_wsgi(self, cycles, concurrency, cycle, long_polls=0, clients=1):
+
+        def drive(index):
+            machine_id = index % concurrency + 1
+            recorder = benchmark.Recorder()
+            try:
+                # a request failing on the database lock is counted as the 500 it would be, not raised
+                client = Client(raise_request_exception=False)
+                benchmark.run_client_cycles(client, machine_id, machine_id, cycles, recorder, count_queries, cycle)
+            finally:
+                connection.close()
+            return recorder
+
+        recorder = benchmark.Recorder()
+        with ThreadPoolExecutor(concurrency * clients) as pool:
+            started = time.perf_counter()
+            for machine_recorder in pool.map(drive, range(concurrency * clients)):
+                recorder.merge(machine_recorder)
+            elapsed = time.perf_counter() - started
+        return recorder, elapsed, None
+
+    def drive_asgi(self, cycles, concurrency, cycle, long_polls=0, clients=1):
+        answers = Counter()
+
+        async def drive():
+            # kiosks of machines nobody is buying from, held open while the driven machines are busy
+            idle = range(concurrency + 1, benchmark.FIXTURE_MACHINES + 1)
+            polls = [asyncio.ensure_future(benchmark.hold_long_poll(
+                AsyncClient(), idle[poll % len(idle)], settings.MACHINE_LONG_POLL_MAX_WAIT, answers))
+                for poll in range(long_polls)]
+            recorders = [benchmark.Recorder() for _ in range(concurrency * clients)]
+            started = time.perf_counter()
+            await asyncio.gather(*[
+                benchmark.run_async_cycles(AsyncClient(raise_request_exception=False), index % concurrency + 1,
+                                           index % concurrency + 1, cycles, recorders[index], cycle)
+                for index in range(concurrency * clients)])
+            elapsed = time.perf_counter() - started
+            for poll in polls:
+                poll.cancel()
+            await asyncio.gather(*polls, return_exceptions=True)
+            return recorders, elapsed
+
+        with override_settings(ROOT_URLCONF=settings.ASGI_ROOT_URLCONF):
+            recorders, elapsed = asyncio.run(drive())
+        recorder = benchmark.Recorder()
+        for machine_recorder in recorders:
+            recorder.merge(machine_recorder)
+        held = {'held': long_polls, 'changed': answers[200], 'unchanged': answers[304]} if long_polls else None
+        return recorder, elapsed, held
+
+    def run_http(self, options):
+        url, processes = options['url'], options['processes']
+        if not 1 <= processes <= benchmark.FIXTURE_MACHINES:
+            raise CommandError('--processes must be between 1 and {}'.format(benchmark.FIXTURE_MACHINES))
+        if options['warmup']:
+            benchmark.run_http_worker((url, 1, options['warmup'], options['flow']))
+        recorder = benchmark.Recorder()
+        with multiprocessing.Pool(processes) as pool:
+            started = time.perf_counter()
+            for worker_recorder in pool.imap_unordered(
+                    benchmark.run_http_worker, [(url, machine_id, options['cycles'], options['flow'])
+                                                for machine_id in range(1, processes + 1)]):
+                recorder.merge(worker_recorder)
+            elapsed = time.perf_counter() - started
+        results = recorder.summary(elapsed)
+        results['driver'] = {'mode': 'http', 'cycles': options['cycles'], 'processes': processes,
+                             'flow': options['flow']}
+        return results
+
+    def report(self, results):
+        row = '{:<26}{:>9}{:>8}{:>6}{:>10}{:>10}{:>10}{:>10}{:>9}'
+        self.stdout.write(row.format('route', 'requests', 'errors', '5xx', 'rps', 'p50 ms', 'p95 ms', 'p99 ms',
+                                     'queries'))
+        for route, summary in list(results['routes'].items()) + [('total', results['total'])]:
+            self.stdout.write(row.format(route, *[
+                '-' if summary.get(key) is None else summary[key]
+                for key in ('requests', 'errors', 'server_errors', 'rps', 'p50_ms', 'p95_ms', 'p99_ms',
+                            'queries_per_request')]))
+        if 'long_polls' in results:
+            self.stdout.write('long-polls held {held}: {changed} answered with a new state, {unchanged} timed out'
+                              .format(**results['long_polls']))
+        if results['total']['errors']:
+            self.stderr.write('{} requests failed'.format(results['total']['errors']))
+
+    def compare(self, results, path):
+        try:
+            with open(path) as baseline_file:
+                baseline = json.load(baseline_file)
+        except (OSError, ValueError) as error:
+            raise CommandError('Could not read baseline {}: {}'.format(path, error))
+        self.stdout.write('\nagainst {}'.format(path))
+        row = '{:<26}{:>16}{:>16}{:>16}'
+        self.stdout.write(row.format('route', 'p95 ms', 'rps', 'queries'))
+        for route, summary in list(results['routes'].items()) + [('total', results['total'])]:
+            before = baseline['total'] if route == 'total' else baseline['routes'].get(route)
+            if before is None:
+                continue
+            self.stdout.write(row.format(route, *[
+                self.delta(before.get(key), summary.get(key)) for key in ('p95_ms', 'rps', 'queries_per_request')]))
+
+    def delta(self, before, after):
+        if before is None or after is None:
+            return '-'
+        if not before:
+            return '{}'.format(after)
+        return '{} ({:+.0%})'.format(after, (after - before) / before)
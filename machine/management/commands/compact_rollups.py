@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from machine import rollups
+
+
+class Command(BaseCommand):
+    help = "Folds the ledger entries recorded since the last run into the hourly and daily sales and cash rollups"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float,
+                            help='Keep running as a background compactor, compacting every this many seconds')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Recompute the rollups from the whole ledger, archive included, first')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            rollups.rebuild()
+            self.stdout.write("rollups rebuilt")
+        while True:
+            compacted = rollups.compact()
+            self.stdout.write("compacted {} ledger entries".format(compacted))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
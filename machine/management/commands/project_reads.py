@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from machine import projection
+
+
+class Command(BaseCommand):
+    help = "Brings the read model up to date with the machines written to since the last run"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float,
+                            help='Keep running as a background projector, projecting every this many seconds')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Project every machine and the whole ledger, archive included, from scratch first')
+
+    def handle(self, *args, **options):
+        rebuild = options['rebuild']
+        while True:
+            projected = projection.project(rebuild=rebuild)
+            self.stdout.write("projected {} machines".format(projected))
+            if not options['interval']:
+                return
+            rebuild = False
+            time.sleep(options['interval'])
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from machine.catalog import invalidate_state
+from machine.models import Machine
+
+
+class Command(BaseCommand):
+    help = "Recounts every machine's in-stock products and repairs Machine.in_stock_count and the out of stock state"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--machine', type=int, action='append', dest='machines',
+                            help='Only rebuild these machine ids (repeatable)')
+
+    def handle(self, *args, **options):
+        machine_ids = options['machines'] or list(Machine.objects.order_by('id').values_list('id', flat=True))
+        repaired = 0
+        for machine_id in machine_ids:
+            with transaction.atomic():
+                try:
+                    machine = Machine.objects.lock(machine_id)
+                except Machine.DoesNotExist:
+                    raise CommandError("Machine {} does not exist".format(machine_id))
+                counted, state = machine.in_stock_count, machine.state
+                machine.rebuild_in_stock_count()
+                if (counted, state) == (machine.in_stock_count, machine.state):
+                    continue
+                machine.save(update_fields=['in_stock_count', 'state', 'modified_at'])
+                invalidate_state(machine_id)
+            repaired += 1
+            self.stdout.write("machine {}: in stock {} -> {}, state {} -> {}".format(
+                machine_id, counted, machine.in_stock_count, state, machine.state))
+        self.stdout.write(self.style.SUCCESS("{} of {} machines repaired".format(repaired, len(machine_ids))))
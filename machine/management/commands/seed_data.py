@@ -0,0 +1,57 @@
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from machine import seed
+
+
+class Command(BaseCommand):
+    help = ("Seeds the database with machines, products and a ledger history played through the real flows, "
+            "deterministic for a given --seed and --until")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--machines', type=int, default=8, help='Machines to create (default 8)')
+        parser.add_argument('--products', type=int, default=len(seed.CATALOGUE),
+                            help='Products per machine (default {})'.format(len(seed.CATALOGUE)))
+        parser.add_argument('--transactions', type=int, default=100000,
+                            help='Ledger entries to record, split between the machines (default 100000)')
+        parser.add_argument('--days', type=int, default=90, help='Days of history the entries span (default 90)')
+        parser.add_argument('--until',
+                            help='End of the history, an ISO 8601 date or datetime (default: the start of today, UTC)')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed (default 0)')
+        parser.add_argument('--batch-size', type=int, default=settings.MACHINE_LEDGER_SNAPSHOT_EVERY,
+                            help='Entries saved per bulk flush (default VENDING_LEDGER_SNAPSHOT_EVERY)')
+
+    def handle(self, *args, **options):
+        if options['machines'] < 1 or options['products'] < 1:
+            raise CommandError('--machines and --products must be at least 1')
+        if options['days'] < 1 or options['batch_size'] < 1:
+            raise CommandError('--days and --batch-size must be at least 1')
+        until = self.parse_until(options['until'])
+        started = time.perf_counter()
+        machines = seed.generate(
+            options['machines'], options['products'], options['transactions'], options['days'], until,
+            seed=options['seed'], batch_size=options['batch_size'],
+            progress=lambda machine: self.stdout.write("machine {} seeded".format(machine.id)))
+        self.stdout.write(self.style.SUCCESS("seeded {} machines with {} products each and ~{} ledger entries in "
+                                             "{:.1f}s".format(len(machines), options['products'],
+                                                              options['transactions'],
+                                                              time.perf_counter() - started)))
+        self.stdout.write("run compact_rollups to fold the history into the sales reports")
+
+    def parse_until(self, value):
+        if value is None:
+            return timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        until = parse_datetime(value)
+        if until is None:
+            day = parse_date(value)
+            if day is None:
+                raise CommandError('--until must be an ISO 8601 date or datetime')
+            until = datetime.combine(day, datetime.min.time())
+        if timezone.is_naive(until):
+            until = timezone.make_aware(until, timezone.utc)
+        return until
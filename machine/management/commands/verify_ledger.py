@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from machine import ledger
+from machine.models import Machine, MachineSnapshot
+
+
+class Command(BaseCommand):
+    help = ("Checks every machine's ledger against its snapshots: each snapshot not verified yet is rebuilt from the "
+            "one before it, and the latest snapshot plus the entries since must match the machine's balance and stock")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--machine', type=int, action='append', dest='machines',
+                            help='Only verify these machine ids (repeatable)')
+        parser.add_argument('--full', action='store_true', help='Re-verify snapshots that were already verified')
+        parser.add_argument('--snapshot', action='store_true',
+                            help='Take a new snapshot of every machine found consistent')
+
+    def handle(self, *args, **options):
+        machine_ids = options['machines'] or list(Machine.objects.order_by('id').values_list('id', flat=True))
+        inconsistent = 0
+        for machine_id in machine_ids:
+            problems = self.verify_snapshots(machine_id, options['full'])
+            with transaction.atomic():
+                try:
+                    machine = Machine.objects.lock(machine_id)
+                except Machine.DoesNotExist:
+                    raise CommandError("Machine {} does not exist".format(machine_id))
+                rebuilt = ledger.state_at(machine_id)
+                problems += ["now: {}".format(difference)
+                             for difference in ledger.differences(rebuilt, ledger.current_state(machine))]
+                if not problems and options['snapshot']:
+                    ledger.take_snapshot(machine, verified=True)
+            if problems:
+                inconsistent += 1
+                self.stdout.write(self.style.ERROR("machine {}: {}".format(machine_id, '; '.join(problems))))
+            else:
+                self.stdout.write("machine {}: consistent up to entry {}".format(machine_id, rebuilt.last_event_id))
+        if inconsistent:
+            raise CommandError("{} of {} machines do not match their ledger".format(inconsistent, len(machine_ids)))
+        self.stdout.write(self.style.SUCCESS("{} machines consistent".format(len(machine_ids))))
+
+    def verify_snapshots(self, machine_id, full):
+        snapshots = MachineSnapshot.objects.filter(machine_id=machine_id).order_by('last_event_id', 'id')
+        if not full:
+            # everything up to the latest verified snapshot was checked by an earlier run
+            verified = snapshots.filter(verified_at__isnull=False).last()
+            if verified is not None:
+                snapshots = snapshots.filter(last_event_id__gte=verified.last_event_id, id__gte=verified.id)
+        problems = []
+        previous = None
+        for snapshot in snapshots:
+            if previous is not None and (full or snapshot.verified_at is None):
+                rebuilt = ledger.apply_entries(machine_id, ledger.snapshot_state(previous), snapshot.last_event_id,
+                                               archived=True)
+                found = ledger.differences(rebuilt, ledger.snapshot_state(snapshot))
+                if found:
+                    problems += ["snapshot {}: {}".format(snapshot.id, difference) for difference in found]
+                elif snapshot.verified_at is None:
+                    MachineSnapshot.objects.filter(pk=snapshot.pk).update(verified_at=timezone.now())
+            previous = snapshot
+        return problems
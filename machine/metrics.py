@@ -0,0 +1,297 @@
+import asyncio
+import contextvars
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.utils.decorators import sync_and_async_middleware
+
+logger = logging.getLogger('machine.slow_requests')
+
+# fixed bucket bounds: two processes' histograms for the same metric add up bucket by bucket
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+HISTOGRAMS = {
+    'machine_http_request_duration_seconds': ('Wall time per request', DURATION_BUCKETS),
+    'machine_db_queries_per_request': ('Database queries per request', QUERY_BUCKETS),
+    'machine_db_duration_seconds': ('Time spent in database queries per request', DURATION_BUCKETS),
+    'machine_serializer_duration_seconds': ('Time spent validating and rendering serializers per request',
+                                            DURATION_BUCKETS),
+}
+COUNTERS = {
+    'machine_http_requests_total': 'Requests by route, method and status code',
+}
+
+_current = contextvars.ContextVar('machine_request_sample', default=None)
+
+
+class RequestSample(object):
+    """
+    What one request spent its time on, filled in while it runs.
+    """
+
+    def __init__(self, capture_sql):
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.serializer_seconds = 0.0
+        self.timing_serializer = False
+        self.statements = [] if capture_sql else None
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            seconds = time.perf_counter() - started
+            self.db_queries += 1
+            self.db_seconds += seconds
+            if self.statements is not None:
+                self.statements.append((seconds, sql, params))
+
+
+def current_sample():
+    return _current.get()
+
+
+@contextmanager
+def timed_serializer():
+    """
+    Adds the block's wall time to the current request's serializer time; nested serializers are only counted once.
+    """
+    sample = _current.get()
+    if sample is None or sample.timing_serializer:
+        yield
+        return
+    sample.timing_serializer = True
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        sample.serializer_seconds += time.perf_counter() - started
+        sample.timing_serializer = False
+
+
+class Registry(object):
+    """
+    Process-local counters and histograms. `snapshot()` is plain JSON and `merge()` adds snapshots together, so the
+    numbers of every worker can be combined into one exposition.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = {name: {} for name in COUNTERS}
+            self._histograms = {name: {} for name in HISTOGRAMS}
+
+    def increment(self, name, labels, value=1):
+        key = _label_key(labels)
+        with self._lock:
+            self._counters[name][key] = self._counters[name].get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = _label_key(labels)
+        bounds = HISTOGRAMS[name][1]
+        with self._lock:
+            histogram = self._histograms[name].get(key)
+            if histogram is None:
+                histogram = self._histograms[name][key] = {'buckets': [0] * (len(bounds) + 1), 'sum': 0, 'count': 0}
+            index = next((index for index, bound in enumerate(bounds) if value <= bound), len(bounds))
+            histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps({'counters': self._counters, 'histograms': self._histograms}))
+
+    @staticmethod
+    def merge(snapshots):
+        merged = {'counters': {name: {} for name in COUNTERS}, 'histograms': {name: {} for name in HISTOGRAMS}}
+        for snapshot in snapshots:
+            for name, series in snapshot.get('counters', {}).items():
+                for key, value in series.items():
+                    merged['counters'][name][key] = merged['counters'][name].get(key, 0) + value
+            for name, series in snapshot.get('histograms', {}).items():
+                for key, histogram in series.items():
+                    total = merged['histograms'][name].setdefault(
+                        key, {'buckets': [0] * len(histogram['buckets']), 'sum': 0, 'count': 0})
+                    total['buckets'] = [left + right for left, right in zip(total['buckets'], histogram['buckets'])]
+                    total['sum'] += histogram['sum']
+                    total['count'] += histogram['count']
+        return merged
+
+
+registry = Registry()
+
+
+def _label_key(labels):
+    return json.dumps(sorted(labels.items()))
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                          for name, value in pairs) + '}'
+
+
+def render(snapshot):
+    """
+    Prometheus text exposition (version 0.0.4) of a snapshot.
+    """
+    lines = []
+    for name, help_text in COUNTERS.items():
+        lines += ['# HELP {} {}'.format(name, help_text), '# TYPE {} counter'.format(name)]
+        for key, value in sorted(snapshot['counters'].get(name, {}).items()):
+            lines.append('{}{} {}'.format(name, _format_labels(json.loads(key)), value))
+    for name, (help_text, bounds) in HISTOGRAMS.items():
+        lines += ['# HELP {} {}'.format(name, help_text), '# TYPE {} histogram'.format(name)]
+        for key, histogram in sorted(snapshot['histograms'].get(name, {}).items()):
+            pairs = json.loads(key)
+            cumulative = 0
+            for bound, count in zip(list(bounds) + ['+Inf'], histogram['buckets']):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(pairs + [['le', bound]]), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(pairs), repr(float(histogram['sum']))))
+            lines.append('{}_count{} {}'.format(name, _format_labels(pairs), histogram['count']))
+    return '\n'.join(lines) + '\n'
+
+
+class WorkerFiles(object):
+    """
+    With `MACHINE_METRICS_DIR` set every worker process writes its snapshot there (at most once a second) and
+    `/metrics` serves the sum over all of them, whichever worker answers the scrape.
+    """
+    interval = 1.0
+
+    def __init__(self):
+        self._written_at = 0.0
+        self._lock = threading.Lock()
+
+    def path(self, directory):
+        return os.path.join(directory, 'metrics-{}.json'.format(os.getpid()))
+
+    def write(self, force=False):
+        directory = settings.MACHINE_METRICS_DIR
+        if not directory:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._written_at < self.interval:
+                return
+            self._written_at = now
+        os.makedirs(directory, exist_ok=True)
+        path = self.path(directory)
+        temporary = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(temporary, 'w') as snapshot_file:
+            json.dump(registry.snapshot(), snapshot_file)
+        os.replace(temporary, path)
+
+    def collect(self):
+        directory = settings.MACHINE_METRICS_DIR
+        if not directory:
+            return registry.snapshot()
+        self.write(force=True)
+        snapshots = []
+        for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+            try:
+                with open(path) as snapshot_file:
+                    snapshots.append(json.load(snapshot_file))
+            except (OSError, ValueError):
+                # a worker is replacing its file right now, its numbers show up on the next scrape
+                continue
+        return Registry.merge(snapshots)
+
+
+worker_files = WorkerFiles()
+
+
+def _in_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """
+    Records wall time, query count and time, serializer time and the status code of every request against the
+    route pattern it matched, and logs the SQL of requests slower than `MACHINE_SLOW_REQUEST_MS`.
+
+    Works on both entry points. Under ASGI the queries run on other threads, `machine.aio.run_sync` counts them.
+    """
+    recorder = RequestRecorder(get_response)
+    if asyncio.iscoroutinefunction(get_response):
+        # a coroutine function, so the handler awaits this middleware instead of running it on a thread
+
+        async def middleware(request):
+            return await recorder.__acall__(request)
+
+        return middleware
+    return recorder
+
+
+class RequestRecorder(object):
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        # Django 3.1's SecurityMiddleware does not mark itself async, the chain below is async when called from the
+        # event loop whatever get_response looks like
+        if _in_event_loop():
+            return self.__acall__(request)
+        sample, token, started = self.start()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(sample))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.finish(request, response, sample, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        sample, token, started = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.finish(request, response, sample, time.perf_counter() - started)
+        return response
+
+    def start(self):
+        sample = RequestSample(capture_sql=settings.MACHINE_SLOW_REQUEST_MS is not None)
+        return sample, _current.set(sample), time.perf_counter()
+
+    def finish(self, request, response, sample, seconds):
+        match = getattr(request, 'resolver_match', None)
+        route = match.route if match is not None else 'unmatched'
+        labels = {'route': route, 'method': request.method}
+        registry.increment('machine_http_requests_total', dict(labels, status=response.status_code))
+        registry.observe('machine_http_request_duration_seconds', labels, seconds)
+        registry.observe('machine_db_queries_per_request', labels, sample.db_queries)
+        registry.observe('machine_db_duration_seconds', labels, sample.db_seconds)
+        registry.observe('machine_serializer_duration_seconds', labels, sample.serializer_seconds)
+        worker_files.write()
+
+        slow_ms = settings.MACHINE_SLOW_REQUEST_MS
+        if slow_ms is not None and seconds * 1000 >= slow_ms:
+            logger.warning('slow request %s %s (%s) took %.1fms, %d queries in %.1fms:\n%s',
+                           request.method, request.get_full_path(), route, seconds * 1000, sample.db_queries,
+                           sample.db_seconds * 1000,
+                           '\n'.join('  {:.1f}ms {} {}'.format(query_seconds * 1000, sql, params)
+                                     for query_seconds, sql, params in sample.statements))
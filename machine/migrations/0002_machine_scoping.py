@@ -0,0 +1,40 @@
+# Generated by Django 3.1 on 2026-10-18 16:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def assign_default_machine(apps, schema_editor):
+    # single-machine installs kept one global inventory; hand it to the machine that used it
+    Machine = apps.get_model('machine', 'Machine')
+    machine = Machine.objects.order_by('id').last()
+    if machine is None:
+        return
+    apps.get_model('machine', 'Products').objects.filter(machine__isnull=True).update(machine=machine)
+    apps.get_model('machine', 'MachineTransaction').objects.filter(machine__isnull=True).update(machine=machine)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='machinetransaction',
+            name='machine',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='transactions', to='machine.machine'),
+        ),
+        migrations.AddField(
+            model_name='products',
+            name='machine',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='products', to='machine.machine'),
+        ),
+        migrations.AlterField(
+            model_name='machine',
+            name='last_transaction',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='machine.machinetransaction'),
+        ),
+        migrations.RunPython(assign_default_machine, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.1 on 2026-10-18 17:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine', '0002_machine_scoping'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='machinetransaction',
+            index=models.Index(fields=['machine', 'action', 'id'], name='machine_txn_action_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='machinetransaction',
+            index=models.Index(fields=['machine', 'product', 'id'], name='machine_txn_product_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='machinetransaction',
+            index=models.Index(fields=['machine', 'created_at'], name='machine_txn_created_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.1 on 2026-10-18 17:07
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def count_in_stock(apps, schema_editor):
+    Machine = apps.get_model('machine', 'Machine')
+    for machine in Machine.objects.annotate(in_stock=Count('products', filter=Q(products__quantity__gt=0))):
+        Machine.objects.filter(pk=machine.pk).update(in_stock_count=machine.in_stock)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine', '0003_transaction_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='machine',
+            name='in_stock_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_in_stock, migrations.RunPython.noop),
+    ]
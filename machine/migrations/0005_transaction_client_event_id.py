@@ -0,0 +1,22 @@
+# Generated by Django 3.1 on 2026-10-18 17:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine', '0004_machine_in_stock_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='machinetransaction',
+            name='client_event_id',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='machinetransaction',
+            constraint=models.UniqueConstraint(fields=('machine', 'client_event_id'), name='machine_txn_client_event_unique'),
+        ),
+    ]
@@ -0,0 +1,84 @@
+# Generated by Django 3.1 on 2026-10-18 17:22
+
+import re
+
+from django.db import migrations, models
+from django.db.models import F, Max
+from django.utils import timezone
+import django.db.models.deletion
+
+# actions that paid cash out of the machine, their amounts were stored unsigned
+CASH_OUT_ACTIONS = (2, 4, 10, 12)
+SELECT_ITEM = 3
+ADD_PRODUCT = 11
+
+
+def sign_ledger(apps, schema_editor):
+    MachineTransaction = apps.get_model('machine', 'MachineTransaction')
+    MachineTransaction.objects.filter(action__in=CASH_OUT_ACTIONS, amount__gt=0).update(amount=-F('amount'))
+    MachineTransaction.objects.filter(action=SELECT_ITEM).update(quantity=-1)
+    for transaction_obj in MachineTransaction.objects.filter(action=ADD_PRODUCT).only('activity_log'):
+        added = re.match(r'added (\d+) units', transaction_obj.activity_log or '')
+        if added:
+            MachineTransaction.objects.filter(pk=transaction_obj.pk).update(quantity=int(added.group(1)))
+
+
+def open_snapshots(apps, schema_editor):
+    # the history before this migration was never a complete ledger, every machine starts one from where it is now
+    Machine = apps.get_model('machine', 'Machine')
+    MachineSnapshot = apps.get_model('machine', 'MachineSnapshot')
+    for machine in Machine.objects.annotate(last_event_id=Max('transactions__id')):
+        MachineSnapshot.objects.create(
+            machine=machine, last_event_id=machine.last_event_id or 0, balance=machine.amount,
+            stock={str(product_id): quantity for product_id, quantity in
+                   machine.products.values_list('id', 'quantity')},
+            verified_at=timezone.now())
+
+
+def unsign_ledger(apps, schema_editor):
+    MachineTransaction = apps.get_model('machine', 'MachineTransaction')
+    MachineTransaction.objects.filter(amount__lt=0).update(amount=-F('amount'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine', '0005_transaction_client_event_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='machine',
+            name='events_since_snapshot',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='machinetransaction',
+            name='quantity',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='machinetransaction',
+            name='amount',
+            field=models.DecimalField(decimal_places=2, max_digits=8),
+        ),
+        migrations.CreateModel(
+            name='MachineSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('last_event_id', models.PositiveIntegerField()),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=8)),
+                ('stock', models.JSONField(default=dict)),
+                ('verified_at', models.DateTimeField(blank=True, null=True)),
+                ('machine', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='snapshots', to='machine.machine')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='machinesnapshot',
+            index=models.Index(fields=['machine', 'last_event_id'], name='machine_snapshot_event_idx'),
+        ),
+        migrations.RunPython(sign_ledger, unsign_ledger),
+        migrations.RunPython(open_snapshots, migrations.RunPython.noop),
+    ]
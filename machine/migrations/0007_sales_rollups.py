@@ -0,0 +1,63 @@
+# Generated by Django 3.1 on 2026-10-18 17:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine', '0006_ledger_snapshots'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('last_event_id', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='SalesRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('period', models.CharField(choices=[('hour', 'Hourly'), ('day', 'Daily')], max_length=4)),
+                ('bucket', models.DateTimeField()),
+                ('units', models.PositiveIntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('machine', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='machine.machine')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='machine.products')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CashRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('period', models.CharField(choices=[('hour', 'Hourly'), ('day', 'Daily')], max_length=4)),
+                ('bucket', models.DateTimeField()),
+                ('action', models.IntegerField(choices=[(1, 'currency inserted'), (2, 'cancelled by user'), (3, 'item selected by user'), (4, 'refund amount'), (10, 'called by machine'), (11, 'Admin add product'), (12, 'Admin currency withdraw')])),
+                ('denomination', models.PositiveIntegerField(default=0)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('machine', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='machine.machine')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='salesrollup',
+            constraint=models.UniqueConstraint(fields=('machine', 'period', 'bucket', 'product'), name='sales_rollup_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='cashrollup',
+            constraint=models.UniqueConstraint(fields=('machine', 'period', 'bucket', 'action', 'denomination'), name='cash_rollup_unique'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.1 on 2026-10-18 17:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine', '0008_archived_transactions'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='machinetransaction',
+            index=models.Index(fields=['action', 'created_at'], name='machine_txn_action_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='machinetransaction',
+            index=models.Index(fields=['product', 'created_at'], name='machine_txn_product_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='products',
+            index=models.Index(condition=models.Q(quantity__gt=0), fields=['machine'], name='products_in_stock_idx'),
+        ),
+    ]
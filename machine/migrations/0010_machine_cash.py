@@ -0,0 +1,65 @@
+# Generated by Django 3.1 on 2026-10-18 17:59
+
+from django.db import migrations, models
+
+
+def count_cash(apps, schema_editor):
+    # the notes behind an existing balance were never recorded, count it in the largest ones
+    Machine = apps.get_model('machine', 'Machine')
+    machines = list(Machine.objects.filter(amount__gt=0))
+    uncountable = ['{} (Rs {})'.format(machine.pk, machine.amount) for machine in machines if machine.amount % 10]
+    if uncountable:
+        # the cash has to add up to the balance, a remainder cannot just be dropped
+        raise ValueError("Machines {} hold balances that cannot be made of notes of Rs 10, 20, 50 and 100, please "
+                         "correct their amount and migrate again".format(', '.join(uncountable)))
+    for machine in machines:
+        left, counts = int(machine.amount), {}
+        for denomination in (100, 50, 20, 10):
+            counts['cash_{}'.format(denomination)], left = divmod(left, denomination)
+        Machine.objects.filter(pk=machine.pk).update(**counts)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine', '0009_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='machine',
+            name='cash_10',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='machine',
+            name='cash_100',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='machine',
+            name='cash_20',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='machine',
+            name='cash_50',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_cash, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='archivedtransaction',
+            name='action',
+            field=models.IntegerField(choices=[(1, 'currency inserted'), (2, 'cancelled by user'), (3, 'item selected by user'), (4, 'refund amount'), (10, 'called by machine'), (11, 'Admin add product'), (12, 'Admin currency withdraw'), (13, 'Admin cash load')]),
+        ),
+        migrations.AlterField(
+            model_name='cashrollup',
+            name='action',
+            field=models.IntegerField(choices=[(1, 'currency inserted'), (2, 'cancelled by user'), (3, 'item selected by user'), (4, 'refund amount'), (10, 'called by machine'), (11, 'Admin add product'), (12, 'Admin currency withdraw'), (13, 'Admin cash load')]),
+        ),
+        migrations.AlterField(
+            model_name='machinetransaction',
+            name='action',
+            field=models.IntegerField(choices=[(1, 'currency inserted'), (2, 'cancelled by user'), (3, 'item selected by user'), (4, 'refund amount'), (10, 'called by machine'), (11, 'Admin add product'), (12, 'Admin currency withdraw'), (13, 'Admin cash load')]),
+        ),
+    ]
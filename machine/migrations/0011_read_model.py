@@ -0,0 +1,62 @@
+# Generated by Django 3.1 on 2026-10-18 18:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine', '0010_machine_cash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('synced_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ReadMachine',
+            fields=[
+                ('machine_id', models.IntegerField(primary_key=True, serialize=False)),
+                ('state_body', models.BinaryField()),
+                ('catalog_body', models.BinaryField()),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ReadTransaction',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField()),
+                ('action', models.IntegerField(choices=[(1, 'currency inserted'), (2, 'cancelled by user'), (3, 'item selected by user'), (4, 'refund amount'), (10, 'called by machine'), (11, 'Admin add product'), (12, 'Admin currency withdraw'), (13, 'Admin cash load')])),
+                ('activity_log', models.CharField(blank=True, max_length=100, null=True)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=8)),
+                ('quantity', models.IntegerField(default=0)),
+                ('total_transaction_amount', models.DecimalField(blank=True, decimal_places=2, max_digits=5, null=True)),
+                ('denomination', models.IntegerField(blank=True, choices=[(10, '10'), (20, '20'), (50, '50'), (100, '100')], null=True)),
+                ('archived', models.BooleanField(default=False)),
+                ('machine', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='machine.machine')),
+                ('product', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='machine.products')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='readtransaction',
+            index=models.Index(fields=['machine', 'archived', 'id'], name='read_txn_hot_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='readtransaction',
+            index=models.Index(fields=['machine', 'action', 'id'], name='read_txn_action_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='readtransaction',
+            index=models.Index(fields=['machine', 'product', 'id'], name='read_txn_product_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='readtransaction',
+            index=models.Index(fields=['machine', 'created_at'], name='read_txn_created_idx'),
+        ),
+    ]
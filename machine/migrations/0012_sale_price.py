@@ -0,0 +1,24 @@
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+SELECT_ITEM = 3
+
+
+def record_sale_prices(apps, schema_editor):
+    # sales recorded before the price was, charged at the product's current price: the best there is to go on
+    Products = apps.get_model('machine', 'Products')
+    price = Subquery(Products.objects.filter(pk=OuterRef('product_id')).values('price')[:1])
+    for name in ('MachineTransaction', 'ArchivedTransaction'):
+        apps.get_model('machine', name).objects.filter(action=SELECT_ITEM, total_transaction_amount=0) \
+            .update(total_transaction_amount=price)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machine', '0011_read_model'),
+    ]
+
+    operations = [
+        migrations.RunPython(record_sale_prices, migrations.RunPython.noop),
+    ]
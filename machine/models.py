@@ -1,4 +1,8 @@
-from django.db import models
+from django.db import connections, models
+from django.db.models import F, Q
+from django.utils import timezone
+from machine.catalog import invalidate_catalog
+
 
 class AbstractModel(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
@@ -9,13 +13,54 @@ class AbstractModel(models.Model):
 
 
 class Products(AbstractModel):
+    machine = models.ForeignKey('Machine', on_delete=models.PROTECT, related_name='products', null=True, blank=True)
     name = models.CharField(max_length=100)
     quantity = models.IntegerField()
     price = models.DecimalField(max_digits=5, decimal_places=2)
 
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.quantity:
+            raise ValueError("Products are stocked through machine.services.stock_product, which accounts for their "
+                             "opening stock")
+        return super(Products, self).save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        # every unit in stock was recorded in the ledger, which protects the product anyway
+        if self.quantity:
+            raise ValueError("Products still in stock cannot be deleted")
+        return super(Products, self).delete(*args, **kwargs)
+
     def dispense(self):
-        self.quantity -= 1
-        self.save()
+        # conditional decrement, so concurrent sales can never take the stock below zero
+        dispensed = Products.objects.filter(pk=self.pk, quantity__gt=0).update(quantity=F('quantity') - 1)
+        if dispensed:
+            self.quantity -= 1
+            invalidate_catalog(self.machine_id)
+        return bool(dispensed)
+
+    def restock(self, quantity):
+        Products.objects.filter(pk=self.pk).update(quantity=F('quantity') + quantity, modified_at=timezone.now())
+        self.quantity += quantity
+        invalidate_catalog(self.machine_id)
+
+    class Meta:
+        indexes = [
+            # in_stock_count is rebuilt from the stocked products only, sold out ones stay out of the index
+            models.Index(fields=['machine'], condition=Q(quantity__gt=0), name='products_in_stock_idx'),
+        ]
+
+
+class MachineQuerySet(models.QuerySet):
+
+    def lock(self, pk):
+        """
+        Fetches the machine row for update. Must be called inside `transaction.atomic()`; every write to a machine,
+        its inventory and its transactions is serialized behind this lock.
+        """
+        if not connections[self.db].features.has_select_for_update:
+            # sqlite has no row locks, take the database write lock up front instead of upgrading to it mid-way
+            self.filter(pk=pk).update(modified_at=timezone.now())
+        return self.select_for_update(of=('self',)).select_related('last_transaction').get(pk=pk)
 
 
 class Machine(AbstractModel):
@@ -35,10 +80,67 @@ class Machine(AbstractModel):
 
     state = models.IntegerField(choices=STATE_CHOICES, default=STATE_READY)
     message = models.CharField(max_length=100, null=True, blank=True)
-    last_transaction = models.ForeignKey('MachineTransaction', on_delete=models.SET_NULL, null=True, blank=True)
+    last_transaction = models.ForeignKey('MachineTransaction', on_delete=models.SET_NULL, related_name='+', null=True,
+                                         blank=True)
     amount = models.DecimalField(max_digits=6, decimal_places=2, default=0)
+    # number of this machine's products with quantity > 0, kept up to date by every stock change
+    in_stock_count = models.PositiveIntegerField(default=0)
+    # ledger entries recorded since the last MachineSnapshot, a new snapshot is taken when this gets too high
+    events_since_snapshot = models.PositiveIntegerField(default=0)
+    # notes held per denomination, what refunds and withdrawals are paid out of; they add up to `amount`
+    cash_10 = models.PositiveIntegerField(default=0)
+    cash_20 = models.PositiveIntegerField(default=0)
+    cash_50 = models.PositiveIntegerField(default=0)
+    cash_100 = models.PositiveIntegerField(default=0)
+
+    CASH_FIELDS = {10: 'cash_10', 20: 'cash_20', 50: 'cash_50', 100: 'cash_100'}
+
+    objects = MachineQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super(Machine, self).save(*args, **kwargs)
+        if adding:
+            # the opening balance, replays of this machine's ledger start from here
+            MachineSnapshot.objects.create(machine=self, last_event_id=0, balance=self.amount, stock={},
+                                           verified_at=timezone.now())
+
+    def rebuild_in_stock_count(self):
+        self.in_stock_count = self.products.filter(quantity__gt=0).count()
+        if self.in_stock_count == 0 and self.state == Machine.STATE_READY:
+            self.state = Machine.STATE_OUT_OF_STOCK
+        elif self.in_stock_count > 0 and self.state == Machine.STATE_OUT_OF_STOCK:
+            self.state = Machine.STATE_READY
+        return self.in_stock_count
+
+    @property
+    def cash(self):
+        return {denomination: getattr(self, field) for denomination, field in self.CASH_FIELDS.items()}
+
+
+class LedgerQuerySet(models.QuerySet):
+
+    def update(self, **kwargs):
+        raise TypeError("MachineTransaction is an append-only ledger, entries cannot be updated")
+
+    def delete(self):
+        raise TypeError("MachineTransaction is an append-only ledger, entries cannot be deleted")
+
+    def delete_archived(self):
+        """
+        The one way out of the ledger, for entries already copied to `ArchivedTransaction`: a single DELETE, without
+        the cascade bookkeeping (no machine ever points at an archived entry).
+        """
+        return self._raw_delete(self.db)
+
 
 class MachineTransaction(AbstractModel):
+    """
+    The machine's append-only ledger. `amount` is the signed change to the machine's cash and `quantity` the signed
+    change to `product`'s stock, so a machine's balance and stock are its latest `MachineSnapshot` plus the entries
+    recorded after it. `total_transaction_amount` is the running total inserted on an insert, the price charged on a
+    sale.
+    """
     ACTION_INSERT_DENOMINATION = 1
     ACTION_USER_CANCEL = 2
     ACTION_SELECT_ITEM = 3
@@ -46,6 +148,7 @@ class MachineTransaction(AbstractModel):
     ACTION_CANCELLED_BY_MACHINE = 10
     ACTION_MAINTENANCE_ADD_PRODUCT = 11
     ACTION_MAINTENANCE_WITHRAW_CURRENCY = 12
+    ACTION_MAINTENANCE_LOAD_CASH = 13
 
     ACTION_CUSTOMER_CHOICES = (
         (ACTION_INSERT_DENOMINATION, 'currency inserted'),
@@ -54,7 +157,8 @@ class MachineTransaction(AbstractModel):
         (ACTION_REFUND, 'refund amount'),
         (ACTION_CANCELLED_BY_MACHINE, 'called by machine'),
         (ACTION_MAINTENANCE_ADD_PRODUCT, 'Admin add product'),
-        (ACTION_MAINTENANCE_WITHRAW_CURRENCY, 'Admin currency withdraw')
+        (ACTION_MAINTENANCE_WITHRAW_CURRENCY, 'Admin currency withdraw'),
+        (ACTION_MAINTENANCE_LOAD_CASH, 'Admin cash load')
     )
 
     DENOMINATOION_10 = 10
@@ -71,7 +175,183 @@ class MachineTransaction(AbstractModel):
 
     action = models.IntegerField(choices=ACTION_CUSTOMER_CHOICES)
     activity_log = models.CharField(max_length=100, null=True, blank=True)
-    amount = models.DecimalField(max_digits=5, decimal_places=2)
+    amount = models.DecimalField(max_digits=8, decimal_places=2)
+    quantity = models.IntegerField(default=0)
     total_transaction_amount = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)
     denomination = models.IntegerField(choices=DENOMINATOION_CHOICES_DICT.items(), null=True, blank=True)
     product = models.ForeignKey(Products, on_delete=models.PROTECT, null=True, blank=True)
+    machine = models.ForeignKey(Machine, on_delete=models.PROTECT, related_name='transactions', null=True, blank=True)
+    # id the machine gave the event when it was recorded offline, makes re-uploads of a backlog idempotent
+    client_event_id = models.CharField(max_length=64, null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['machine', 'client_event_id'], name='machine_txn_client_event_unique'),
+        ]
+        indexes = [
+            # the admin listing filters by machine and one of these, then walks the id keyset
+            models.Index(fields=['machine', 'action', 'id'], name='machine_txn_action_idx'),
+            models.Index(fields=['machine', 'product', 'id'], name='machine_txn_product_idx'),
+            models.Index(fields=['machine', 'created_at'], name='machine_txn_created_idx'),
+            # fleet-wide reporting, sales or cash movements and the history of one product over a time range
+            models.Index(fields=['action', 'created_at'], name='machine_txn_action_time_idx'),
+            models.Index(fields=['product', 'created_at'], name='machine_txn_product_time_idx'),
+        ]
+
+    objects = LedgerQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise TypeError("MachineTransaction is an append-only ledger, entries cannot be updated")
+        return super(MachineTransaction, self).save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise TypeError("MachineTransaction is an append-only ledger, entries cannot be deleted")
+
+
+class ArchivedTransaction(models.Model):
+    """
+    Ledger entries moved out of `MachineTransaction` by `machine.archive`, same ids and columns. The keys are plain
+    indexed columns rather than enforced foreign keys, so archived rows never hold up changes to the hot tables.
+    """
+    id = models.IntegerField(primary_key=True)
+    created_at = models.DateTimeField()
+    modified_at = models.DateTimeField()
+    action = models.IntegerField(choices=MachineTransaction.ACTION_CUSTOMER_CHOICES)
+    activity_log = models.CharField(max_length=100, null=True, blank=True)
+    amount = models.DecimalField(max_digits=8, decimal_places=2)
+    quantity = models.IntegerField(default=0)
+    total_transaction_amount = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)
+    denomination = models.IntegerField(choices=MachineTransaction.DENOMINATOION_CHOICES_DICT.items(), null=True,
+                                       blank=True)
+    product = models.ForeignKey(Products, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+',
+                                null=True, blank=True)
+    machine = models.ForeignKey(Machine, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+',
+                                null=True, blank=True)
+    client_event_id = models.CharField(max_length=64, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['machine', 'action', 'id'], name='archived_txn_action_idx'),
+            models.Index(fields=['machine', 'product', 'id'], name='archived_txn_product_idx'),
+            models.Index(fields=['machine', 'created_at'], name='archived_txn_created_idx'),
+        ]
+
+
+class MachineSnapshot(AbstractModel):
+    """
+    A machine's balance and stock levels once every ledger entry up to `last_event_id` had been applied.
+    """
+    machine = models.ForeignKey(Machine, on_delete=models.PROTECT, related_name='snapshots')
+    last_event_id = models.PositiveIntegerField()
+    balance = models.DecimalField(max_digits=8, decimal_places=2)
+    # {product id: quantity}
+    stock = models.JSONField(default=dict)
+    # set once verify_ledger has checked the entries between the previous snapshot and this one
+    verified_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['machine', 'last_event_id'], name='machine_snapshot_event_idx'),
+        ]
+
+
+class SalesRollup(AbstractModel):
+    """
+    Units sold and revenue per machine, product and hour or day, folded in from the ledger by `machine.rollups`.
+    """
+    PERIOD_HOUR = 'hour'
+    PERIOD_DAY = 'day'
+
+    PERIOD_CHOICES = (
+        (PERIOD_HOUR, 'Hourly'),
+        (PERIOD_DAY, 'Daily'),
+    )
+
+    machine = models.ForeignKey(Machine, on_delete=models.PROTECT, related_name='+')
+    product = models.ForeignKey(Products, on_delete=models.PROTECT, related_name='+')
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    bucket = models.DateTimeField()
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['machine', 'period', 'bucket', 'product'], name='sales_rollup_unique'),
+        ]
+
+
+class CashRollup(AbstractModel):
+    """
+    Cash inserted (per denomination), refunded and handed back on cancel per machine and hour or day. `amount` is
+    the signed ledger total, `denomination` is 0 for the actions that have none.
+    """
+    machine = models.ForeignKey(Machine, on_delete=models.PROTECT, related_name='+')
+    period = models.CharField(max_length=4, choices=SalesRollup.PERIOD_CHOICES)
+    bucket = models.DateTimeField()
+    action = models.IntegerField(choices=MachineTransaction.ACTION_CUSTOMER_CHOICES)
+    denomination = models.PositiveIntegerField(default=0)
+    count = models.PositiveIntegerField(default=0)
+    amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['machine', 'period', 'bucket', 'action', 'denomination'],
+                                    name='cash_rollup_unique'),
+        ]
+
+
+class RollupWatermark(AbstractModel):
+    """
+    Single row, every ledger entry up to `last_event_id` is already folded into the rollups.
+    """
+    last_event_id = models.PositiveIntegerField(default=0)
+
+
+# The read model, kept in the 'read' database (see machine.routers) by machine.projection.
+
+class ReadMachine(models.Model):
+    """
+    A machine's state and catalog responses, rendered by the projection.
+    """
+    machine_id = models.IntegerField(primary_key=True)
+    state_body = models.BinaryField()
+    catalog_body = models.BinaryField()
+    modified_at = models.DateTimeField(auto_now=True)
+
+
+class ReadTransaction(models.Model):
+    """
+    A ledger entry as the transaction listing and export read it, archived entries included and flagged, so one
+    table answers both the hot and the `include_archived` listing.
+    """
+    id = models.IntegerField(primary_key=True)
+    created_at = models.DateTimeField()
+    action = models.IntegerField(choices=MachineTransaction.ACTION_CUSTOMER_CHOICES)
+    activity_log = models.CharField(max_length=100, null=True, blank=True)
+    amount = models.DecimalField(max_digits=8, decimal_places=2)
+    quantity = models.IntegerField(default=0)
+    total_transaction_amount = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)
+    denomination = models.IntegerField(choices=MachineTransaction.DENOMINATOION_CHOICES_DICT.items(), null=True,
+                                       blank=True)
+    # the primary's tables are not in this database, plain indexed columns
+    product = models.ForeignKey(Products, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+',
+                                null=True, blank=True)
+    machine = models.ForeignKey(Machine, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+',
+                                null=True, blank=True)
+    archived = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['machine', 'archived', 'id'], name='read_txn_hot_idx'),
+            models.Index(fields=['machine', 'action', 'id'], name='read_txn_action_idx'),
+            models.Index(fields=['machine', 'product', 'id'], name='read_txn_product_idx'),
+            models.Index(fields=['machine', 'created_at'], name='read_txn_created_idx'),
+        ]
+
+
+class ReadCheckpoint(models.Model):
+    """
+    Single row, the read model holds everything the primary had committed at `synced_at`.
+    """
+    synced_at = models.DateTimeField()
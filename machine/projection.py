@@ -0,0 +1,114 @@
+"""
+The read model the catalog, state and transaction reads are served from when `MACHINE_READ_MODEL` is on: each
+machine's state and catalog responses rendered ready to send, and its ledger flattened into one table with the
+archived entries flagged. It lives in its own database ('read', see machine.routers), so those reads never wait on
+the primary's writers.
+
+`project()` brings it up to date from the primary, re-rendering the machines written to since its previous run and
+copying their new ledger entries; it looks back `MACHINE_ROLLUP_SETTLE_SECONDS` past the previous run's start, so an
+entry that was slow to commit is still copied. `machine.archive` flags the entries it moves, with the read model on or
+off. Readers fall back to the
+primary once the last run started more than `MACHINE_READ_MAX_STALENESS` seconds ago.
+"""
+from datetime import timedelta
+from itertools import islice
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from machine.models import ArchivedTransaction, Machine, MachineTransaction, ReadCheckpoint, ReadMachine, \
+    ReadTransaction
+from machine.routers import READ_DATABASE
+from machine.serializers import render_catalog, render_machine_state
+
+PROJECTED_FIELDS = [field.attname for field in ReadTransaction._meta.concrete_fields if field.name != 'archived']
+
+
+def project(settle_seconds=None, rebuild=False, batch_size=1000):
+    """
+    Brings the read model up to date, from scratch on its first run or with `rebuild`; returns how many machines
+    were projected.
+    """
+    if settle_seconds is None:
+        settle_seconds = settings.MACHINE_ROLLUP_SETTLE_SECONDS
+    started = timezone.now()
+    synced_at = ReadCheckpoint.objects.filter(pk=1).values_list('synced_at', flat=True).first()
+    rebuild = rebuild or synced_at is None
+    machines = Machine.objects.select_related('last_transaction').order_by('id')
+    since = None
+    if rebuild:
+        with transaction.atomic(using=READ_DATABASE):
+            ReadTransaction.objects.all().delete()
+            ReadMachine.objects.all().delete()
+    else:
+        since = synced_at - timedelta(seconds=settle_seconds)
+        machines = machines.filter(Q(modified_at__gte=since) | Q(products__modified_at__gte=since)).distinct()
+    projected = 0
+    for machine in machines:
+        entries = MachineTransaction.objects.filter(machine=machine)
+        if since is not None:
+            entries = entries.filter(created_at__gte=since)
+        with transaction.atomic(using=READ_DATABASE):
+            copy_entries(entries, batch_size)
+            ReadMachine.objects.update_or_create(machine_id=machine.id, defaults={
+                'state_body': render_machine_state(machine),
+                'catalog_body': render_catalog(machine.id),
+            })
+        projected += 1
+    if rebuild:
+        # after the hot entries, so one archived in between is copied either way
+        copy_entries(ArchivedTransaction.objects.all(), batch_size, archived=True)
+    ReadCheckpoint.objects.update_or_create(pk=1, defaults={'synced_at': started})
+    return projected
+
+
+def copy_entries(entries, batch_size, archived=False):
+    # entries already copied by an earlier, overlapping run are skipped
+    rows = entries.order_by('id').values_list(*PROJECTED_FIELDS).iterator(chunk_size=batch_size)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        ReadTransaction.objects.bulk_create([ReadTransaction(archived=archived, **dict(zip(PROJECTED_FIELDS, row)))
+                                             for row in batch], ignore_conflicts=True)
+
+
+def mark_archived(ids):
+    # whether or not reads are served from it right now, a read model turned on later must not list these as hot
+    if ReadTransaction._meta.db_table in connections[READ_DATABASE].introspection.table_names():
+        ReadTransaction.objects.filter(pk__in=ids).update(archived=True)
+
+
+def freshness():
+    """
+    How many more seconds the read model may be served for, None when it is off or already too far behind.
+    """
+    if not settings.MACHINE_READ_MODEL:
+        return None
+    synced_at = ReadCheckpoint.objects.filter(pk=1).values_list('synced_at', flat=True).first()
+    if synced_at is None:
+        return None
+    left = settings.MACHINE_READ_MAX_STALENESS - (timezone.now() - synced_at).total_seconds()
+    return left if left > 0 else None
+
+
+def rendered(field, machine_id, render):
+    """
+    A render for `machine.cache.get_rendered`: the machine's `state_body` or `catalog_body` from the read model,
+    cached only for as long as it stays within the staleness bound, or `render()` from the primary.
+    """
+    left = freshness()
+    if left is not None and int(left) > 0:
+        body = ReadMachine.objects.filter(machine_id=machine_id).values_list(field, flat=True).first()
+        if body is not None:
+            return bytes(body), int(left)
+    return render()
+
+
+def transactions(machine_id, include_archived=False):
+    queryset = ReadTransaction.objects.filter(machine_id=machine_id)
+    if not include_archived:
+        queryset = queryset.filter(archived=False)
+    return queryset
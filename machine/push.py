@@ -0,0 +1,83 @@
+"""
+In-process pub/sub for machine state. The new state of a machine written by the update views is published once it
+commits and every stream subscribed to that machine (see `machine.streams`) gets it without touching the cache or
+database.
+"""
+import asyncio
+import threading
+from collections import defaultdict
+
+from django.dispatch import receiver
+
+from machine.cache import etag_for
+from machine.catalog import state_changed
+
+
+class Subscription(object):
+    """
+    One stream's view of a machine. Every event is the machine's whole state, so a subscriber that falls behind only
+    keeps the latest one.
+    """
+
+    def __init__(self, machine_id):
+        self.machine_id = machine_id
+        self.loop = asyncio.get_running_loop()
+        self.ready = asyncio.Event()
+        self.latest = None
+
+    def offer(self, entry):
+        self.latest = entry
+        self.ready.set()
+
+    def take(self):
+        entry, self.latest = self.latest, None
+        self.ready.clear()
+        return entry
+
+
+class Broker(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+
+    def subscribe(self, machine_id):
+        subscription = Subscription(machine_id)
+        with self._lock:
+            self._subscriptions[machine_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.machine_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.machine_id]
+
+    def has_subscribers(self, machine_id):
+        with self._lock:
+            return machine_id in self._subscriptions
+
+    def count(self):
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+    def publish(self, machine_id, body):
+        """
+        Hands a rendered state to the subscribers of a machine, from any thread.
+        """
+        entry = (etag_for(body), body)
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(machine_id, ()))
+        for subscription in subscriptions:
+            subscription.loop.call_soon_threadsafe(subscription.offer, entry)
+
+
+broker = Broker()
+
+
+@receiver(state_changed)
+def publish_state(sender, machine_id, body=None, **kwargs):
+    if body is not None and broker.has_subscribers(machine_id):
+        broker.publish(machine_id, body)
@@ -0,0 +1,178 @@
+"""
+Hourly and daily sales and cash rollups, compacted from the append-only ledger.
+
+`compact()` folds every ledger entry past the watermark into the rollup tables and moves the watermark, so each entry
+is aggregated exactly once. `report()` reads the rollups and adds the few entries past the watermark on the fly,
+which keeps reports exact between compactions at a cost bounded by how often the compactor runs.
+"""
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+
+from machine.models import ArchivedTransaction, CashRollup, MachineTransaction, RollupWatermark, SalesRollup
+
+TRUNCATE = {
+    SalesRollup.PERIOD_HOUR: TruncHour,
+    SalesRollup.PERIOD_DAY: TruncDay,
+}
+CASH_ACTIONS = (MachineTransaction.ACTION_INSERT_DENOMINATION, MachineTransaction.ACTION_USER_CANCEL,
+                MachineTransaction.ACTION_REFUND)
+
+SALES_KEY = ('machine_id', 'bucket', 'product_id')
+CASH_KEY = ('machine_id', 'bucket', 'action', 'denomination')
+
+
+def sales_groups(entries, period):
+    return list(entries.filter(action=MachineTransaction.ACTION_SELECT_ITEM)
+                .annotate(bucket=TRUNCATE[period]('created_at'))
+                .values('machine_id', 'bucket', 'product_id')
+                .annotate(units=Count('id'), revenue=Sum('total_transaction_amount')).order_by())
+
+
+def cash_groups(entries, period):
+    groups = list(entries.filter(action__in=CASH_ACTIONS)
+                  .annotate(bucket=TRUNCATE[period]('created_at'))
+                  .values('machine_id', 'bucket', 'action', 'denomination')
+                  .annotate(count=Count('id'), amount=Sum('amount')).order_by())
+    for group in groups:
+        group['denomination'] = group['denomination'] or 0
+    return groups
+
+
+def merge_groups(model, period, groups, key, totals):
+    """
+    Adds aggregated groups to the rollup rows with the same key, creating the rows that do not exist yet.
+    """
+    if not groups:
+        return
+    existing = {
+        tuple(getattr(row, field) for field in key): row
+        for row in model.objects.filter(period=period, machine_id__in={group['machine_id'] for group in groups},
+                                        bucket__in={group['bucket'] for group in groups})
+    }
+    now = timezone.now()
+    changed, created = [], []
+    for group in groups:
+        row = existing.get(tuple(group[field] for field in key))
+        if row is None:
+            created.append(model(period=period, **group))
+            continue
+        for field in totals:
+            setattr(row, field, getattr(row, field) + group[field])
+        row.modified_at = now
+        changed.append(row)
+    model.objects.bulk_update(changed, list(totals) + ['modified_at'], batch_size=500)
+    model.objects.bulk_create(created, batch_size=500)
+
+
+def lock_watermark():
+    # sqlite has no row locks, take the write lock with an update first (see MachineQuerySet.lock)
+    if not RollupWatermark.objects.filter(pk=1).update(modified_at=timezone.now()):
+        RollupWatermark.objects.get_or_create(pk=1)
+    return RollupWatermark.objects.select_for_update().get(pk=1)
+
+
+def compact(settle_seconds=None):
+    """
+    Folds the ledger entries recorded since the last compaction into the rollups, returns how many there were.
+    Entries younger than `settle_seconds` are left for the next run, so one whose transaction commits after a
+    later id was compacted is not skipped.
+    """
+    if settle_seconds is None:
+        settle_seconds = settings.MACHINE_ROLLUP_SETTLE_SECONDS
+    with transaction.atomic():
+        watermark = lock_watermark()
+        pending = MachineTransaction.objects.filter(id__gt=watermark.last_event_id)
+        upto = pending.filter(created_at__lte=timezone.now() - timedelta(seconds=settle_seconds)) \
+            .aggregate(last=Max('id'))['last']
+        if upto is None:
+            return 0
+        entries = pending.filter(id__lte=upto)
+        compacted = entries.count()
+        fold(entries)
+        watermark.last_event_id = upto
+        watermark.save(update_fields=['last_event_id', 'modified_at'])
+    return compacted
+
+
+def fold(entries):
+    for period in TRUNCATE:
+        merge_groups(SalesRollup, period, sales_groups(entries, period), SALES_KEY, ('units', 'revenue'))
+        merge_groups(CashRollup, period, cash_groups(entries, period), CASH_KEY, ('count', 'amount'))
+
+
+def rebuild():
+    """
+    Recomputes the rollups from scratch up to the current watermark, archived entries included (everything archived
+    is below the watermark).
+    """
+    with transaction.atomic():
+        watermark = lock_watermark()
+        SalesRollup.objects.all().delete()
+        CashRollup.objects.all().delete()
+        fold(ArchivedTransaction.objects.all())
+        fold(MachineTransaction.objects.filter(id__lte=watermark.last_event_id))
+
+
+def report(machine_id, period, since=None, until=None):
+    """
+    Sales per product, cash per denomination and both per time bucket for one machine over `[since, until)`.
+    `since` and `until` are rounded down to the period.
+    """
+    for _ in range(3):
+        watermark = RollupWatermark.objects.filter(pk=1).values_list('last_event_id', flat=True).first() or 0
+        sales = SalesRollup.objects.filter(machine_id=machine_id, period=period)
+        cash = CashRollup.objects.filter(machine_id=machine_id, period=period)
+        tail = MachineTransaction.objects.filter(machine_id=machine_id, id__gt=watermark)
+        if since is not None:
+            since = floor(since, period)
+            sales, cash, tail = sales.filter(bucket__gte=since), cash.filter(bucket__gte=since), \
+                tail.filter(created_at__gte=since)
+        if until is not None:
+            until = floor(until, period)
+            sales, cash, tail = sales.filter(bucket__lt=until), cash.filter(bucket__lt=until), \
+                tail.filter(created_at__lt=until)
+        sales_rows = list(sales.values(*SALES_KEY + ('units', 'revenue'))) + sales_groups(tail, period)
+        cash_rows = list(cash.values(*CASH_KEY + ('count', 'amount'))) + cash_groups(tail, period)
+        # a compaction committing while we read would be counted twice, read again
+        if watermark == (RollupWatermark.objects.filter(pk=1).values_list('last_event_id', flat=True).first() or 0):
+            break
+    return summarize(sales_rows, cash_rows)
+
+
+def floor(moment, period):
+    moment = timezone.localtime(moment)
+    moment = moment.replace(minute=0, second=0, microsecond=0)
+    if period == SalesRollup.PERIOD_DAY:
+        moment = moment.replace(hour=0)
+    return moment
+
+
+def summarize(sales_rows, cash_rows):
+    buckets, products, denominations = {}, {}, {}
+    zero = lambda: {'units': 0, 'revenue': Decimal(0), 'cash_in': Decimal(0), 'cash_out': Decimal(0)}
+    for row in sales_rows:
+        bucket = buckets.setdefault(row['bucket'], zero())
+        product = products.setdefault(row['product_id'], {'units': 0, 'revenue': Decimal(0)})
+        for total in (bucket, product):
+            total['units'] += row['units']
+            total['revenue'] += row['revenue'] or 0
+    for row in cash_rows:
+        bucket = buckets.setdefault(row['bucket'], zero())
+        if row['action'] == MachineTransaction.ACTION_INSERT_DENOMINATION:
+            bucket['cash_in'] += row['amount']
+            denomination = denominations.setdefault(row['denomination'], {'count': 0, 'amount': Decimal(0)})
+            denomination['count'] += row['count']
+            denomination['amount'] += row['amount']
+        else:
+            bucket['cash_out'] -= row['amount']
+    return {
+        'buckets': [dict(bucket=moment, **totals) for moment, totals in sorted(buckets.items())],
+        'products': [dict(product=product_id, **totals) for product_id, totals in sorted(products.items())],
+        'denominations': [dict(denomination=value, **totals) for value, totals in sorted(denominations.items())],
+    }
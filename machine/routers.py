@@ -0,0 +1,29 @@
+READ_DATABASE = 'read'
+READ_MODELS = frozenset(['readmachine', 'readtransaction', 'readcheckpoint'])
+
+
+class ReadModelRouter(object):
+    """
+    The read model's tables live in the 'read' database and nowhere else, every other table in the primary
+    ('default'). Writes to the primary's models always go to the primary, even for an object read elsewhere.
+    """
+
+    def database_for(self, model):
+        if model._meta.app_label == 'machine' and model._meta.model_name in READ_MODELS:
+            return READ_DATABASE
+        return 'default'
+
+    def db_for_read(self, model, **hints):
+        return self.database_for(model)
+
+    def db_for_write(self, model, **hints):
+        return self.database_for(model)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the read model refers to the primary's rows by id only
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # data migrations (no model_name) only ever touch the primary's tables
+        in_read_model = app_label == 'machine' and model_name in READ_MODELS
+        return db == (READ_DATABASE if in_read_model else 'default')
@@ -0,0 +1,171 @@
+"""
+Deterministic large datasets for benchmarks and index tuning (see the `seed_data` command).
+
+Machines and their products are bulk inserted empty, then every machine's history is played through the same
+operations the endpoints use (`machine.services`) on a `BufferedWriter`, so the ledger, cash, stock, counters and
+snapshots come out exactly as if customers and operators had used the API: the admin stocks the machine and loads a
+change float, customers buy (paying in random notes, cancelling when the machine cannot give change) or change their
+mind, and the operator restocks sold out products, tops the change up and withdraws the takings. The writer is
+flushed every `batch_size` entries, each flush a handful of bulk queries.
+
+The same arguments always produce the same rows, timestamps included: entries are spread evenly over `days` ending
+at `until`.
+"""
+import random
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from rest_framework.exceptions import ValidationError
+
+from machine import services
+from machine.catalog import invalidate_catalog, invalidate_state
+from machine.models import Machine, MachineSnapshot, MachineTransaction, Products
+
+# name and price of the SKUs handed out to every machine; prices are multiples of the smallest note so any sale can
+# be paid and changed
+CATALOGUE = (
+    ('Lays', 20), ('Uncle Chips', 30), ('Kurkure', 20), ('Britania Cake', 50), ('Bisleri', 20), ('Coke', 40),
+    ('Pepsi', 40), ('Mars', 30), ('KitKat', 30),
+)
+# notes customers pay with, the small ones more often
+CUSTOMER_NOTES = (10, 20, 50, 100)
+CUSTOMER_NOTE_WEIGHTS = (3, 4, 2, 1)
+SLOT_CAPACITY = 20
+# the operator keeps at least this much in 10s and 20s for change and takes the takings out past TAKINGS_LIMIT
+CHANGE_FLOAT = {10: 20, 20: 10}
+TAKINGS_LIMIT = 5000
+CANCEL_RATE = 0.1
+# the most entries one step records: a customer paying the dearest item in the smallest notes, the sale and the refund
+LONGEST_STEP = max(price for _, price in CATALOGUE) // min(CUSTOMER_NOTES) + 2
+
+
+@contextmanager
+def keeping_timestamps(model):
+    # the history brings its own created_at/modified_at, which bulk inserts would otherwise overwrite with now
+    fields = [model._meta.get_field('created_at'), model._meta.get_field('modified_at')]
+    saved = [(field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, (auto_now, auto_now_add) in zip(fields, saved):
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def next_id(model):
+    return (model.objects.aggregate(last=Max('id'))['last'] or 0) + 1
+
+
+def create_machines(count, products_per_machine):
+    """
+    Bulk inserts empty machines, each with `products_per_machine` out of stock products, ids given up front since
+    not every backend hands them back from a bulk insert.
+    """
+    first_machine, first_product = next_id(Machine), next_id(Products)
+    machines = [Machine(id=first_machine + index, state=Machine.STATE_OUT_OF_STOCK, message="Ready !!!")
+                for index in range(count)]
+    products = []
+    for machine in machines:
+        for index in range(products_per_machine):
+            name, price = CATALOGUE[index % len(CATALOGUE)]
+            if index >= len(CATALOGUE):
+                name = '{} {}'.format(name, index // len(CATALOGUE) + 1)
+            products.append(Products(id=first_product + len(products), machine=machine, name=name, price=price,
+                                     quantity=0))
+    Machine.objects.bulk_create(machines, batch_size=services.BufferedWriter.BATCH_SIZE)
+    Products.objects.bulk_create(products, batch_size=services.BufferedWriter.BATCH_SIZE)
+    # the opening snapshot Machine.save() would have taken
+    MachineSnapshot.objects.bulk_create([MachineSnapshot(machine=machine, last_event_id=0, balance=0, stock={})
+                                         for machine in machines], batch_size=services.BufferedWriter.BATCH_SIZE)
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), [Machine, Products]):
+            cursor.execute(sql)
+    return machines
+
+
+class History(object):
+    """
+    Plays one machine's history onto a `BufferedWriter`, stamping each entry with the next point in time.
+    """
+
+    def __init__(self, machine, rng, started, step, batch_size):
+        self.machine = machine
+        self.rng = rng
+        self.at = started
+        self.step = step
+        self.batch_size = batch_size
+        self.writer = services.BufferedWriter(machine)
+        self.recorded = 0
+
+    def run(self, operation, *args):
+        before = len(self.writer.transactions)
+        operation(self.machine, *args, self.writer)
+        for entry in self.writer.transactions[before:]:
+            entry.created_at = entry.modified_at = self.at
+            self.at += self.step
+        self.recorded += len(self.writer.transactions) - before
+
+    def flush(self):
+        with transaction.atomic(), keeping_timestamps(MachineTransaction):
+            self.writer.flush()
+        self.writer = services.BufferedWriter(self.machine)
+
+    def play(self, entries):
+        while self.recorded < entries:
+            self.step_once()
+            if len(self.writer.transactions) >= self.batch_size:
+                self.flush()
+        self.flush()
+
+    def step_once(self):
+        products = self.writer.products
+        sold_out = [product for product in products.values() if product.quantity == 0]
+        if sold_out:
+            product = self.rng.choice(sold_out)
+            return self.run(services.add_product, product.id, SLOT_CAPACITY)
+        for denomination, count in CHANGE_FLOAT.items():
+            if self.machine.cash[denomination] < count // 2:
+                return self.run(services.load_cash, denomination, count - self.machine.cash[denomination])
+        if self.machine.amount > TAKINGS_LIMIT:
+            # everything but the change float
+            takings = sum(denomination * max(count - CHANGE_FLOAT.get(denomination, 0), 0)
+                          for denomination, count in self.machine.cash.items())
+            return self.run(services.withdraw_cash, takings)
+        self.customer(self.rng.choice(list(products.values())))
+
+    def customer(self, product):
+        paid = 0
+        while paid < product.price:
+            note = self.rng.choices(CUSTOMER_NOTES, CUSTOMER_NOTE_WEIGHTS)[0]
+            self.run(services.insert_currency, note)
+            paid += note
+        if self.rng.random() < CANCEL_RATE:
+            return self.run(services.cancel_transaction)
+        try:
+            self.run(services.dispense_product, product.id)
+        except ValidationError:
+            # no change for it, the customer takes their money back
+            self.run(services.cancel_transaction)
+
+
+def generate(machines, products, entries, days, until, seed=0, batch_size=1000, progress=None):
+    """
+    Creates `machines` machines of `products` products each and about `entries` ledger entries between them.
+    Returns the machines created.
+    """
+    rng = random.Random(seed)
+    created = create_machines(machines, products)
+    per_machine = max(entries // machines, 1) if machines else 0
+    # the last step may overshoot the entries asked for, leave it room before `until`
+    step = timedelta(days=days) / (per_machine + LONGEST_STEP)
+    for machine in created:
+        History(machine, rng, until - timedelta(days=days), step, batch_size).play(per_machine)
+        invalidate_catalog(machine.id)
+        invalidate_state(machine.id)
+        if progress is not None:
+            progress(machine)
+    return created
@@ -1,146 +1,83 @@
 from rest_framework import serializers
-from rest_framework.exceptions import NotAcceptable, ValidationError
-from machine.models import Machine, MachineTransaction, Products
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import JSONRenderer
+from machine import services
+from machine.metrics import timed_serializer
+from machine.models import Machine, MachineTransaction, Products, SalesRollup
+from machine.state import MachineState
 from decimal import Decimal
 
 
-class ProductSerializer(serializers.ModelSerializer):
+class TimedSerializerMixin(object):
+    """
+    Counts validation and rendering towards the request's serializer time in /metrics.
+    """
+
+    def is_valid(self, raise_exception=False):
+        with timed_serializer():
+            return super(TimedSerializerMixin, self).is_valid(raise_exception=raise_exception)
+
+    @property
+    def data(self):
+        with timed_serializer():
+            return super(TimedSerializerMixin, self).data
+
+
+class TimedListSerializer(TimedSerializerMixin, serializers.ListSerializer):
+    pass
+
+
+class ProductSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     price = serializers.DecimalField(max_digits=5, decimal_places=2, read_only=True)
     name = serializers.CharField(read_only=True)
 
     class Meta:
         model = Products
+        list_serializer_class = TimedListSerializer
         fields = ['id', 'name', 'price', 'quantity']
 
 
-    def validate_quantity(self, qty):
-        if qty < 1:
-            raise ValidationError('Please select a valid quantity for product')
-        return qty
-
-    def update(self, instance, validated_data):
-        product_obj = super(ProductSerializer, self).update(instance, validated_data)
-        if Machine.objects.last().state == Machine.STATE_OUT_OF_STOCK and product_obj.quantity > 0:
-            Machine.objects.all().update(state=Machine.STATE_READY)
-        return product_obj
-
-
-class TransactionSerializer(serializers.ModelSerializer):
-    amount = serializers.DecimalField(max_digits=5, decimal_places=2, required=False, write_only=True)
-    quantity = serializers.IntegerField(required=False, write_only=True)
-    action_performed = serializers.CharField(source = 'get_action_display', read_only=True)
-    denomination = serializers.IntegerField(write_only=True, required=False)
-    action = serializers.IntegerField(write_only=True)
-    # product = serializers.ModelField(model_field='products_id', read_only=True)
+class TransactionSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    action_performed = serializers.CharField(source='get_action_display', read_only=True)
 
     class Meta:
         model = MachineTransaction
-        fields = ('action', 'denomination', 'product', 'activity_log', 'amount', 'quantity', 'action_performed')
-        # read_only_fields = ('activity_log', 'action_performed')
-
-    def validate_product(self, product):
-        if self.initial_data.get('action') == MachineTransaction.ACTION_SELECT_ITEM:
-            if product.quantity == 0:
-                raise ValidationError("Item is out of stock, Please select any other item")
-            if product.price > self.context.get('machine').last_transaction.total_transaction_amount:
-                raise ValidationError(
-                    "you are short of Rs {}. Please insert amount to continue or choose any other item".format(
-                        product.price - self.context.get('machine').last_transaction.total_transaction_amount
-                    ))
-            return product
-        if self.initial_data.get('action') == MachineTransaction.ACTION_MAINTENANCE_ADD_PRODUCT:
-            return product
+        list_serializer_class = TimedListSerializer
+        fields = ('product', 'activity_log', 'action_performed')
+        read_only_fields = ('product', 'activity_log')
 
-    def validate_quantity(self, qty):
-        if self.initial_data.get('action') == MachineTransaction.ACTION_MAINTENANCE_ADD_PRODUCT:
-            if not qty:
-                raise ValidationError("Please enter quantity of the product to add")
-            if qty < 1:
-                raise ValidationError('Please select a valid quantity for product')
-            return qty
 
-    def validate_denomination(self, denomination):
-        if self.initial_data.get('action') == MachineTransaction.ACTION_INSERT_DENOMINATION:
-            if not denomination:
-                raise ValidationError("please insert money before proceeding")
-            if self.initial_data.get('denomination') not in MachineTransaction.DENOMINATOION_CHOICES_DICT.keys():
-                raise ValidationError("unknown currency inserted")
-            return denomination
+class TransactionFilterSerializer(TimedSerializerMixin, serializers.Serializer):
+    action = serializers.ChoiceField(choices=MachineTransaction.ACTION_CUSTOMER_CHOICES, required=False)
+    product = serializers.IntegerField(required=False)
+    created_after = serializers.DateTimeField(required=False)
+    created_before = serializers.DateTimeField(required=False)
+    include_archived = serializers.BooleanField(required=False, default=False)
 
     def validate(self, attrs):
-        self.refund_serialiser = None
-
-        # handling if currency is inserted
-        if attrs.get('action') == MachineTransaction.ACTION_INSERT_DENOMINATION:
-            attrs['amount'] = attrs.get('denomination')
-            attrs['total_transaction_amount'] = attrs.get('denomination')
-            if self.context.get('machine').state == Machine.STATE_CURRENCY_INSERTED:
-                attrs['total_transaction_amount'] += self.context.get('machine').last_transaction.total_transaction_amount
-            attrs["activity_log"] = "Rs {} inserted, Please Select Item".format(attrs['amount'])
-
-        # handling when item is selected
-        elif attrs.get('action') == MachineTransaction.ACTION_SELECT_ITEM:
-            attrs['amount'] = 0
-            attrs['total_transaction_amount'] = 0
-            attrs["activity_log"] = "Please collect {}. ".format(attrs['product'].name)
-            if attrs.get('product').price < self.context.get('machine').last_transaction.total_transaction_amount:
-                refund_amount = self.context.get('machine').last_transaction.total_transaction_amount \
-                                - attrs.get('product').price
-                self.refund_serialiser = TransactionSerializer(data={
-                    "action": MachineTransaction.ACTION_REFUND,
-                    "activity_log": attrs['activity_log'] + "Collect balance Rs {}".format(refund_amount),
-                    "amount": refund_amount,
-                })
-                self.refund_serialiser.is_valid(raise_exception=True)
-
-        # Handling when user cancelled the transaction
-        elif attrs.get('action') == MachineTransaction.ACTION_USER_CANCEL:
-            if self.context.get('machine').state == Machine.STATE_CURRENCY_INSERTED:
-                refund_amount = self.context.get('machine').last_transaction.total_transaction_amount
-                attrs["activity_log"] = "Transaction Cancelled, Collect Rs {}".format(refund_amount)
-                attrs["amount"] = refund_amount
-                attrs["total_transaction_amount"] = 0
-
-        # Handling for Refund Payment
-        elif attrs.get('action') == MachineTransaction.ACTION_REFUND:
-            pass
-
-        # Handling for payment withdraw
-        elif attrs.get('action') == MachineTransaction.ACTION_MAINTENANCE_WITHRAW_CURRENCY:
-            attrs["activity_log"] = "Rs {} withdrawn by admin".format(attrs['amount'])
-            # attrs["amount"] = refund_amount
-            attrs["total_transaction_amount"] = 0
-
-        # Handling for product add
-        elif attrs.get('action') == MachineTransaction.ACTION_MAINTENANCE_ADD_PRODUCT:
-            attrs['amount'] = 0
-            attrs['total_transaction_amount'] = 0
-            attrs["activity_log"] = "added {} units of {}. ".format(attrs['quantity'], attrs['product'].name)
-            attrs['quantity'] += attrs['product'].quantity
-            self.product_serializer = ProductSerializer(data = {"quantity": attrs.pop('quantity')},
-                                                         instance = attrs['product']
-                                                         )
-            self.product_serializer.is_valid(raise_exception=True)
+        if attrs.get('created_after') and attrs.get('created_before') \
+                and attrs['created_after'] > attrs['created_before']:
+            raise ValidationError("created_after must be earlier than created_before")
         return attrs
 
-
-    def create(self, validated_data):
-        transaction_obj = super(TransactionSerializer, self).create(validated_data=validated_data)
-        if transaction_obj.action == MachineTransaction.ACTION_SELECT_ITEM:
-            transaction_obj.product.dispense()
-        elif transaction_obj.action == MachineTransaction.ACTION_MAINTENANCE_ADD_PRODUCT:
-            self.product_serializer.save()
-        if self.refund_serialiser is not None:
-            return self.refund_serialiser.save()
-        return transaction_obj
+    def filter_queryset(self, queryset):
+        filters = {
+            'action': self.validated_data.get('action'),
+            'product_id': self.validated_data.get('product'),
+            'created_at__gte': self.validated_data.get('created_after'),
+            'created_at__lt': self.validated_data.get('created_before'),
+        }
+        return queryset.filter(**{key: value for key, value in filters.items() if value is not None})
 
 
-class MachineSerializer(serializers.ModelSerializer):
+class MachineSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     state = serializers.CharField(source='get_state_display', read_only=True)
     amount = serializers.SerializerMethodField()
-    total_amount = serializers.DecimalField(max_digits=6, decimal_places=2, source='amount')
-    # product = serializers.IntegerField(write_only=True)
-    # denomination = serializers.IntegerField(write_only=True)
+    message = serializers.CharField(read_only=True)
+    total_amount = serializers.DecimalField(max_digits=6, decimal_places=2, source='amount', read_only=True)
+
+    # the response is the machine's state alone, the update views answer it with the state already rendered
+    state_response = True
 
     class Meta:
         fields = ('state', 'message', 'amount', 'total_amount')
@@ -148,203 +85,92 @@ class MachineSerializer(serializers.ModelSerializer):
 
     def get_amount(self, obj):
         if obj.state == Machine.STATE_CURRENCY_INSERTED:
-            return obj.last_transaction.total_transaction_amount
+            # a Decimal whether the transaction was just written or read back, so both render the same
+            return Decimal(obj.last_transaction.total_transaction_amount)
         else:
             return Decimal(0)
 
 
-class AddCurrencySerializer(serializers.ModelSerializer):
-    state = serializers.CharField(source='get_state_display', read_only=True)
-    amount = serializers.SerializerMethodField()
+def render_machine_state(machine):
+    """
+    The body of `GET machine/<machine_id>/state`, shared with the state pushed to streams so their ETags match.
+    """
+    return MachineState.of(machine).render()
+
+
+def render_catalog(machine_id):
+    """
+    The body of `GET machine/<machine_id>/products`.
+    """
+    products = Products.objects.filter(machine_id=machine_id).order_by('id')
+    return JSONRenderer().render(ProductSerializer(products, many=True).data)
+
+
+# The write serializers below only parse the request and render the machine afterwards, the work itself is done by
+# machine.services under the row lock the view holds.
+
+class AddCurrencySerializer(MachineSerializer):
     denomination = serializers.IntegerField(write_only=True)
-    message = serializers.CharField(read_only=True)
-    total_amount = serializers.DecimalField(max_digits=6, decimal_places=2, source='amount')
 
-    class Meta:
-        model = Machine
+    class Meta(MachineSerializer.Meta):
         fields = ('state', 'message', 'denomination', 'amount', 'total_amount')
 
-    def get_amount(self, obj):
-        if obj.state == Machine.STATE_CURRENCY_INSERTED:
-            return obj.last_transaction.total_transaction_amount
-        else:
-            return Decimal(0)
-
     def validate_denomination(self, denomination):
         if denomination not in MachineTransaction.DENOMINATOION_CHOICES_DICT.keys():
             raise ValidationError("Please enter a valid denomination")
         return denomination
 
-    def validate(self, attrs):
-        validated_data = super(AddCurrencySerializer, self).validate(attrs)
-        if self.instance.state == Machine.STATE_OUT_OF_STOCK:
-            raise ValidationError("Vending Machine is out of stock")
-
-        transaction_data = {
-            "action": MachineTransaction.ACTION_INSERT_DENOMINATION,
-            "denomination": validated_data.pop('denomination', None),
-            "activity_log": ""
-        }
-        self.transaction_serializer = TransactionSerializer(data=transaction_data,
-                                                            context={
-                                                                "machine": self.instance
-                                                            })
-        self.transaction_serializer.is_valid(raise_exception=True)
-        return validated_data
-
     def update(self, instance, validated_data):
-        transaction_obj = self.transaction_serializer.save()
-        validated_data['state'] = Machine.STATE_CURRENCY_INSERTED
-        validated_data['last_transaction'] = transaction_obj
-        validated_data['amount'] = instance.amount + transaction_obj.amount
-        validated_data['message'] = transaction_obj.activity_log
-        return super(AddCurrencySerializer, self).update(instance, validated_data)
-
-
-class UserCancelTransactionSerializer(serializers.ModelSerializer):
-    state = serializers.CharField(source='get_state_display', read_only=True)
-    amount = serializers.SerializerMethodField()
-    message = serializers.CharField(read_only=True)
-    total_amount = serializers.DecimalField(max_digits=6, decimal_places=2, source='amount')
-
-    class Meta:
-        model = Machine
-        fields = ('state', 'message', 'amount', 'total_amount')
-
-    def get_amount(self, obj):
-        if obj.state == Machine.STATE_CURRENCY_INSERTED:
-            return obj.last_transaction.total_transaction_amount
-        else:
-            return Decimal(0)
+        return services.insert_currency(instance, validated_data.get('denomination'))
 
 
-    def validate(self, attrs):
-        validated_date = super(UserCancelTransactionSerializer, self).validate(attrs)
-        if self.instance.state != Machine.STATE_CURRENCY_INSERTED:
-            raise ValidationError("No transaction to cancel")
-        validated_date['state'] = Machine.STATE_READY
-        transaction_data = {
-            "action": MachineTransaction.ACTION_USER_CANCEL,
-            "activity_log": ""
-        }
-        self.transaction_serializer = TransactionSerializer(data=transaction_data,
-                                                            context={
-                                                                "machine": self.instance
-                                                            })
-        self.transaction_serializer.is_valid(raise_exception=True)
-        return validated_date
+class UserCancelTransactionSerializer(MachineSerializer):
 
     def update(self, instance, validated_data):
-        transaction_obj = self.transaction_serializer.save()
-        validated_data['last_transaction'] = transaction_obj
-        validated_data['amount'] = instance.amount - transaction_obj.amount
-        validated_data['message'] = transaction_obj.activity_log
-        return super(UserCancelTransactionSerializer, self).update(instance, validated_data)
+        return services.cancel_transaction(instance)
 
 
-class UserDispenseProductSerializer(serializers.ModelSerializer):
-    state = serializers.CharField(source='get_state_display', read_only=True)
-    amount = serializers.SerializerMethodField()
-    message = serializers.CharField(read_only=True)
+class UserDispenseProductSerializer(MachineSerializer):
     product = serializers.IntegerField(write_only=True, required=True)
-    total_amount = serializers.DecimalField(max_digits=6, decimal_places=2, source='amount')
 
-    class Meta:
-        model = Machine
+    class Meta(MachineSerializer.Meta):
         fields = ('state', 'message', 'amount', 'product', 'total_amount')
 
-    def get_amount(self, obj):
-        if obj.state == Machine.STATE_CURRENCY_INSERTED:
-            return obj.last_transaction.total_transaction_amount
-        else:
-            return Decimal(0)
+    def update(self, instance, validated_data):
+        return services.dispense_product(instance, validated_data.get('product'))
 
-    def validate(self, attrs):
-        validated_date = super(UserDispenseProductSerializer, self).validate(attrs)
-        if self.instance.state != Machine.STATE_CURRENCY_INSERTED:
-            raise ValidationError("Please insert money before selecting any item")
-        validated_date['state'] = Machine.STATE_READY
-        transaction_data = {
-            "action": MachineTransaction.ACTION_SELECT_ITEM,
-            "activity_log": "",
-            "product": validated_date.pop('product', None),
-        }
-        self.transaction_serializer = TransactionSerializer(data=transaction_data,
-                                                            context={
-                                                                "machine": self.instance
-                                                            })
-        self.transaction_serializer.is_valid(raise_exception=True)
-        return validated_date
 
-    def update(self, instance, validated_data):
-        transaction_obj = self.transaction_serializer.save()
-        print(transaction_obj.__dict__)
-        if transaction_obj.action == MachineTransaction.ACTION_REFUND:
-            validated_data['amount'] = instance.amount - transaction_obj.amount
-        validated_data['last_transaction'] = transaction_obj
-        validated_data['message'] = transaction_obj.activity_log
-        if not Products.objects.filter(quantity__gt=0).exists():
-            validated_data['state'] = Machine.STATE_OUT_OF_STOCK
-        return super(UserDispenseProductSerializer, self).update(instance, validated_data)
-
-
-class WithdrawAmountSerializer(serializers.ModelSerializer):
-    state = serializers.CharField(source='get_state_display', read_only=True)
+class WithdrawAmountSerializer(MachineSerializer):
     amount = serializers.DecimalField(max_digits=6, decimal_places=2, read_only=True)
     withdraw_amount = serializers.DecimalField(max_digits=6, decimal_places=2, write_only=True, required=True)
-    message = serializers.CharField(read_only=True)
-    total_amount = serializers.DecimalField(max_digits=6, decimal_places=2, source='amount')
 
-    class Meta:
+    state_response = False
+
+    class Meta(MachineSerializer.Meta):
         fields = ('withdraw_amount', 'state', 'message', 'amount', 'total_amount')
-        model = Machine
 
-    def get_amount(self, obj):
-        if obj.state == Machine.STATE_CURRENCY_INSERTED:
-            return obj.last_transaction.total_transaction_amount
-        else:
-            return Decimal(0)
+    def update(self, instance, validated_data):
+        return services.withdraw_cash(instance, validated_data.get('withdraw_amount'))
 
-    def validate_withdraw_amount(self, amount):
-        if amount <=0:
-            raise ValidationError("Please enter valid amount to withdraw")
-        if amount > self.instance.amount:
-            raise ValidationError("You can withdraw maximum Rs {} ".format(self.instance.amount))
-        return amount
 
-    def validate(self, attrs):
-        validated_data = super(WithdrawAmountSerializer, self).validate(attrs)
-        if self.instance.state == Machine.STATE_CURRENCY_INSERTED:
-            raise ValidationError("You cannot withdraw money. A transaction is in progress")
-        if not validated_data.get('withdraw_amount'):
-            raise ValidationError("Please enter amount to withdraw")
-        validated_data['amount'] = self.instance.amount - validated_data.get('withdraw_amount')
-        transaction_data = {
-            "action": MachineTransaction.ACTION_MAINTENANCE_WITHRAW_CURRENCY,
-            "activity_log": "",
-            "amount": validated_data.pop('withdraw_amount')
-        }
-        self.transaction_serializer = TransactionSerializer(data=transaction_data,
-                                                            context={"machine": self.instance})
-        self.transaction_serializer.is_valid(raise_exception=True)
-        return validated_data
+class LoadCashSerializer(MachineSerializer):
+    denomination = serializers.IntegerField(write_only=True)
+    quantity = serializers.IntegerField(write_only=True)
+
+    class Meta(MachineSerializer.Meta):
+        fields = ('denomination', 'quantity', 'state', 'message', 'amount', 'total_amount')
 
     def update(self, instance, validated_data):
-        transaction_obj = self.transaction_serializer.save()
-        validated_data['last_transaction'] = transaction_obj
-        validated_data['amount'] = instance.amount - transaction_obj.amount
-        validated_data['message'] = transaction_obj.activity_log
-        return super(WithdrawAmountSerializer, self).update(instance, validated_data)
+        return services.load_cash(instance, validated_data.get('denomination'), validated_data.get('quantity'))
 
 
-class AddProductSerializer(serializers.ModelSerializer):
-    state = serializers.CharField(source='get_state_display', read_only=True)
+class AddProductSerializer(MachineSerializer):
     product = serializers.IntegerField(write_only=True)
-    quantity = serializers.IntegerField(required=False)
-    message = serializers.CharField(read_only=True)
+    quantity = serializers.IntegerField(write_only=True)
 
-    class Meta:
-        model = Machine
+    state_response = False
+
+    class Meta(MachineSerializer.Meta):
         fields = ('product', 'quantity', 'state', 'message')
 
     def validate_quantity(self, qty):
@@ -352,26 +178,116 @@ class AddProductSerializer(serializers.ModelSerializer):
             raise ValidationError('Please select a valid quantity for product')
         return qty
 
-    def validate(self, attrs):
-        validated_data = super(AddProductSerializer, self).validate(attrs)
-        if self.instance.state == Machine.STATE_CURRENCY_INSERTED:
-            raise ValidationError("You cannot add products. A transaction is in progress")
-        transaction_data = {
-            "action": MachineTransaction.ACTION_MAINTENANCE_ADD_PRODUCT,
-            "product": validated_data.pop('product', None),
-            "activity_log": "",
-            "quantity": validated_data.pop('quantity')
-        }
-        self.transaction_serializer = TransactionSerializer(data=transaction_data,
-                                                            context={"machine": self.instance})
-        self.transaction_serializer.is_valid(raise_exception=True)
-        return validated_data
+    def update(self, instance, validated_data):
+        return services.add_product(instance, validated_data.get('product'), validated_data.get('quantity'))
+
+
+class RestockLineSerializer(serializers.Serializer):
+    product = serializers.IntegerField()
+    quantity = serializers.IntegerField()
+
+    def validate_quantity(self, qty):
+        if qty < 1:
+            raise ValidationError('Please select a valid quantity for product')
+        return qty
+
+
+class BulkRestockSerializer(MachineSerializer):
+    MAX_LINES = 500
+
+    items = RestockLineSerializer(many=True, write_only=True)
+    results = serializers.SerializerMethodField()
+
+    state_response = False
+
+    class Meta(MachineSerializer.Meta):
+        fields = ('items', 'state', 'message', 'results')
+
+    def validate_items(self, items):
+        if len(items) > self.MAX_LINES:
+            raise ValidationError("You can restock at most {} products per request".format(self.MAX_LINES))
+        return items
+
+    def get_results(self, obj):
+        return getattr(self, 'results', [])
 
     def update(self, instance, validated_data):
-        transaction_obj = self.transaction_serializer.save()
-        validated_data['last_transaction'] = transaction_obj
-        validated_data['message'] = transaction_obj.activity_log
-        return super(AddProductSerializer, self).update(instance, validated_data)
+        self.results = services.restock_products(instance, validated_data.get('items'))
+        return instance
+
+
+class MachineEventSerializer(serializers.Serializer):
+    event_id = serializers.CharField(max_length=64)
+    action = serializers.ChoiceField(choices=list(services.INGESTIBLE_ACTIONS))
+    denomination = serializers.IntegerField(required=False)
+    product = serializers.IntegerField(required=False)
+
+
+class IngestEventsSerializer(MachineSerializer):
+    MAX_EVENTS = 10000
+
+    events = MachineEventSerializer(many=True, write_only=True)
+    applied = serializers.SerializerMethodField()
+    duplicates = serializers.SerializerMethodField()
+    rejected = serializers.SerializerMethodField()
+
+    state_response = False
+
+    class Meta(MachineSerializer.Meta):
+        fields = ('events', 'state', 'message', 'amount', 'total_amount', 'applied', 'duplicates', 'rejected')
+
+    def validate_events(self, events):
+        if len(events) > self.MAX_EVENTS:
+            raise ValidationError("You can upload at most {} events per request".format(self.MAX_EVENTS))
+        return events
+
+    def get_applied(self, obj):
+        return self.outcome['applied']
+
+    def get_duplicates(self, obj):
+        return self.outcome['duplicates']
+
+    def get_rejected(self, obj):
+        return self.outcome['rejected']
+
+    def update(self, instance, validated_data):
+        self.outcome = services.ingest_events(instance, validated_data.get('events') or [])
+        return instance
+
+
+class SalesReportBucketSerializer(serializers.Serializer):
+    bucket = serializers.DateTimeField()
+    units = serializers.IntegerField()
+    revenue = serializers.DecimalField(max_digits=12, decimal_places=2)
+    cash_in = serializers.DecimalField(max_digits=12, decimal_places=2)
+    cash_out = serializers.DecimalField(max_digits=12, decimal_places=2)
+
+
+class SalesReportProductSerializer(serializers.Serializer):
+    product = serializers.IntegerField()
+    name = serializers.CharField()
+    units = serializers.IntegerField()
+    revenue = serializers.DecimalField(max_digits=12, decimal_places=2)
+
+
+class SalesReportDenominationSerializer(serializers.Serializer):
+    denomination = serializers.IntegerField()
+    count = serializers.IntegerField()
+    amount = serializers.DecimalField(max_digits=12, decimal_places=2)
+
+
+class SalesReportSerializer(TimedSerializerMixin, serializers.Serializer):
+    period = serializers.ChoiceField(choices=SalesRollup.PERIOD_CHOICES, default=SalesRollup.PERIOD_HOUR)
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+    buckets = SalesReportBucketSerializer(many=True, read_only=True)
+    products = SalesReportProductSerializer(many=True, read_only=True)
+    denominations = SalesReportDenominationSerializer(many=True, read_only=True)
+
+    def validate(self, attrs):
+        if attrs.get('since') and attrs.get('until') and attrs['since'] >= attrs['until']:
+            raise ValidationError("since must be earlier than until")
+        return attrs
 
 
 # class TransactionSerializer(serializers.ModelSerializer):
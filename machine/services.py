@@ -0,0 +1,399 @@
+"""
+Domain operations behind the machine endpoints.
+
+Each operation takes a machine already locked by the caller (see `MachineQuerySet.lock`), checks its transition in
+`machine.transitions` first, validates the rest of the request against the machine, and persists the outcome with a
+fixed number of queries. Errors are raised as DRF `ValidationError`s
+shaped like the serializer errors the API has always returned, and always before anything is changed.
+
+Persistence goes through a writer: `ImmediateWriter` saves every change as it happens, `BufferedWriter` keeps them in
+memory so a whole batch of operations can be replayed and then saved in bulk.
+"""
+from django.db.models import F
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.settings import api_settings
+
+from machine import ledger
+from machine.change import make_change
+from machine.catalog import invalidate_catalog
+from machine.models import Machine, MachineTransaction, Products
+from machine.transitions import TABLE
+
+
+def reject(message, field=None):
+    raise ValidationError({field or api_settings.NON_FIELD_ERRORS_KEY: [message]})
+
+
+def begin(machine, action):
+    """
+    The transition `action` takes the machine through, refused unless its state allows it.
+    """
+    transition = TABLE[machine.state, action]
+    if transition.refusal is not None:
+        reject(transition.refusal)
+    return transition
+
+
+def check_product(machine, product_id, product):
+    if product_id is None:
+        reject("This field is required.", 'product')
+    if product is None:
+        reject('Invalid pk "{}" - object does not exist.'.format(product_id), 'product')
+    if product.machine_id != machine.id:
+        reject("Item is not available in this machine", 'product')
+    return product
+
+
+def pay_out(machine, amount):
+    """
+    The notes `amount` is paid out in, as negative counts ready for `save_machine(cash_delta=...)`, or None when the
+    machine does not hold the notes to make it exactly.
+    """
+    payout = make_change(amount, machine.cash)
+    if payout is None:
+        return None
+    return {denomination: -count for denomination, count in payout.items()}
+
+
+def inserted_amount(machine):
+    if machine.state == Machine.STATE_CURRENCY_INSERTED:
+        return machine.last_transaction.total_transaction_amount
+    return 0
+
+
+class ImmediateWriter(object):
+
+    def get_product(self, machine, product_id):
+        product = Products.objects.filter(pk=product_id).first() if product_id is not None else None
+        return check_product(machine, product_id, product)
+
+    def record(self, machine, action, activity_log, amount=0, **fields):
+        transaction_obj = MachineTransaction.objects.create(machine=machine, action=action, activity_log=activity_log,
+                                                            amount=amount, **fields)
+        machine.last_transaction = transaction_obj
+        machine.message = activity_log
+        machine.events_since_snapshot += 1
+        return transaction_obj
+
+    def dispense(self, product):
+        if not product.dispense():
+            reject("Item is out of stock, Please select any other item", 'product')
+
+    def restock(self, product, quantity):
+        product.restock(quantity)
+
+    def save_machine(self, machine, amount_delta=0, in_stock_delta=0, cash_delta=None):
+        update_fields = ['state', 'message', 'last_transaction', 'events_since_snapshot', 'modified_at']
+        # the row is locked so the in-memory counters are current, the F()s keep the writes themselves relative
+        deltas = {'amount': amount_delta, 'in_stock_count': in_stock_delta}
+        for denomination, count in (cash_delta or {}).items():
+            deltas[Machine.CASH_FIELDS[denomination]] = count
+        current = {}
+        for field, delta in deltas.items():
+            if delta:
+                current[field] = getattr(machine, field) + delta
+                setattr(machine, field, F(field) + delta)
+                update_fields.append(field)
+        machine.save(update_fields=update_fields)
+        for field, value in current.items():
+            setattr(machine, field, value)
+        ledger.snapshot_if_due(machine)
+        return machine
+
+
+class BufferedWriter(object):
+    """
+    Applies every change to in-memory objects only; `flush()` then saves the lot with bulk queries. The machine's
+    products are loaded once up front. `event_id` is stamped on the first transaction each operation records.
+    """
+    BATCH_SIZE = 500
+
+    def __init__(self, machine):
+        self.machine = machine
+        self.products = machine.products.in_bulk()
+        self.transactions = []
+        self.touched_products = {}
+        self.event_id = None
+
+    def get_product(self, machine, product_id):
+        return check_product(machine, product_id, self.products.get(product_id))
+
+    def record(self, machine, action, activity_log, amount=0, **fields):
+        transaction_obj = MachineTransaction(machine=machine, action=action, activity_log=activity_log, amount=amount,
+                                             client_event_id=self.event_id, **fields)
+        self.event_id = None
+        self.transactions.append(transaction_obj)
+        machine.last_transaction = transaction_obj
+        machine.message = activity_log
+        machine.events_since_snapshot += 1
+        return transaction_obj
+
+    def dispense(self, product):
+        product.quantity -= 1
+        self.touched_products[product.id] = product
+
+    def restock(self, product, quantity):
+        product.quantity += quantity
+        self.touched_products[product.id] = product
+
+    def save_machine(self, machine, amount_delta=0, in_stock_delta=0, cash_delta=None):
+        machine.amount += amount_delta
+        machine.in_stock_count += in_stock_delta
+        for denomination, count in (cash_delta or {}).items():
+            field = Machine.CASH_FIELDS[denomination]
+            setattr(machine, field, getattr(machine, field) + count)
+        return machine
+
+    def flush(self):
+        if not self.transactions:
+            return self.machine
+        now = timezone.now()
+        for product in self.touched_products.values():
+            product.modified_at = now
+        Products.objects.bulk_update(self.touched_products.values(), ['quantity', 'modified_at'],
+                                     batch_size=self.BATCH_SIZE)
+        # bulk inserts do not hand primary keys back on every backend, the last row is saved alone to become the
+        # machine's last transaction
+        MachineTransaction.objects.bulk_create(self.transactions[:-1], batch_size=self.BATCH_SIZE)
+        self.transactions[-1].save()
+        if self.touched_products:
+            invalidate_catalog(self.machine.id)
+        self.machine.last_transaction = self.transactions[-1]
+        self.machine.save(update_fields=['state', 'message', 'last_transaction', 'amount', 'in_stock_count',
+                                         'events_since_snapshot', 'modified_at'] + list(Machine.CASH_FIELDS.values()))
+        ledger.snapshot_if_due(self.machine)
+        return self.machine
+
+
+def insert_currency(machine, denomination, writer=None):
+    writer = writer or ImmediateWriter()
+    transition = begin(machine, MachineTransaction.ACTION_INSERT_DENOMINATION)
+    if denomination is None:
+        reject("please insert money before proceeding", 'denomination')
+    if denomination not in MachineTransaction.DENOMINATOION_CHOICES_DICT:
+        reject("unknown currency inserted", 'denomination')
+
+    writer.record(machine, MachineTransaction.ACTION_INSERT_DENOMINATION,
+                  "Rs {} inserted, Please Select Item".format(denomination),
+                  amount=denomination, denomination=denomination,
+                  total_transaction_amount=inserted_amount(machine) + denomination)
+    machine.state = transition.target
+    return writer.save_machine(machine, denomination, cash_delta={denomination: 1})
+
+
+def cancel_transaction(machine, writer=None):
+    writer = writer or ImmediateWriter()
+    transition = begin(machine, MachineTransaction.ACTION_USER_CANCEL)
+
+    refund_amount = inserted_amount(machine)
+    # the notes just inserted are always there to give back
+    payout = pay_out(machine, refund_amount)
+    if payout is None:
+        reject("Unable to return Rs {}, please contact the operator".format(refund_amount))
+    writer.record(machine, MachineTransaction.ACTION_USER_CANCEL,
+                  "Transaction Cancelled, Collect Rs {}".format(refund_amount),
+                  amount=-refund_amount, total_transaction_amount=0)
+    machine.state = transition.target
+    return writer.save_machine(machine, -refund_amount, cash_delta=payout)
+
+
+def dispense_product(machine, product_id, writer=None):
+    writer = writer or ImmediateWriter()
+    transition = begin(machine, MachineTransaction.ACTION_SELECT_ITEM)
+    product = writer.get_product(machine, product_id)
+    paid = inserted_amount(machine)
+    if product.quantity == 0:
+        reject("Item is out of stock, Please select any other item", 'product')
+    if product.price > paid:
+        reject("you are short of Rs {}. Please insert amount to continue or choose any other item".format(
+            product.price - paid), 'product')
+    refund_amount = paid - product.price
+    payout = pay_out(machine, refund_amount)
+    if payout is None:
+        reject("Exact change of Rs {} is not available. Please insert the exact amount or choose any other "
+               "item".format(refund_amount), 'product')
+
+    activity_log = "Please collect {}. ".format(product.name)
+    # the price charged, so sales reports never depend on what the product costs later
+    writer.record(machine, MachineTransaction.ACTION_SELECT_ITEM, activity_log, product=product, quantity=-1,
+                  total_transaction_amount=product.price)
+    writer.dispense(product)
+    if refund_amount > 0:
+        writer.record(machine, MachineTransaction.ACTION_REFUND,
+                      activity_log + "Collect balance Rs {}".format(refund_amount), amount=-refund_amount)
+    in_stock_delta = -1 if product.quantity == 0 else 0
+    machine.state = transition.target
+    if machine.in_stock_count + in_stock_delta <= 0:
+        machine.state = transition.sold_out
+    return writer.save_machine(machine, -refund_amount, in_stock_delta, payout)
+
+
+def withdraw_cash(machine, amount, writer=None):
+    writer = writer or ImmediateWriter()
+    transition = begin(machine, MachineTransaction.ACTION_MAINTENANCE_WITHRAW_CURRENCY)
+    if amount is None:
+        reject("Please enter amount to withdraw")
+    if amount <= 0:
+        reject("Please enter valid amount to withdraw", 'withdraw_amount')
+    if amount > machine.amount:
+        reject("You can withdraw maximum Rs {} ".format(machine.amount), 'withdraw_amount')
+    payout = pay_out(machine, amount)
+    if payout is None:
+        reject("Rs {} cannot be paid out in the notes the machine holds".format(amount), 'withdraw_amount')
+
+    writer.record(machine, MachineTransaction.ACTION_MAINTENANCE_WITHRAW_CURRENCY,
+                  "Rs {} withdrawn by admin".format(amount), amount=-amount, total_transaction_amount=0)
+    machine.state = transition.target
+    return writer.save_machine(machine, -amount, cash_delta=payout)
+
+
+def load_cash(machine, denomination, quantity, writer=None):
+    writer = writer or ImmediateWriter()
+    transition = begin(machine, MachineTransaction.ACTION_MAINTENANCE_LOAD_CASH)
+    if denomination not in MachineTransaction.DENOMINATOION_CHOICES_DICT:
+        reject("Please enter a valid denomination", 'denomination')
+    if quantity is None or quantity < 1:
+        reject("Please enter a valid number of notes", 'quantity')
+
+    amount = denomination * quantity
+    writer.record(machine, MachineTransaction.ACTION_MAINTENANCE_LOAD_CASH,
+                  "{} notes of Rs {} loaded by admin".format(quantity, denomination), amount=amount,
+                  denomination=denomination, total_transaction_amount=0)
+    machine.state = transition.target
+    return writer.save_machine(machine, amount, cash_delta={denomination: quantity})
+
+
+def add_product(machine, product_id, quantity, writer=None):
+    writer = writer or ImmediateWriter()
+    transition = begin(machine, MachineTransaction.ACTION_MAINTENANCE_ADD_PRODUCT)
+    if quantity is None:
+        reject("Please enter quantity of the product to add", 'quantity')
+    if quantity < 1:
+        reject('Please select a valid quantity for product', 'quantity')
+    product = writer.get_product(machine, product_id)
+
+    writer.record(machine, MachineTransaction.ACTION_MAINTENANCE_ADD_PRODUCT,
+                  "added {} units of {}. ".format(quantity, product.name), product=product, quantity=quantity,
+                  total_transaction_amount=0)
+    in_stock_delta = 1 if product.quantity == 0 else 0
+    writer.restock(product, quantity)
+    machine.state = transition.target
+    return writer.save_machine(machine, in_stock_delta=in_stock_delta)
+
+
+def stock_product(machine, name, price, quantity, writer=None):
+    """
+    Adds a new product to the machine. Its opening stock is recorded like any other restock, so it counts towards
+    `in_stock_count`, takes the machine out of stock and is in the ledger; returns the product.
+    """
+    writer = writer or ImmediateWriter()
+    transition = begin(machine, MachineTransaction.ACTION_MAINTENANCE_ADD_PRODUCT)
+    if quantity is None or quantity < 0:
+        reject('Please select a valid quantity for product', 'quantity')
+    product = Products.objects.create(machine=machine, name=name, price=price, quantity=0)
+    invalidate_catalog(machine.id)
+    if quantity == 0:
+        return product
+
+    writer.record(machine, MachineTransaction.ACTION_MAINTENANCE_ADD_PRODUCT,
+                  "added {} units of {}. ".format(quantity, name), product=product, quantity=quantity,
+                  total_transaction_amount=0)
+    writer.restock(product, quantity)
+    machine.state = transition.target
+    writer.save_machine(machine, in_stock_delta=1)
+    return product
+
+
+def restock_products(machine, items):
+    """
+    Applies a restock manifest, a list of `{'product': id, 'quantity': n}` lines, all or nothing: the whole manifest
+    is validated before anything is written, then products, transactions and the machine are saved in bulk.
+    """
+    transition = begin(machine, MachineTransaction.ACTION_MAINTENANCE_ADD_PRODUCT)
+    if not items:
+        reject("Please add at least one product to restock", 'items')
+
+    products = machine.products.in_bulk([line['product'] for line in items])
+    line_errors, seen = [], set()
+    for line in items:
+        errors = {}
+        if line['product'] not in products:
+            errors['product'] = ["Item is not available in this machine"]
+        elif line['product'] in seen:
+            errors['product'] = ["Product is listed more than once"]
+        seen.add(line['product'])
+        line_errors.append(errors)
+    if any(line_errors):
+        raise ValidationError({'items': line_errors})
+
+    transactions, results, in_stock_delta = [], [], 0
+    now = timezone.now()
+    for line in items:
+        product = products[line['product']]
+        if product.quantity == 0:
+            in_stock_delta += 1
+        product.quantity += line['quantity']
+        product.modified_at = now
+        transactions.append(MachineTransaction(
+            machine=machine, action=MachineTransaction.ACTION_MAINTENANCE_ADD_PRODUCT, product=product, amount=0,
+            quantity=line['quantity'], total_transaction_amount=0,
+            activity_log="added {} units of {}. ".format(line['quantity'], product.name)))
+        results.append({'product': product.id, 'name': product.name, 'added': line['quantity'],
+                        'quantity': product.quantity})
+    Products.objects.bulk_update(products.values(), ['quantity', 'modified_at'])
+    # bulk inserts do not hand primary keys back on every backend, the last line is saved alone to become the
+    # machine's last transaction
+    MachineTransaction.objects.bulk_create(transactions[:-1])
+    transactions[-1].save()
+    invalidate_catalog(machine.id)
+
+    machine.last_transaction = transactions[-1]
+    machine.message = "restocked {} products".format(len(items))
+    machine.events_since_snapshot += len(transactions)
+    machine.state = transition.target
+    ImmediateWriter().save_machine(machine, in_stock_delta=in_stock_delta)
+    return results
+
+
+# actions a machine may upload after being offline, and how an event's fields map onto the operation
+INGESTIBLE_ACTIONS = {
+    MachineTransaction.ACTION_INSERT_DENOMINATION:
+        lambda machine, event, writer: insert_currency(machine, event.get('denomination'), writer),
+    MachineTransaction.ACTION_SELECT_ITEM:
+        lambda machine, event, writer: dispense_product(machine, event.get('product'), writer),
+    MachineTransaction.ACTION_USER_CANCEL:
+        lambda machine, event, writer: cancel_transaction(machine, writer),
+}
+
+
+def ingest_events(machine, events):
+    """
+    Replays an ordered backlog of client events through the same operations the online endpoints use, in memory,
+    then saves everything with bulk queries. Events whose `event_id` is already stored for the machine, or repeated
+    within the batch, are skipped; events the state machine refuses are skipped and reported.
+    """
+    event_ids = [event['event_id'] for event in events]
+    known = set()
+    for start in range(0, len(event_ids), BufferedWriter.BATCH_SIZE):
+        known.update(MachineTransaction.objects.filter(
+            machine=machine, client_event_id__in=event_ids[start:start + BufferedWriter.BATCH_SIZE]
+        ).values_list('client_event_id', flat=True))
+
+    writer = BufferedWriter(machine)
+    applied, duplicates, rejected = 0, 0, []
+    for event in events:
+        if event['event_id'] in known:
+            duplicates += 1
+            continue
+        known.add(event['event_id'])
+        writer.event_id = event['event_id']
+        try:
+            INGESTIBLE_ACTIONS[event['action']](machine, event, writer)
+        except ValidationError as error:
+            writer.event_id = None
+            rejected.append({'event_id': event['event_id'], 'errors': error.detail})
+            continue
+        applied += 1
+    writer.flush()
+    return {'applied': applied, 'duplicates': duplicates, 'rejected': rejected}
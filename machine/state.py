@@ -0,0 +1,46 @@
+"""
+The machine's state as served by `GET machine/<machine_id>/state`, without the DRF field machinery.
+
+`MachineState` holds the four response fields read off a machine already in memory, so building one never queries,
+and renders them straight to the bytes `MachineSerializer` + `JSONRenderer` produce for the same machine.
+"""
+from decimal import ROUND_HALF_UP, Decimal
+from json.encoder import encode_basestring
+
+from machine.models import Machine
+
+# the state labels are fixed, encoded once
+STATE_LABELS = {state: encode_basestring(label).encode() for state, label in Machine.STATE_CHOICES}
+CENTS = Decimal('0.01')
+
+
+class MachineState(object):
+    __slots__ = ('state', 'message', 'amount', 'total_amount')
+
+    def __init__(self, state, message, amount, total_amount):
+        self.state = state
+        self.message = message
+        self.amount = amount
+        self.total_amount = total_amount
+
+    @classmethod
+    def of(cls, machine):
+        amount = 0
+        if machine.state == Machine.STATE_CURRENCY_INSERTED:
+            amount = machine.last_transaction.total_transaction_amount
+        return cls(machine.state, machine.message, amount, machine.amount)
+
+    def render(self):
+        label = STATE_LABELS.get(self.state)
+        if label is None:
+            label = encode_basestring(str(self.state)).encode()
+        if self.message is None:
+            message = b'null'
+        else:
+            # what JSONRenderer does to keep the body valid javascript
+            message = encode_basestring(self.message).replace('\u2028', '\\u2028').replace('\u2029', '\\u2029') \
+                .encode()
+        # `amount` renders as a float and `total_amount` as a fixed point string, like the serializer fields
+        total_amount = '{:f}'.format(Decimal(self.total_amount).quantize(CENTS, rounding=ROUND_HALF_UP))
+        return b''.join((b'{"state":', label, b',"message":', message, b',"amount":',
+                         repr(float(self.amount)).encode(), b',"total_amount":"', total_amount.encode(), b'"}'))
@@ -0,0 +1,162 @@
+"""
+State push for kiosks on the ASGI app: `GET machine/<machine_id>/events` is a Server-Sent Events stream and a
+WebSocket on the same path gets the same events as text messages. Each event is the machine's state as served by
+`GET machine/<machine_id>/state`, sent on connect and then whenever it changes, so a kiosk can drop polling.
+
+Changes written in this process arrive ready rendered from `machine.push`; changes written by other processes are
+noticed by the `machine.aio` state watcher and read once through the state cache, which takes a cache shared by every
+worker (redis).
+"""
+import asyncio
+import json
+import re
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+
+from machine import aio, push
+from machine.catalog import get_state
+from machine.models import Machine
+from machine.serializers import render_machine_state
+
+EVENTS_PATH = re.compile(r'^/machine/(?P<machine_id>[0-9]+)/events$')
+
+
+def router(application):
+    """
+    Wraps the Django ASGI application, taking over the event streams.
+    """
+
+    async def route(scope, receive, send):
+        match = EVENTS_PATH.match(scope.get('path', ''))
+        if scope['type'] == 'http' and match and scope['method'] == 'GET':
+            return await stream(int(match.group('machine_id')), EventSource(receive, send))
+        if scope['type'] == 'websocket':
+            if match:
+                return await stream(int(match.group('machine_id')), WebSocket(receive, send))
+            return await WebSocket(receive, send).reject()
+        return await application(scope, receive, send)
+
+    return route
+
+
+def load_state(machine_id):
+
+    def render():
+        return render_machine_state(Machine.objects.select_related('last_transaction').get(pk=machine_id))
+
+    return get_state(machine_id, render)
+
+
+async def stream(machine_id, client):
+    # subscribed and listening before the first read, a change committing in between is still sent
+    subscription = push.broker.subscribe(machine_id)
+    disconnected = asyncio.ensure_future(client.wait_disconnect())
+    try:
+        sent = None
+        entry = None
+        while not disconnected.done():
+            changed = aio.state_waiters.listen(machine_id)
+            try:
+                if entry is None:
+                    try:
+                        entry = await aio.run_sync(load_state, machine_id)
+                    except ObjectDoesNotExist:
+                        return await client.reject()
+                if sent is None:
+                    if not await client.accept():
+                        return
+                if entry[0] != sent:
+                    await client.send_state(*entry)
+                    sent = entry[0]
+                pushed = asyncio.ensure_future(subscription.ready.wait())
+                done, _ = await asyncio.wait({pushed, changed, disconnected},
+                                             timeout=settings.MACHINE_PUSH_KEEPALIVE_SECONDS,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                pushed.cancel()
+                if subscription.ready.is_set():
+                    entry = subscription.take()
+                elif changed in done:
+                    entry = None
+                elif not done:
+                    await client.keepalive()
+            finally:
+                aio.state_waiters.discard(machine_id, changed)
+    finally:
+        push.broker.unsubscribe(subscription)
+        disconnected.cancel()
+
+
+class EventSource(object):
+
+    def __init__(self, receive, send):
+        self.receive = receive
+        self.send = send
+
+    async def wait_disconnect(self):
+        while (await self.receive())['type'] != 'http.disconnect':
+            pass
+
+    async def accept(self):
+        await self.send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            # nginx would otherwise buffer the stream
+            (b'x-accel-buffering', b'no'),
+        ]})
+        return True
+
+    async def reject(self):
+        await self.send({'type': 'http.response.start', 'status': 404,
+                         'headers': [(b'content-type', b'application/json')]})
+        await self.send({'type': 'http.response.body', 'body': b'{"detail":"Not found."}'})
+
+    async def send_state(self, etag, body):
+        message = b'event: state\nid: ' + etag.encode() + b'\ndata: ' + body + b'\n\n'
+        await self.send({'type': 'http.response.body', 'body': message, 'more_body': True})
+
+    async def keepalive(self):
+        await self.send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+
+
+class WebSocket(object):
+
+    def __init__(self, receive, send):
+        self.receive = receive
+        self.send = send
+        self.connected = asyncio.get_running_loop().create_future()
+        self.listening = False
+
+    async def wait_disconnect(self):
+        # messages from the kiosk are ignored, only connect and disconnect matter
+        self.listening = True
+        while True:
+            message = await self.receive()
+            if message['type'] == 'websocket.connect':
+                self.connected.set_result(True)
+            elif message['type'] == 'websocket.disconnect':
+                if not self.connected.done():
+                    self.connected.set_result(False)
+                return
+
+    async def accept(self):
+        if not await self.connected:
+            return False
+        await self.send({'type': 'websocket.accept'})
+        return True
+
+    async def reject(self):
+        if self.listening:
+            connected = await self.connected
+        else:
+            connected = (await self.receive())['type'] == 'websocket.connect'
+        if connected:
+            await self.send({'type': 'websocket.close', 'code': 4404})
+
+    async def send_state(self, etag, body):
+        await self.send({'type': 'websocket.send',
+                         'text': '{{"etag":{},"state":{}}}'.format(json.dumps(etag), body.decode())})
+
+    async def keepalive(self):
+        # the server's own pings keep the socket open
+        pass
@@ -1,3 +1,1646 @@
-from django.test import TestCase
+import asyncio
+import csv
+import importlib
+import io
+import json
+import os
+import random
+import socketserver
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.core.cache import cache, caches
+from django.core.management import CommandError, call_command
+from django.db import connection, connections, transaction
+from django.db.models import F, ProtectedError
+from django.test import AsyncClient, Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import JSONRenderer
+
+from machine import aio, archive, benchmark, cache as machine_cache, change, idempotency, ledger, \
+    mailboxes as machine_mailboxes, metrics, projection, push, rollups, routers, seed, services, streams, transitions
+from machine.catalog import STATE, invalidate_state
+from machine.mailboxes import Mailboxes
+
+from machine.models import ArchivedTransaction, Machine, MachineSnapshot, MachineTransaction, Products, \
+    ReadCheckpoint, ReadTransaction, SalesRollup
+from machine.serializers import MachineSerializer, TransactionFilterSerializer, render_machine_state
+
+
+class MachineTestMixin(object):
+    """
+    Sets up `self.machine`, holding Rs 100 in notes to give change from, over an empty cache; `patch()` calls its
+    write routes and `apply()` expects them to succeed.
+    """
+    machine_fields = {'amount': 100, 'cash_10': 4, 'cash_20': 3}
+
+    def setUp(self):
+        super(MachineTestMixin, self).setUp()
+        cache.clear()
+        self.machine = self.create_machine()
+
+    def create_machine(self, **fields):
+        return Machine.objects.create(message="Ready !!!", **dict(self.machine_fields, **fields))
+
+    def create_product(self, name='Lays', price=20, quantity=3, machine=None):
+        machine = machine or self.machine
+        with transaction.atomic():
+            product = services.stock_product(Machine.objects.lock(machine.id), name, price, quantity)
+            invalidate_state(machine.id)
+        machine.refresh_from_db()
+        return product
+
+    def patch(self, route, data, client=None, **extra):
+        return (client or self.client).patch('/machine/{}/{}'.format(self.machine.id, route), json.dumps(data),
+                                             content_type='application/json', **extra)
+
+    def apply(self, route, data, **extra):
+        response = self.patch(route, data, **extra)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response
+
+
+class FleetRoutingTests(MachineTestMixin, TestCase):
+    """
+    Two machines side by side, the second created last is the one the legacy un-prefixed routes serve.
+    """
+
+    def setUp(self):
+        super(FleetRoutingTests, self).setUp()
+        self.product = self.create_product()
+        self.other = self.create_machine()
+        self.other_product = self.create_product('Coke', 40, machine=self.other)
+
+    def get(self, machine, route):
+        return self.client.get('/machine/{}/{}'.format(machine.id, route))
+
+    def test_routes_touch_only_their_machine(self):
+        other_history = list(MachineTransaction.objects.filter(machine=self.other).values_list('id', flat=True))
+        other_state = self.get(self.other, 'state').content
+        self.apply('user_insert_currency', {'denomination': 50})
+        refused = self.patch('user_dispense_product', {'product': self.other_product.id})
+        self.assertEqual(refused.status_code, 400)
+        self.assertIn('Item is not available in this machine', str(refused.json()))
+        self.apply('user_dispense_product', {'product': self.product.id})
+        self.apply('admin_add_product', {'product': self.product.id, 'quantity': 4})
+
+        self.assertEqual([row['name'] for row in self.get(self.machine, 'products').json()], ['Lays'])
+        self.assertEqual([row['name'] for row in self.get(self.other, 'products').json()], ['Coke'])
+        self.assertEqual(self.get(self.machine, 'state').json()['total_amount'], '120.00')
+        self.assertEqual(self.get(self.other, 'state').content, other_state)
+        self.assertEqual(len(self.get(self.machine, 'admin_transaction_list').json()['results']),
+                         MachineTransaction.objects.filter(machine=self.machine).count())
+        self.assertEqual(len(self.get(self.other, 'admin_transaction_list').json()['results']), len(other_history))
+        self.assertEqual(self.get(self.other, 'admin_sales_report').json()['products'], [])
+
+        self.other.refresh_from_db()
+        self.other_product.refresh_from_db()
+        self.assertEqual((self.other.amount, self.other.cash), (100, {10: 4, 20: 3, 50: 0, 100: 0}))
+        self.assertEqual(self.other_product.quantity, 3)
+        self.assertEqual(list(MachineTransaction.objects.filter(machine=self.other).values_list('id', flat=True)),
+                         other_history)
+
+    def test_unknown_machine_is_not_found(self):
+        unknown = Machine(id=self.other.id + 1)
+        for route in ('state', 'products', 'admin_transaction_list', 'admin_transaction_export',
+                      'admin_sales_report'):
+            self.assertEqual(self.get(unknown, route).status_code, 404, route)
+        for route in ('user_insert_currency', 'user_cancel_transaction', 'user_dispense_product',
+                      'admin_withdraw', 'admin_add_product', 'admin_restock'):
+            response = self.client.patch('/machine/{}/{}'.format(unknown.id, route), json.dumps({}),
+                                         content_type='application/json')
+            self.assertEqual(response.status_code, 404, route)
+        self.assertFalse(MachineTransaction.objects.filter(machine_id=unknown.id).exists())
+
+    def test_legacy_routes_serve_the_latest_machine(self):
+        response = self.client.patch('/machine/user_insert_currency', json.dumps({'denomination': 20}),
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.other.refresh_from_db()
+        self.machine.refresh_from_db()
+        self.assertEqual((self.other.state, self.machine.state),
+                         (Machine.STATE_CURRENCY_INSERTED, Machine.STATE_READY))
+        self.assertEqual(self.client.get('/machine/state').content, self.get(self.other, 'state').content)
+        self.assertEqual(self.client.get('/machine/products').content, self.get(self.other, 'products').content)
+        self.assertEqual(self.client.get('/machine/admin_transaction_list').json(),
+                         self.get(self.other, 'admin_transaction_list').json())
+
+
+class ConcurrentWriteTests(MachineTestMixin, TransactionTestCase):
+    """
+    Hammers a single machine from many threads at once; every thread has its own database connection, so the
+    writes really do race against each other.
+    """
+    threads = 8
+
+    def setUp(self):
+        super(ConcurrentWriteTests, self).setUp()
+        self.product = self.create_product()
+
+    def patch(self, route, data):
+        # a client per call, the test client is not shared between threads
+        return super(ConcurrentWriteTests, self).patch(route, data, client=Client())
+
+    def run_in_threads(self, target, count):
+        barrier = threading.Barrier(count)
+        results = []
+
+        def worker():
+            try:
+                barrier.wait()
+                results.append(target())
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=worker) for _ in range(count)]
+        for each_worker in workers:
+            each_worker.start()
+        for each_worker in workers:
+            each_worker.join()
+        return results
+
+    def test_parallel_inserts_lose_no_currency(self):
+        inserts_per_thread = 5
+
+        def insert_many():
+            return [self.patch('user_insert_currency', {'denomination': 10}).status_code
+                    for _ in range(inserts_per_thread)]
+
+        results = self.run_in_threads(insert_many, self.threads)
+        self.assertEqual(sum(results, []), [200] * self.threads * inserts_per_thread)
+
+        self.machine.refresh_from_db()
+        inserted = Decimal(10 * self.threads * inserts_per_thread)
+        self.assertEqual(self.machine.amount, 100 + inserted)
+        self.assertEqual(self.machine.last_transaction.total_transaction_amount, inserted)
+
+    def test_parallel_selections_dispense_once(self):
+        self.assertEqual(self.patch('user_insert_currency', {'denomination': 50}).status_code, 200)
+
+        results = self.run_in_threads(
+            lambda: self.patch('user_dispense_product', {'product': self.product.id}).status_code, self.threads)
+        self.assertEqual(sorted(results), [200] + [400] * (self.threads - 1))
+
+        self.product.refresh_from_db()
+        self.machine.refresh_from_db()
+        self.assertEqual(self.product.quantity, 2)
+        self.assertEqual(self.machine.amount, Decimal(100 + 50 - 30))
+        self.assertEqual(MachineTransaction.objects.filter(action=MachineTransaction.ACTION_SELECT_ITEM).count(), 1)
+
+    def test_parallel_sessions_never_overdraw(self):
+        # each thread tries to buy the whole stock; the ledger, the balance and the stock must still agree
+        def buy():
+            statuses = []
+            for _ in range(self.product.quantity + 1):
+                statuses.append(self.patch('user_insert_currency', {'denomination': 20}).status_code)
+                statuses.append(self.patch('user_dispense_product', {'product': self.product.id}).status_code)
+            return statuses
+
+        self.run_in_threads(buy, self.threads)
+
+        self.product.refresh_from_db()
+        self.machine.refresh_from_db()
+        transactions = MachineTransaction.objects.filter(machine=self.machine)
+        sold = transactions.filter(action=MachineTransaction.ACTION_SELECT_ITEM).count()
+        inserted = sum(transactions.filter(action=MachineTransaction.ACTION_INSERT_DENOMINATION)
+                       .values_list('amount', flat=True))
+        refunded = sum(transactions.filter(action=MachineTransaction.ACTION_REFUND).values_list('amount', flat=True))
+        self.assertEqual(self.product.quantity, 0)
+        self.assertEqual(sold, 3)
+        self.assertEqual(self.machine.state, Machine.STATE_OUT_OF_STOCK)
+        self.assertEqual(self.machine.amount, 100 + sold * self.product.price)
+        # refunds are negative ledger entries
+        self.assertEqual(self.machine.amount, 100 + inserted + refunded)
+
+
+class MailboxTests(TestCase):
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.001)
+
+    def test_commands_run_in_arrival_order_and_machines_in_parallel(self):
+        mailboxes, ran = Mailboxes(), []
+
+        def command(machine_id, name):
+            with mailboxes.turn(machine_id):
+                ran.append(name)
+
+        threads = []
+        with mailboxes.turn(1):
+            for position, name in enumerate(['first', 'second', 'third'], 2):
+                threads.append(threading.Thread(target=command, args=(1, name)))
+                threads[-1].start()
+                self.wait_for(lambda: mailboxes.queued(1) == position)
+            # another machine's command is not held up
+            command(2, 'other machine')
+            self.assertEqual(ran, ['other machine'])
+        for thread in threads:
+            thread.join()
+        self.assertEqual(ran, ['other machine', 'first', 'second', 'third'])
+        self.assertEqual(mailboxes.queued(1), 0)
+
+    def test_capacity_bounds_the_turns_held_at_once(self):
+        writers, inside, most = Mailboxes(capacity=2), [], []
+        release = threading.Event()
+
+        def command():
+            with writers.turn('writers'):
+                inside.append(1)
+                most.append(len(inside))
+                release.wait()
+                inside.pop()
+
+        threads = [threading.Thread(target=command) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        self.wait_for(lambda: writers.queued('writers') == 3 and len(inside) == 2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(max(most), 2)
+        self.assertEqual(writers.queued('writers'), 0)
+
+    def test_async_waiters_hold_no_thread_and_may_give_up(self):
+        mailboxes, ran = Mailboxes(), []
+
+        async def command(name, release=None):
+            async with mailboxes.async_turn(1):
+                ran.append(name)
+                if release is not None:
+                    await release.wait()
+
+        async def run():
+            release = asyncio.Event()
+            holder = asyncio.ensure_future(command('holder', release))
+            await asyncio.sleep(0)
+            impatient = asyncio.ensure_future(command('impatient'))
+            patient = asyncio.ensure_future(command('patient'))
+            await asyncio.sleep(0)
+            self.assertEqual(mailboxes.queued(1), 3)
+            impatient.cancel()
+            await asyncio.sleep(0)
+            release.set()
+            await asyncio.gather(holder, patient)
+            self.assertTrue(impatient.cancelled())
+
+        asyncio.run(run())
+        self.assertEqual(ran, ['holder', 'patient'])
+        self.assertEqual(mailboxes.queued(1), 0)
+
+
+class TransactionListingTests(MachineTestMixin, TestCase):
+
+    def setUp(self):
+        super(TransactionListingTests, self).setUp()
+        self.lays = self.create_product()
+        self.coke = self.create_product('Coke', 40)
+        self.monday = datetime(2026, 1, 5, 10, tzinfo=dt_timezone.utc)
+        self.tuesday = self.monday + timedelta(days=1)
+        for day, product in ((self.monday, self.lays), (self.tuesday, self.coke)):
+            with mock.patch('django.utils.timezone.now', return_value=day):
+                self.apply('user_insert_currency', {'denomination': 50})
+                self.apply('user_dispense_product', {'product': product.id})
+        self.url = '/machine/{}/admin_transaction_list'.format(self.machine.id)
+
+    def entries(self, **filters):
+        return list(MachineTransaction.objects.filter(machine=self.machine, **filters).order_by('-id')
+                    .values_list('activity_log', flat=True))
+
+    def listing(self, url=None, **params):
+        logs = []
+        if url is None:
+            url, params = self.url, dict(params, page_size=2)
+        while url:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200, response.content)
+            page = response.json()
+            logs += [row['activity_log'] for row in page['results']]
+            url, params = page['next'], {}
+        return logs
+
+    def test_pages_hold_still_while_entries_are_added(self):
+        history = self.entries()
+        first = self.client.get(self.url, {'page_size': 2}).json()
+        self.assertIsNone(first['previous'])
+        self.apply('user_insert_currency', {'denomination': 20})
+        self.apply('user_cancel_transaction', {})
+        # the cursor carries on below the first page, the entries written since neither shift nor repeat it
+        rest = self.listing(first['next'])
+        self.assertEqual([row['activity_log'] for row in first['results']] + rest, history)
+        self.assertEqual(self.listing(), self.entries())
+
+    def test_each_filter_narrows_the_listing(self):
+        sales = self.listing(action=MachineTransaction.ACTION_SELECT_ITEM)
+        self.assertEqual(len(sales), 2)
+        self.assertEqual(sales, self.entries(action=MachineTransaction.ACTION_SELECT_ITEM))
+        self.assertEqual(self.listing(product=self.coke.id), self.entries(product=self.coke))
+        self.assertEqual(self.listing(created_after=self.tuesday.isoformat()),
+                         self.entries(created_at__gte=self.tuesday))
+        self.assertEqual(self.listing(created_before=self.tuesday.isoformat()),
+                         self.entries(created_at__lt=self.tuesday))
+        self.assertEqual(self.listing(created_after=self.monday.isoformat(), created_before=self.tuesday.isoformat()),
+                         self.entries(created_at__gte=self.monday, created_at__lt=self.tuesday))
+        self.assertEqual(self.listing(action=MachineTransaction.ACTION_REFUND, product=self.lays.id), [])
+
+        backwards = self.client.get(self.url, {'created_after': self.tuesday.isoformat(),
+                                               'created_before': self.monday.isoformat()})
+        self.assertEqual(backwards.status_code, 400)
+        self.assertIn('created_after must be earlier than created_before', str(backwards.json()))
+        self.assertEqual(self.client.get(self.url, {'action': 99}).status_code, 400)
+
+    def test_export_streams_ndjson_and_csv(self):
+        url = '/machine/{}/admin_transaction_export'.format(self.machine.id)
+        expected = list(reversed(self.entries(action=MachineTransaction.ACTION_SELECT_ITEM)))
+
+        ndjson = self.client.get(url, {'action': MachineTransaction.ACTION_SELECT_ITEM})
+        self.assertEqual(ndjson['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(ndjson.streaming_content).decode().splitlines()]
+        self.assertEqual([row['activity_log'] for row in rows], expected)
+        self.assertEqual([row['product_id'] for row in rows], [self.lays.id, self.coke.id])
+
+        exported = self.client.get(url, {'action': MachineTransaction.ACTION_SELECT_ITEM, 'output': 'csv'})
+        self.assertEqual(exported['Content-Type'], 'text/csv')
+        self.assertIn('transactions.csv', exported['Content-Disposition'])
+        header, *rows = csv.reader(b''.join(exported.streaming_content).decode().splitlines())
+        self.assertEqual(header[:3], ['id', 'created_at', 'action'])
+        self.assertEqual([row[header.index('activity_log')] for row in rows], expected)
+
+        self.assertEqual(self.client.get(url, {'output': 'xml'}).status_code, 400)
+
+
+class CatalogCacheTests(MachineTestMixin, TestCase):
+
+    def setUp(self):
+        super(CatalogCacheTests, self).setUp()
+        self.product = self.create_product()
+        self.url = '/machine/{}/products'.format(self.machine.id)
+
+    def test_unchanged_poll_is_served_without_queries(self):
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(json.loads(first.content), [{'id': self.product.id, 'name': 'Lays', 'price': '20.00',
+                                                      'quantity': 3}])
+
+        with self.assertNumQueries(0):
+            cached = self.client.get(self.url)
+            not_modified = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(cached.content, first.content)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], first['ETag'])
+
+    def test_sale_and_restock_invalidate_the_catalog(self):
+        etag = self.client.get(self.url)['ETag']
+        self.patch('user_insert_currency', {'denomination': 20})
+        self.patch('user_dispense_product', {'product': self.product.id})
+
+        after_sale = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(after_sale.status_code, 200)
+        self.assertEqual(json.loads(after_sale.content)[0]['quantity'], 2)
+
+        self.patch('admin_add_product', {'product': self.product.id, 'quantity': 5})
+        after_restock = self.client.get(self.url, HTTP_IF_NONE_MATCH=after_sale['ETag'])
+        self.assertEqual(after_restock.status_code, 200)
+        self.assertEqual(json.loads(after_restock.content)[0]['quantity'], 7)
+
+
+class StateRenderingTests(MachineTestMixin, TransactionTestCase):
+    """
+    A TransactionTestCase, the state is cached by the writes as they commit.
+    """
+
+    def setUp(self):
+        super(StateRenderingTests, self).setUp()
+        self.product = self.create_product()
+
+    def assertRendersLikeTheSerializer(self, machine):
+        self.assertEqual(render_machine_state(machine), JSONRenderer().render(MachineSerializer(machine).data))
+
+    def test_state_renders_like_the_serializer(self):
+        self.assertRendersLikeTheSerializer(self.machine)
+        self.patch('user_insert_currency', {'denomination': 50})
+        machine = Machine.objects.select_related('last_transaction').get(pk=self.machine.id)
+        self.assertRendersLikeTheSerializer(machine)
+        for message in (None, '', 'Rs 50 "inserted"\n', 'caf\xe9 \u2028 \u2029 \U0001f36b'):
+            machine.message = message
+            self.assertRendersLikeTheSerializer(machine)
+        machine.state, machine.amount = Machine.STATE_OUT_OF_STOCK, Decimal('1234.5')
+        self.assertRendersLikeTheSerializer(machine)
+
+    def test_reads_after_a_write_skip_the_database(self):
+        response = self.patch('user_insert_currency', {'denomination': 50})
+        self.assertEqual(response.json(), {'state': 'Currency Inserted',
+                                           'message': 'Rs 50 inserted, Please Select Item', 'amount': 50.0,
+                                           'total_amount': '150.00'})
+        with self.assertNumQueries(0):
+            state = self.client.get('/machine/{}/state'.format(self.machine.id))
+        self.assertEqual(state.content, response.content)
+        self.assertEqual(state['ETag'], machine_cache.etag_for(response.content))
+
+    def test_write_overtaken_by_another_leaves_the_state_to_the_next_read(self):
+        with transaction.atomic():
+            machine_cache.invalidate(STATE, self.machine.id, b'"first"')
+            # a second writer committing and bumping in between
+            machine_cache.invalidate(STATE, self.machine.id)
+        self.assertEqual(machine_cache.get_rendered(STATE, self.machine.id, lambda: b'"read"')[1], b'"read"')
+
+
+class IdempotencyTests(MachineTestMixin, TestCase):
+
+    def setUp(self):
+        super(IdempotencyTests, self).setUp()
+        self.product = self.create_product()
+
+    def patch(self, route, data, key='kiosk-1'):
+        return super(IdempotencyTests, self).patch(route, data, HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retries_are_answered_without_applying_again(self):
+        first = self.patch('user_insert_currency', {'denomination': 50})
+        self.assertEqual(first.status_code, 200)
+        with self.assertNumQueries(0):
+            retry = self.patch('user_insert_currency', {'denomination': 50})
+        self.assertEqual((retry.status_code, retry.content), (200, first.content))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.machine.refresh_from_db()
+        self.assertEqual((self.machine.amount, self.machine.cash_50), (150, 1))
+
+        # the same key on another route is another request
+        self.assertEqual(self.patch('user_dispense_product', {'product': self.product.id}).status_code, 200)
+        self.assertEqual(MachineTransaction.objects.filter(machine=self.machine).count(), 4)
+
+    def test_rejections_are_replayed_and_mismatches_refused(self):
+        rejected = self.patch('user_dispense_product', {'product': self.product.id}, key='k2')
+        self.assertEqual(rejected.status_code, 400)
+        self.patch('user_insert_currency', {'denomination': 20})
+        self.assertEqual(self.patch('user_dispense_product', {'product': self.product.id}, key='k2').content,
+                         rejected.content)
+        self.assertEqual(self.patch('user_insert_currency', {'denomination': 10}).status_code, 422)
+        self.assertEqual(self.patch('user_insert_currency', {'denomination': 10}, key='x' * 256).status_code, 400)
+
+    def test_retry_during_first_attempt_is_refused_with_409(self):
+        body = json.dumps({'denomination': 50}).encode()
+        claim = idempotency.Claim('/machine/{}/user_insert_currency'.format(self.machine.id), 'kiosk-1', body)
+        self.assertIsNone(claim.acquire())
+        self.assertEqual(self.patch('user_insert_currency', {'denomination': 50}).status_code, 409)
+        claim.release()
+        self.assertEqual(self.patch('user_insert_currency', {'denomination': 50}).status_code, 200)
+
+
+class QueryBudgetTests(MachineTestMixin, TestCase):
+    """
+    Pins the number of queries behind every write. The counts include the savepoint pair around the view's atomic
+    block (the test itself runs in a transaction) and the two statements of the machine row lock.
+    """
+
+    def setUp(self):
+        super(QueryBudgetTests, self).setUp()
+        self.product = self.create_product(quantity=5)
+
+    def budgeted(self, route, data, budget):
+        with self.assertNumQueries(budget):
+            return self.apply(route, data)
+
+    def test_insert_currency(self):
+        self.budgeted('user_insert_currency', {'denomination': 50}, 6)
+        self.budgeted('user_insert_currency', {'denomination': 10}, 6)
+
+    def test_dispense_with_refund(self):
+        self.budgeted('user_insert_currency', {'denomination': 50}, 6)
+        self.budgeted('user_dispense_product', {'product': self.product.id}, 9)
+
+    def test_dispense_exact_amount(self):
+        self.budgeted('user_insert_currency', {'denomination': 20}, 6)
+        self.budgeted('user_dispense_product', {'product': self.product.id}, 8)
+
+    def test_cancel(self):
+        self.budgeted('user_insert_currency', {'denomination': 20}, 6)
+        self.budgeted('user_cancel_transaction', {}, 6)
+
+    def test_admin_actions(self):
+        self.budgeted('admin_withdraw', {'withdraw_amount': 10}, 6)
+        self.budgeted('admin_load_cash', {'denomination': 10, 'quantity': 5}, 6)
+        self.budgeted('admin_add_product', {'product': self.product.id, 'quantity': 2}, 8)
+
+    def test_rejected_request_writes_nothing(self):
+        entries = MachineTransaction.objects.count()
+        with self.assertNumQueries(5):
+            response = self.patch('user_dispense_product', {'product': self.product.id})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(MachineTransaction.objects.count(), entries)
+
+
+class InStockCounterTests(MachineTestMixin, TestCase):
+
+    def setUp(self):
+        super(InStockCounterTests, self).setUp()
+        self.lays = self.create_product(quantity=1)
+        self.coke = self.create_product('Coke', 40, quantity=1)
+
+    def buy(self, product):
+        self.patch('user_insert_currency', {'denomination': 50})
+        return self.patch('user_dispense_product', {'product': product.id}).json()
+
+    def test_counter_follows_sales_and_restocks(self):
+        self.machine.refresh_from_db()
+        self.assertEqual(self.machine.in_stock_count, 2)
+
+        self.assertEqual(self.buy(self.lays)['state'], 'Ready')
+        self.assertEqual(self.buy(self.coke)['state'], 'Out of Stock')
+        self.machine.refresh_from_db()
+        self.assertEqual(self.machine.in_stock_count, 0)
+
+        self.assertEqual(self.patch('admin_add_product', {'product': self.lays.id, 'quantity': 2}).json()['state'],
+                         'Ready')
+        self.patch('admin_add_product', {'product': self.lays.id, 'quantity': 2})
+        self.machine.refresh_from_db()
+        self.assertEqual(self.machine.in_stock_count, 1)
+
+    def test_rebuild_command_repairs_drift(self):
+        Machine.objects.filter(pk=self.machine.pk).update(in_stock_count=7)
+        Products.objects.filter(pk=self.coke.pk).update(quantity=0)
+        output = io.StringIO()
+        call_command('rebuild_stock_counters', stdout=output)
+        self.machine.refresh_from_db()
+        self.assertEqual(self.machine.in_stock_count, 1)
+        self.assertIn('1 of 1 machines repaired', output.getvalue())
+
+    def test_refused_delete_leaves_the_counter_alone(self):
+        with self.assertRaises(ValueError):
+            self.lays.delete()
+        self.buy(self.lays)
+        self.lays.refresh_from_db()
+        with self.assertRaises(ProtectedError):
+            self.lays.delete()
+        self.machine.refresh_from_db()
+        self.assertEqual(self.machine.in_stock_count, 1)
+        self.create_product('Pepsi', 30, quantity=0).delete()
+        self.machine.refresh_from_db()
+        self.assertEqual(self.machine.in_stock_count, 1)
+        with self.assertRaises(ValueError):
+            Products.objects.create(machine=self.machine, name='Mars', price=30, quantity=1)
+
+    def test_new_stock_brings_the_machine_back(self):
+        self.buy(self.lays)
+        self.buy(self.coke)
+        catalog = self.client.get('/machine/{}/products'.format(self.machine.id))
+        self.assertEqual(self.client.get('/machine/{}/state'.format(self.machine.id)).json()['state'], 'Out of Stock')
+
+        pepsi = self.create_product('Pepsi', 30, quantity=4)
+        self.assertEqual((self.machine.state, self.machine.in_stock_count), (Machine.STATE_READY, 1))
+        self.assertEqual(self.machine.last_transaction.product_id, pepsi.id)
+        self.assertEqual(self.client.get('/machine/{}/state'.format(self.machine.id)).json()['state'], 'Ready')
+        stocked = self.client.get('/machine/{}/products'.format(self.machine.id), HTTP_IF_NONE_MATCH=catalog['ETag'])
+        self.assertEqual(stocked.status_code, 200)
+        self.assertNotEqual(stocked['ETag'], catalog['ETag'])
+        self.assertEqual(stocked.json()[-1]['quantity'], 4)
+        self.assertEqual(self.buy(pepsi)['state'], 'Ready')
+
+
+class TransitionTableTests(MachineTestMixin, TestCase):
+
+    def operations(self, product):
+        return {
+            MachineTransaction.ACTION_INSERT_DENOMINATION: lambda machine: services.insert_currency(machine, 10),
+            MachineTransaction.ACTION_USER_CANCEL: lambda machine: services.cancel_transaction(machine),
+            MachineTransaction.ACTION_SELECT_ITEM: lambda machine: services.dispense_product(machine, product.id),
+            MachineTransaction.ACTION_MAINTENANCE_WITHRAW_CURRENCY:
+                lambda machine: services.withdraw_cash(machine, 10),
+            MachineTransaction.ACTION_MAINTENANCE_LOAD_CASH: lambda machine: services.load_cash(machine, 10, 1),
+            MachineTransaction.ACTION_MAINTENANCE_ADD_PRODUCT:
+                lambda machine: services.add_product(machine, product.id, 1),
+        }
+
+    def machine_in(self, state):
+        machine = self.create_machine(cash_10=10, cash_20=0)
+        product = self.create_product(quantity=5, machine=machine)
+        machine.state = state
+        if state == Machine.STATE_CURRENCY_INSERTED:
+            machine.last_transaction = MachineTransaction.objects.create(
+                machine=machine, action=MachineTransaction.ACTION_INSERT_DENOMINATION, amount=20, denomination=20,
+                total_transaction_amount=20, activity_log="Rs 20 inserted")
+            machine.amount, machine.cash_20 = 120, 1
+        machine.save()
+        return Machine.objects.select_related('last_transaction').get(pk=machine.id), product
+
+    def test_table_covers_every_state_and_action(self):
+        self.assertEqual(set(transitions.TABLE), {(state, action) for state in transitions.STATES
+                                                  for action in transitions.ACTIONS})
+        for (state, action), transition in transitions.TABLE.items():
+            self.assertIn(transition.target, transitions.STATES)
+            self.assertIn(transition.sold_out, transitions.STATES)
+            if transition.refusal is not None:
+                self.assertEqual((transition.target, transition.sold_out), (state, state))
+
+    def test_every_transition_is_taken_or_refused_as_declared(self):
+        for state in transitions.STATES:
+            for action in transitions.ACTIONS:
+                with self.subTest(state=state, action=action):
+                    machine, product = self.machine_in(state)
+                    operation = self.operations(product)[action]
+                    transition = transitions.TABLE[state, action]
+                    if transition.refusal is None:
+                        operation(machine)
+                        machine.refresh_from_db()
+                        self.assertEqual(machine.state, transition.target)
+                        continue
+                    # refused off the locked machine alone
+                    with self.assertNumQueries(0), self.assertRaisesMessage(ValidationError, transition.refusal):
+                        operation(machine)
+                    machine.refresh_from_db()
+                    self.assertEqual(machine.state, state)
+
+    def test_random_walks_follow_the_table(self):
+        rng = random.Random(7)
+        machine, product = self.machine_in(Machine.STATE_READY)
+        product.quantity = 1
+        product.save()
+        operations = self.operations(product)
+        for step in range(300):
+            action = rng.choice(transitions.ACTIONS)
+            transition = transitions.TABLE[machine.state, action]
+            try:
+                operations[action](machine)
+            except ValidationError as error:
+                # refused by the table, or by the request itself (no change, nothing left to sell)
+                if transition.refusal is not None:
+                    self.assertIn(transition.refusal, str(error.detail))
+                machine = Machine.objects.select_related('last_transaction').get(pk=machine.id)
+                continue
+            self.assertIsNone(transition.refusal, (step, action))
+            machine.refresh_from_db()
+            self.assertIn(machine.state, (transition.target, transition.sold_out))
+            self.assertEqual(machine.state == Machine.STATE_OUT_OF_STOCK, machine.in_stock_count == 0)
+
+
+class ChangeMakingTests(MachineTestMixin, TestCase):
+    machine_fields = {'amount': 100, 'cash_50': 2}
+
+    def setUp(self):
+        super(ChangeMakingTests, self).setUp()
+        self.product = self.create_product(quantity=5)
+
+    def test_fewest_notes_out_of_what_is_held(self):
+        self.assertEqual(change.make_change(Decimal('30.00'), {10: 3, 20: 1, 50: 2}), {20: 1, 10: 1})
+        # taking the 50 first leaves 10 that cannot be made
+        self.assertEqual(change.make_change(60, {10: 0, 20: 3, 50: 1}), {20: 3})
+        self.assertEqual(change.make_change(0, {}), {})
+        self.assertIsNone(change.make_change(30, {10: 2, 50: 5}))
+        self.assertIsNone(change.make_change(Decimal('4.50'), {10: 9}))
+
+    def test_sale_without_change_is_rejected_before_dispensing(self):
+        self.patch('user_insert_currency', {'denomination': 50})
+        response = self.patch('user_dispense_product', {'product': self.product.id})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'product': [
+            'Exact change of Rs 30.00 is not available. Please insert the exact amount or choose any other item']})
+        self.product.refresh_from_db()
+        self.machine.refresh_from_db()
+        self.assertEqual(self.product.quantity, 5)
+        self.assertEqual(self.machine.state, Machine.STATE_CURRENCY_INSERTED)
+        self.assertFalse(MachineTransaction.objects.filter(action=MachineTransaction.ACTION_SELECT_ITEM).exists())
+
+        # the inserted note goes back on cancel
+        self.assertEqual(self.patch('user_cancel_transaction', {}).status_code, 200)
+        self.machine.refresh_from_db()
+        self.assertEqual(self.machine.cash, {10: 0, 20: 0, 50: 2, 100: 0})
+
+    def test_loaded_change_is_paid_out(self):
+        self.assertEqual(self.patch('admin_load_cash', {'denomination': 10, 'quantity': 5}).json()['total_amount'],
+                         '150.00')
+        self.patch('user_insert_currency', {'denomination': 50})
+        self.assertEqual(self.patch('user_dispense_product', {'product': self.product.id}).status_code, 200)
+        self.machine.refresh_from_db()
+        self.assertEqual(self.machine.cash, {10: 2, 20: 0, 50: 3, 100: 0})
+        self.assertEqual(self.machine.amount, sum(denomination * count
+                                                  for denomination, count in self.machine.cash.items()))
+
+        response = self.patch('admin_withdraw', {'withdraw_amount': 40})
+        self.assertEqual(response.json(), {'withdraw_amount': ['Rs 40.00 cannot be paid out in the notes the machine '
+                                                               'holds']})
+        self.assertEqual(self.patch('admin_withdraw', {'withdraw_amount': 120}).status_code, 200)
+        self.machine.refresh_from_db()
+        self.assertEqual(self.machine.cash, {10: 0, 20: 0, 50: 1, 100: 0})
+
+    def test_cash_migration_counts_balances_in_notes(self):
+        count_cash = importlib.import_module('machine.migrations.0010_machine_cash').count_cash
+        Machine.objects.filter(pk=self.machine.pk).update(amount=180, cash_50=0)
+        count_cash(apps, None)
+        self.machine.refresh_from_db()
+        self.assertEqual(self.machine.cash, {10: 1, 20: 1, 50: 1, 100: 1})
+
+        Machine.objects.filter(pk=self.machine.pk).update(amount=Decimal('185.50'))
+        with self.assertRaisesMessage(ValueError, '{} (Rs 185.50)'.format(self.machine.pk)):
+            count_cash(apps, None)
+
+
+class BulkRestockTests(MachineTestMixin, TestCase):
+
+    def setUp(self):
+        super(BulkRestockTests, self).setUp()
+        self.products = [self.create_product('Item {}'.format(index), quantity=index % 2) for index in range(40)]
+
+    def restock(self, items):
+        return self.patch('admin_restock', {'items': items})
+
+    def test_manifest_is_applied_in_bulk(self):
+        items = [{'product': product.id, 'quantity': 5} for product in self.products]
+        with self.assertNumQueries(9):
+            response = self.restock(items)
+        self.assertEqual(response.status_code, 200, response.content)
+        body = response.json()
+        self.assertEqual(body['message'], 'restocked 40 products')
+        self.assertEqual(body['results'][1], {'product': self.products[1].id, 'name': 'Item 1', 'added': 5,
+                                              'quantity': 6})
+        self.assertEqual(sorted(Products.objects.values_list('quantity', flat=True).distinct()), [5, 6])
+        self.assertEqual(MachineTransaction.objects.filter(
+            action=MachineTransaction.ACTION_MAINTENANCE_ADD_PRODUCT, quantity=5).count(), 40)
+        self.machine.refresh_from_db()
+        self.assertEqual(self.machine.in_stock_count, 40)
+        self.assertEqual(self.machine.last_transaction.product_id, self.products[-1].id)
+
+    def test_invalid_line_rejects_the_whole_manifest(self):
+        other = self.create_product('Mars', 30, quantity=1, machine=self.create_machine())
+        entries = MachineTransaction.objects.count()
+        response = self.restock([{'product': self.products[0].id, 'quantity': 5},
+                                 {'product': other.id, 'quantity': 5},
+                                 {'product': self.products[0].id, 'quantity': 1}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'items': [{}, {'product': ['Item is not available in this machine']},
+                                                     {'product': ['Product is listed more than once']}]})
+        self.assertEqual(MachineTransaction.objects.count(), entries)
+        self.assertEqual(self.restock([{'product': self.products[0].id, 'quantity': 0}]).json(),
+                         {'items': [{'quantity': ['Please select a valid quantity for product']}]})
+
+
+class EventIngestionTests(MachineTestMixin, TestCase):
+    # change for the refunds of the 400 sales in the large backlog
+    machine_fields = {'amount': 4000, 'cash_10': 400}
+
+    def setUp(self):
+        super(EventIngestionTests, self).setUp()
+        self.product = self.create_product(quantity=1000)
+
+    def upload(self, events):
+        return self.patch('ingest_events', {'events': events})
+
+    def backlog(self, sales, cancels=0, prefix='event', denomination=50):
+        events = []
+        for cancel in range(cancels):
+            events.append({'event_id': '{}-{}-retry'.format(prefix, cancel), 'action': 1, 'denomination': 10})
+            events.append({'event_id': '{}-{}-cancel'.format(prefix, cancel), 'action': 2})
+        for sale in range(sales):
+            events.append({'event_id': '{}-{}-insert'.format(prefix, sale), 'action': 1,
+                           'denomination': denomination})
+            events.append({'event_id': '{}-{}-select'.format(prefix, sale), 'action': 3, 'product': self.product.id})
+        return events
+
+    def test_backlog_is_replayed_and_stored_in_bulk(self):
+        self.machine = self.create_machine()
+        self.product = self.create_product(price=10, quantity=400)
+        # the duplicate lookup and the inserts run in batches, never per event: 6 lookups and 38 inserts for the 3400
+        # entries (sqlite caps an insert at 90 rows) plus the last one saved alone, then the lock, the products, the
+        # snapshot and the saves
+        with self.assertNumQueries(56):
+            response = self.upload(self.backlog(400, cancels=1100, denomination=20))
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['applied'], 3000)
+
+        self.product.refresh_from_db()
+        self.machine.refresh_from_db()
+        self.assertEqual(self.product.quantity, 0)
+        self.assertEqual(self.machine.state, Machine.STATE_OUT_OF_STOCK)
+        self.assertEqual(self.machine.in_stock_count, 0)
+        self.assertEqual(self.machine.amount, 4000 + 400 * 10)
+        self.assertEqual(self.machine.cash, {10: 0, 20: 400, 50: 0, 100: 0})
+        # every sale stores insert, select and the refund of the change, on top of the product's opening stock
+        self.assertEqual(MachineTransaction.objects.filter(machine=self.machine).count(), 1 + 400 * 3 + 1100 * 2)
+        self.assertEqual(self.machine.last_transaction.action, MachineTransaction.ACTION_REFUND)
+
+    def test_reupload_is_idempotent(self):
+        events = self.backlog(3)
+        self.assertEqual(self.upload(events).json()['applied'], 6)
+        response = self.upload(events + self.backlog(1, prefix='late'))
+        self.assertEqual((response.json()['applied'], response.json()['duplicates']), (2, 6))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity, 996)
+
+    def test_refused_events_are_reported_and_skipped(self):
+        response = self.upload([
+            {'event_id': 'a', 'action': 3, 'product': self.product.id},
+            {'event_id': 'b', 'action': 1, 'denomination': 10},
+            {'event_id': 'c', 'action': 3, 'product': self.product.id},
+            {'event_id': 'd', 'action': 2},
+        ]).json()
+        self.assertEqual(response['applied'], 2)
+        self.assertEqual(response['rejected'], [
+            {'event_id': 'a', 'errors': {'non_field_errors': ['Please insert money before selecting any item']}},
+            {'event_id': 'c', 'errors': {'product': [
+                'you are short of Rs 10.00. Please insert amount to continue or choose any other item']}},
+        ])
+        self.assertEqual(response['state'], 'Ready')
+        self.assertEqual(response['message'], 'Transaction Cancelled, Collect Rs 10')
+
+
+class BenchmarkCycleTests(TestCase):
+    fixtures = [benchmark.FIXTURE]
+
+    def test_cycle_succeeds_and_leaves_the_machine_as_it_found_it(self):
+        recorder = benchmark.Recorder()
+        benchmark.run_client_cycles(self.client, 1, 1, 3, recorder, lambda: CaptureQueriesContext(connection))
+        summary = recorder.summary(1)
+        self.assertEqual(summary['total']['errors'], 0)
+        self.assertEqual(summary['total']['requests'], 3 * len(benchmark.CYCLE))
+        self.assertEqual(summary['routes']['user_insert_currency']['requests'], 9)
+
+        machine = Machine.objects.get(pk=1)
+        self.assertEqual((machine.amount, machine.state), (Decimal('1000.00'), Machine.STATE_READY))
+        self.assertEqual(Products.objects.get(pk=1).quantity, 1000)
+
+    def test_percentiles_use_nearest_rank(self):
+        samples = list(range(1, 101))
+        self.assertEqual([benchmark.percentile(samples, p) for p in (50, 95, 99, 100)], [50, 95, 99, 100])
+        self.assertEqual(benchmark.percentile([7], 99), 7)
+        self.assertIsNone(benchmark.percentile([], 50))
+
+
+class MetricsTests(MachineTestMixin, TestCase):
+    route = 'machine/<int:machine_id>/user_insert_currency'
+
+    def setUp(self):
+        super(MetricsTests, self).setUp()
+        metrics.registry.reset()
+        self.create_product()
+
+    def insert(self):
+        return self.patch('user_insert_currency', {'denomination': 10})
+
+    def series(self, name, **labels):
+        return metrics.registry.snapshot()['histograms'][name][metrics._label_key(labels)]
+
+    def test_records_queries_serializer_time_and_status_per_route(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.insert()
+        query_count = len(queries)
+        self.insert()
+        self.patch('user_dispense_product', {'product': 0})
+
+        labels = {'route': self.route, 'method': 'PATCH'}
+        self.assertEqual(self.series('machine_http_request_duration_seconds', **labels)['count'], 2)
+        self.assertEqual(self.series('machine_db_queries_per_request', **labels)['sum'], 2 * query_count)
+        self.assertGreater(self.series('machine_serializer_duration_seconds', **labels)['sum'], 0)
+        counters = metrics.registry.snapshot()['counters']['machine_http_requests_total']
+        self.assertEqual(counters[metrics._label_key(dict(labels, status=200))], 2)
+        self.assertEqual(counters[metrics._label_key(
+            {'route': 'machine/<int:machine_id>/user_dispense_product', 'method': 'PATCH', 'status': 400})], 1)
+
+        exposition = self.client.get('/metrics').content.decode()
+        self.assertIn('machine_http_requests_total{method="PATCH",route="%s",status="200"} 2' % self.route,
+                      exposition)
+        self.assertIn('machine_db_queries_per_request_bucket{method="PATCH",route="%s",le="+Inf"} 2' % self.route,
+                      exposition)
+
+    def test_snapshots_merge_bucket_by_bucket(self):
+        self.insert()
+        snapshot = metrics.registry.snapshot()
+        merged = metrics.Registry.merge([snapshot, snapshot])
+        key = metrics._label_key({'route': self.route, 'method': 'PATCH'})
+        single = snapshot['histograms']['machine_db_queries_per_request'][key]
+        double = merged['histograms']['machine_db_queries_per_request'][key]
+        self.assertEqual(double['buckets'], [count * 2 for count in single['buckets']])
+        self.assertEqual(double['count'], 2)
+
+    def test_metrics_endpoint_sums_every_worker(self):
+        with tempfile.TemporaryDirectory() as directory, self.settings(MACHINE_METRICS_DIR=directory):
+            self.insert()
+            metrics.worker_files.write(force=True)
+            own = os.path.join(directory, 'metrics-{}.json'.format(os.getpid()))
+            os.rename(own, os.path.join(directory, 'metrics-other-worker.json'))
+            self.insert()
+            exposition = self.client.get('/metrics').content.decode()
+        self.assertIn('machine_http_requests_total{method="PATCH",route="%s",status="200"} 3' % self.route,
+                      exposition)
+
+    def test_slow_requests_log_their_sql(self):
+        with self.settings(MACHINE_SLOW_REQUEST_MS=0), self.assertLogs('machine.slow_requests') as logs:
+            self.insert()
+        self.assertIn(self.route, logs.output[0])
+        self.assertIn('UPDATE "machine_machine"', logs.output[0])
+
+
+class LedgerTests(MachineTestMixin, TestCase):
+
+    machine_fields = {'amount': 300, 'cash_10': 10, 'cash_20': 10}
+
+    def setUp(self):
+        super(LedgerTests, self).setUp()
+        self.product = self.create_product()
+
+    def trade(self):
+        self.apply('user_insert_currency', {'denomination': 50})
+        self.apply('user_dispense_product', {'product': self.product.id})
+        self.apply('user_insert_currency', {'denomination': 10})
+        self.apply('user_cancel_transaction', {})
+        self.apply('admin_withdraw', {'withdraw_amount': 20})
+        self.apply('admin_add_product', {'product': self.product.id, 'quantity': 2})
+
+    def test_entries_are_signed_and_replay_to_any_point(self):
+        self.trade()
+        self.machine.refresh_from_db()
+        self.assertEqual(self.machine.amount, Decimal(300 + 20 - 20))
+        self.assertEqual(ledger.state_at(self.machine.id)[:2], (self.machine.amount, {self.product.id: 4}))
+
+        entries = list(MachineTransaction.objects.filter(machine=self.machine).order_by('id')
+                       .values_list('id', 'action', 'amount', 'quantity'))
+        self.assertEqual([entry[1:] for entry in entries], [
+            (MachineTransaction.ACTION_MAINTENANCE_ADD_PRODUCT, 0, 3),
+            (MachineTransaction.ACTION_INSERT_DENOMINATION, 50, 0),
+            (MachineTransaction.ACTION_SELECT_ITEM, 0, -1),
+            (MachineTransaction.ACTION_REFUND, -30, 0),
+            (MachineTransaction.ACTION_INSERT_DENOMINATION, 10, 0),
+            (MachineTransaction.ACTION_USER_CANCEL, -10, 0),
+            (MachineTransaction.ACTION_MAINTENANCE_WITHRAW_CURRENCY, -20, 0),
+            (MachineTransaction.ACTION_MAINTENANCE_ADD_PRODUCT, 0, 2),
+        ])
+        after_sale = ledger.state_at(self.machine.id, entries[3][0])
+        self.assertEqual(after_sale[:2], (Decimal(320), {self.product.id: 2}))
+
+    def test_ledger_is_append_only(self):
+        self.trade()
+        with self.assertRaises(TypeError):
+            MachineTransaction.objects.filter(machine=self.machine).update(amount=0)
+        with self.assertRaises(TypeError):
+            MachineTransaction.objects.filter(machine=self.machine).delete()
+        entry = MachineTransaction.objects.filter(machine=self.machine).first()
+        entry.amount = 1000
+        with self.assertRaises(TypeError):
+            entry.save()
+
+    @override_settings(MACHINE_LEDGER_SNAPSHOT_EVERY=5)
+    def test_snapshots_bound_the_replay(self):
+        self.machine.refresh_from_db()
+        # the opening stock's entry counts towards the first snapshot
+        self.assertEqual(self.machine.events_since_snapshot, 1)
+        for _ in range(4):
+            self.trade()
+        snapshots = list(MachineSnapshot.objects.filter(machine=self.machine).order_by('last_event_id'))
+        self.machine.refresh_from_db()
+        # the opening snapshot, then one every 5 entries
+        self.assertEqual(len(snapshots), 1 + 29 // 5)
+        self.assertLess(self.machine.events_since_snapshot, 5)
+        latest = snapshots[-1]
+        self.assertEqual(MachineTransaction.objects.filter(machine=self.machine, id__gt=latest.last_event_id).count(),
+                         self.machine.events_since_snapshot)
+        with self.assertNumQueries(3):
+            state = ledger.state_at(self.machine.id)
+        self.assertEqual(state[:2], (self.machine.amount, {self.product.id: 3 + 4 * 1}))
+
+    @override_settings(MACHINE_LEDGER_SNAPSHOT_EVERY=5)
+    def test_opening_stock_follows_the_write_path(self):
+        products = [self.create_product('Item {}'.format(index), quantity=index + 1) for index in range(4)]
+        # the fifth entry, counting the setUp product's, is due a snapshot like any other
+        self.assertEqual(self.machine.events_since_snapshot, 0)
+        self.assertEqual(self.machine.last_transaction.product_id, products[-1].id)
+        snapshot = MachineSnapshot.objects.filter(machine=self.machine).latest('last_event_id')
+        self.assertEqual(snapshot.last_event_id, self.machine.last_transaction_id)
+        self.assertEqual(ledger.state_at(self.machine.id)[1],
+                         {product.id: product.quantity for product in [self.product] + products})
+
+    @override_settings(MACHINE_LEDGER_SNAPSHOT_EVERY=5)
+    def test_verify_ledger_checks_new_snapshots_and_the_live_state(self):
+        self.trade()
+        self.trade()
+        out = io.StringIO()
+        call_command('verify_ledger', stdout=out)
+        self.assertIn('1 machines consistent', out.getvalue())
+        self.assertFalse(MachineSnapshot.objects.filter(verified_at__isnull=True).exists())
+
+        call_command('verify_ledger', '--snapshot', stdout=io.StringIO())
+        self.machine.refresh_from_db()
+        self.assertEqual(self.machine.events_since_snapshot, 0)
+
+        Machine.objects.filter(pk=self.machine.id).update(amount=F('amount') + 5)
+        with self.assertRaisesMessage(CommandError, '1 of 1 machines do not match their ledger'):
+            call_command('verify_ledger', stdout=out)
+        self.assertIn('now: balance', out.getvalue())
+
+
+class SalesRollupTests(MachineTestMixin, TestCase):
+
+    def setUp(self):
+        super(SalesRollupTests, self).setUp()
+        self.lays = self.create_product(quantity=10)
+        self.coke = self.create_product('Coke', 40, quantity=10)
+        self.url = '/machine/{}/admin_sales_report'.format(self.machine.id)
+
+    def buy(self, product, *denominations, at):
+        with mock.patch('django.utils.timezone.now', return_value=at):
+            for denomination in denominations:
+                self.apply('user_insert_currency', {'denomination': denomination})
+            self.apply('user_dispense_product', {'product': product.id})
+
+    def history(self):
+        self.buy(self.lays, 50, at=datetime(2026, 5, 1, 10, 15, tzinfo=dt_timezone.utc))
+        self.buy(self.coke, 20, 20, at=datetime(2026, 5, 1, 10, 45, tzinfo=dt_timezone.utc))
+        self.buy(self.lays, 20, at=datetime(2026, 5, 1, 11, 5, tzinfo=dt_timezone.utc))
+
+    def expected_hourly(self):
+        return [
+            {'bucket': '2026-05-01T10:00:00Z', 'units': 2, 'revenue': '60.00', 'cash_in': '90.00',
+             'cash_out': '30.00'},
+            {'bucket': '2026-05-01T11:00:00Z', 'units': 1, 'revenue': '20.00', 'cash_in': '20.00',
+             'cash_out': '0.00'},
+        ]
+
+    def test_report_is_the_same_before_and_after_compaction(self):
+        self.history()
+        before = self.client.get(self.url).json()
+        self.assertEqual(before['buckets'], self.expected_hourly())
+
+        self.assertEqual(rollups.compact(settle_seconds=0), MachineTransaction.objects.count())
+        self.assertEqual(rollups.compact(settle_seconds=0), 0)
+        self.assertEqual(SalesRollup.objects.filter(period=SalesRollup.PERIOD_HOUR).count(), 3)
+        self.assertEqual(self.client.get(self.url).json(), before)
+
+        self.assertEqual(before['products'], [
+            {'product': self.lays.id, 'name': 'Lays', 'units': 2, 'revenue': '40.00'},
+            {'product': self.coke.id, 'name': 'Coke', 'units': 1, 'revenue': '40.00'},
+        ])
+        self.assertEqual(before['denominations'], [
+            {'denomination': 20, 'count': 3, 'amount': '60.00'},
+            {'denomination': 50, 'count': 1, 'amount': '50.00'},
+        ])
+
+    def test_new_entries_are_added_to_existing_rollups(self):
+        self.buy(self.lays, 50, at=datetime(2026, 5, 1, 10, 15, tzinfo=dt_timezone.utc))
+        rollups.compact(settle_seconds=0)
+        self.buy(self.coke, 20, 20, at=datetime(2026, 5, 1, 10, 45, tzinfo=dt_timezone.utc))
+        self.buy(self.lays, 20, at=datetime(2026, 5, 1, 11, 5, tzinfo=dt_timezone.utc))
+        rollups.compact(settle_seconds=0)
+
+        self.assertEqual(self.client.get(self.url).json()['buckets'], self.expected_hourly())
+        daily = self.client.get(self.url, {'period': 'day'}).json()
+        self.assertEqual(daily['buckets'], [{'bucket': '2026-05-01T00:00:00Z', 'units': 3, 'revenue': '80.00',
+                                             'cash_in': '110.00', 'cash_out': '30.00'}])
+        later = self.client.get(self.url, {'since': '2026-05-01T11:30:00Z'}).json()
+        self.assertEqual(later['buckets'], self.expected_hourly()[1:])
+
+    def test_report_cost_does_not_grow_with_history(self):
+        self.history()
+        rollups.compact(settle_seconds=0)
+        # watermark twice, rollups and tail for sales and cash, product names
+        with self.assertNumQueries(7):
+            self.client.get(self.url)
+        for hour in range(12, 20):
+            self.buy(self.lays, 20, at=datetime(2026, 5, 1, hour, tzinfo=dt_timezone.utc))
+        rollups.compact(settle_seconds=0)
+        with self.assertNumQueries(7):
+            report = self.client.get(self.url).json()
+        self.assertEqual(len(report['buckets']), 10)
+
+    def test_price_changes_do_not_rewrite_past_revenue(self):
+        self.history()
+        before = self.client.get(self.url).json()
+        self.lays.price = 30
+        self.lays.save()
+        self.assertEqual(self.client.get(self.url).json(), before)
+        rollups.compact(settle_seconds=0)
+        rollups.rebuild()
+        self.assertEqual(self.client.get(self.url).json(), before)
+
+    def test_rejects_an_empty_range(self):
+        response = self.client.get(self.url, {'since': '2026-05-02T00:00:00Z', 'until': '2026-05-01T00:00:00Z'})
+        self.assertEqual(response.status_code, 400)
+
+
+class ArchiveTests(MachineTestMixin, TestCase):
+    # archiving flags the entries in the read model's table
+    databases = {'default', routers.READ_DATABASE}
+
+    machine_fields = {'amount': 200, 'cash_10': 10, 'cash_20': 5}
+
+    def setUp(self):
+        self.old = datetime(2020, 1, 1, 10, tzinfo=dt_timezone.utc)
+        with mock.patch('django.utils.timezone.now', return_value=self.old):
+            super(ArchiveTests, self).setUp()
+            self.product = self.create_product(quantity=10)
+            for _ in range(4):
+                self.apply('user_insert_currency', {'denomination': 50})
+                self.apply('user_dispense_product', {'product': self.product.id})
+        self.apply('user_insert_currency', {'denomination': 20})
+        rollups.compact(settle_seconds=0)
+
+    def listing(self, **params):
+        ids, url = [], '/machine/{}/admin_transaction_list'.format(self.machine.id)
+        params['page_size'] = 5
+        while url:
+            page = self.client.get(url, params).json()
+            ids += [row['activity_log'] for row in page['results']]
+            url, params = page['next'], {}
+        return ids
+
+    def test_old_entries_move_to_the_archive_in_batches(self):
+        all_ids = list(MachineTransaction.objects.order_by('id').values_list('id', flat=True))
+        self.assertEqual(archive.archive(older_than_days=90, batch_size=4), len(all_ids) - 1)
+        # only the live session's entry, younger than the cutoff, stays in the hot table
+        self.assertEqual(list(MachineTransaction.objects.values_list('id', flat=True)), all_ids[-1:])
+        self.assertEqual(list(ArchivedTransaction.objects.order_by('id').values_list('id', flat=True)),
+                         all_ids[:-1])
+        self.assertEqual(archive.archive(older_than_days=90), 0)
+
+    def test_last_transaction_is_kept_hot(self):
+        self.apply('user_cancel_transaction', {})
+        with mock.patch('django.utils.timezone.now', return_value=datetime(2030, 1, 1, tzinfo=dt_timezone.utc)):
+            archive.archive(older_than_days=90)
+        self.machine.refresh_from_db()
+        self.assertEqual(list(MachineTransaction.objects.values_list('id', flat=True)),
+                         [self.machine.last_transaction_id])
+
+    def test_readers_reach_the_archive(self):
+        history = self.listing(include_archived='true')
+        report = self.client.get('/machine/{}/admin_sales_report'.format(self.machine.id)).json()
+        old_state = ledger.state_at(self.machine.id, MachineTransaction.objects.order_by('id')[3].id)
+
+        archive.archive(older_than_days=90)
+        self.assertEqual(self.listing(), history[:1])
+        self.assertEqual(self.listing(include_archived='true'), history)
+        export = self.client.get('/machine/{}/admin_transaction_export'.format(self.machine.id),
+                                 {'include_archived': 'true'})
+        self.assertEqual(len(b''.join(export.streaming_content).splitlines()), len(history))
+
+        self.assertEqual(self.client.get('/machine/{}/admin_sales_report'.format(self.machine.id)).json(), report)
+        rollups.rebuild()
+        self.assertEqual(self.client.get('/machine/{}/admin_sales_report'.format(self.machine.id)).json(), report)
+        self.assertEqual(ledger.state_at(self.machine.id, old_state.last_event_id), old_state)
+        call_command('verify_ledger', '--full', stdout=io.StringIO())
+
+
+@override_settings(MACHINE_READ_MODEL=True)
+class ReadModelTests(MachineTestMixin, TestCase):
+    """
+    The primary and the read model are two sqlite files here, test_db.sqlite3 and test_read.sqlite3.
+    """
+    databases = {'default', routers.READ_DATABASE}
+
+    def setUp(self):
+        super(ReadModelTests, self).setUp()
+        self.product = self.create_product()
+        self.apply('user_insert_currency', {'denomination': 50})
+        self.apply('user_dispense_product', {'product': self.product.id})
+
+    def reads(self, **params):
+        cache.clear()
+        return [self.client.get('/machine/{}/{}'.format(self.machine.id, route), params).content
+                for route in ('products', 'state', 'admin_transaction_list')]
+
+    def listing(self, **params):
+        page = self.client.get('/machine/{}/admin_transaction_list'.format(self.machine.id), params).json()
+        return [row['activity_log'] for row in page['results']]
+
+    def test_router_keeps_the_read_model_apart(self):
+        router = routers.ReadModelRouter()
+        self.assertEqual(router.db_for_write(Machine), 'default')
+        self.assertEqual(router.db_for_read(MachineTransaction), 'default')
+        self.assertEqual(router.db_for_read(ReadTransaction), routers.READ_DATABASE)
+        self.assertTrue(router.allow_migrate(routers.READ_DATABASE, 'machine', 'readtransaction'))
+        self.assertFalse(router.allow_migrate(routers.READ_DATABASE, 'machine', 'machinetransaction'))
+        self.assertFalse(router.allow_migrate(routers.READ_DATABASE, 'machine'))
+        self.assertFalse(router.allow_migrate('default', 'machine', 'readmachine'))
+        self.assertFalse(router.allow_migrate(routers.READ_DATABASE, 'auth', 'user'))
+
+    def test_reads_are_served_from_the_projection(self):
+        call_command('project_reads', stdout=io.StringIO())
+        with CaptureQueriesContext(connections['default']) as primary:
+            served = self.reads()
+        self.assertEqual(len(primary), 0)
+        with override_settings(MACHINE_READ_MODEL=False):
+            self.assertEqual(served, self.reads())
+
+    def test_writes_are_read_once_projected(self):
+        projection.project()
+        self.apply('user_insert_currency', {'denomination': 20})
+        self.assertEqual(len(self.listing()), 4)
+        self.assertEqual(projection.project(), 1)
+        self.assertEqual(len(self.listing()), 5)
+        with override_settings(MACHINE_READ_MODEL=False):
+            self.assertEqual(self.reads(), self.reads())
+
+    def test_reads_past_the_staleness_bound_go_to_the_primary(self):
+        projection.project()
+        self.apply('user_insert_currency', {'denomination': 20})
+        ReadCheckpoint.objects.update(synced_at=timezone.now() - timedelta(seconds=6))
+        with CaptureQueriesContext(connections['default']) as primary:
+            self.assertEqual(len(self.listing()), 5)
+        self.assertGreater(len(primary), 0)
+
+    @override_settings(MACHINE_ROLLUP_SETTLE_SECONDS=0)
+    def test_archived_entries_are_flagged(self):
+        projection.project()
+        history = self.listing()
+        archive.archive(older_than_days=0)
+        self.assertEqual(ReadTransaction.objects.filter(archived=False).count(), 1)
+        self.assertEqual(self.listing(), history[:1])
+        self.assertEqual(self.listing(include_archived='true'), history)
+        projection.project(rebuild=True)
+        self.assertEqual(self.listing(), history[:1])
+        self.assertEqual(self.listing(include_archived='true'), history)
+
+    @override_settings(MACHINE_ROLLUP_SETTLE_SECONDS=0)
+    def test_entries_archived_while_the_read_model_is_off_are_flagged(self):
+        projection.project()
+        history = self.listing()
+        with override_settings(MACHINE_READ_MODEL=False):
+            archive.archive(older_than_days=0)
+        # no run in between, the projection is still within its staleness bound
+        self.assertEqual(self.listing(), history[:1])
+        self.assertEqual(self.listing(include_archived='true'), history)
+
+
+class SeedDataTests(TestCase):
+
+    def seed(self, **options):
+        out = io.StringIO()
+        call_command('seed_data', machines=2, products=3, transactions=600, days=10, until='2026-01-01',
+                     batch_size=50, stdout=out, **options)
+        return out.getvalue()
+
+    def history(self, machine_id):
+        return list(MachineTransaction.objects.filter(machine_id=machine_id).order_by('id')
+                    .values_list('action', 'denomination', 'amount', 'quantity', 'product__name', 'created_at'))
+
+    def test_history_is_played_through_the_flows(self):
+        self.assertIn('seeded 2 machines', self.seed())
+        machines = list(Machine.objects.order_by('id'))
+        self.assertEqual(len(machines), 2)
+        self.assertEqual(Products.objects.count(), 6)
+        self.assertGreaterEqual(MachineTransaction.objects.count(), 600)
+        actions = set(MachineTransaction.objects.values_list('action', flat=True))
+        self.assertTrue({MachineTransaction.ACTION_SELECT_ITEM, MachineTransaction.ACTION_MAINTENANCE_ADD_PRODUCT,
+                         MachineTransaction.ACTION_MAINTENANCE_LOAD_CASH} <= actions)
+
+        until = datetime(2026, 1, 1, tzinfo=dt_timezone.utc)
+        stamps = MachineTransaction.objects.values_list('created_at', flat=True)
+        self.assertGreaterEqual(min(stamps), datetime(2025, 12, 22, tzinfo=dt_timezone.utc))
+        self.assertLess(max(stamps), until)
+        for machine in machines:
+            self.assertEqual(sum(denomination * count for denomination, count in machine.cash.items()),
+                             machine.amount)
+        out = io.StringIO()
+        call_command('verify_ledger', '--full', stdout=out)
+        self.assertIn('2 machines consistent', out.getvalue())
+
+    def test_same_seed_same_rows(self):
+        self.seed()
+        self.seed()
+        first, _, again, _ = Machine.objects.order_by('id').values_list('id', flat=True)
+        self.assertEqual(self.history(first), self.history(again))
+        self.seed(seed=1)
+        other = Machine.objects.order_by('-id').values_list('id', flat=True)[1]
+        self.assertNotEqual(self.history(first), self.history(other))
+
+
+@override_settings(ROOT_URLCONF='vending_machine_apis.asgi_urls')
+class AsyncViewTests(MachineTestMixin, TransactionTestCase):
+    """
+    The ASGI routes: the views run on the `machine.aio` pool with their own connections, hence a TransactionTestCase.
+    """
+
+    def setUp(self):
+        super(AsyncViewTests, self).setUp()
+        self.product = self.create_product()
+        self.client = AsyncClient()
+
+    async def request(self, method, route, data=None, etag=None):
+        body = None if data is None else json.dumps(data)
+        return await self.client.generic(method, '/machine/{}/{}'.format(self.machine.id, route), body or '',
+                                         headers=benchmark.asgi_headers(body, etag))
+
+    async def poll(self, etag, wait):
+        return await self.request('GET', 'state?wait={}'.format(wait), etag=etag)
+
+    async def test_flow_runs_on_the_pool(self):
+        metrics.registry.reset()
+        response = await self.request('PATCH', 'user_insert_currency', {'denomination': 20})
+        self.assertEqual(response.status_code, 200, response.content)
+        response = await self.request('PATCH', 'user_dispense_product', {'product': self.product.id})
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['total_amount'], '120.00')
+
+        products = await self.request('GET', 'products')
+        self.assertEqual(products.json()[0]['quantity'], 2)
+        self.assertEqual((await self.request('GET', 'products', etag=products['ETag'])).status_code, 304)
+        export = await self.request('GET', 'admin_transaction_export?output=csv')
+        self.assertEqual(len(b''.join(export.streaming_content).splitlines()), 4)
+
+        self.assertEqual(await sync_to_async(lambda: Products.objects.get(pk=self.product.pk).quantity)(), 2)
+        # queries made on the pool threads still count against the request
+        snapshot = metrics.registry.snapshot()['histograms']['machine_db_queries_per_request']
+        route = json.dumps(sorted({'route': 'machine/<int:machine_id>/user_dispense_product',
+                                   'method': 'PATCH'}.items()))
+        self.assertGreater(snapshot[route]['sum'], 0)
+
+    async def test_legacy_writes_queue_with_the_machine_routes(self):
+        holding, release = asyncio.Event(), asyncio.Event()
+
+        async def hold():
+            async with machine_mailboxes.async_turn(self.machine.id):
+                holding.set()
+                await release.wait()
+
+        holder = asyncio.ensure_future(hold())
+        await holding.wait()
+        body = json.dumps({'denomination': 20})
+        legacy = asyncio.ensure_future(self.client.generic('PATCH', '/machine/user_insert_currency', body,
+                                                           headers=benchmark.asgi_headers(body, None)))
+        await asyncio.sleep(0.2)
+        self.assertFalse(legacy.done())
+        self.assertEqual(machine_mailboxes.machines.queued(self.machine.id), 2)
+        release.set()
+        await holder
+        response = await asyncio.wait_for(legacy, 5)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['total_amount'], '120.00')
+
+    async def test_long_poll_answers_when_the_state_changes(self):
+        etag = (await self.request('GET', 'state'))['ETag']
+        self.assertEqual((await self.poll(etag, 0.1)).status_code, 304)
+
+        poll = asyncio.ensure_future(self.poll(etag, 10))
+        await asyncio.sleep(0.2)
+        self.assertFalse(poll.done())
+        await self.request('PATCH', 'user_insert_currency', {'denomination': 20})
+        response = await asyncio.wait_for(poll, 5)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['total_amount'], '120.00')
+        self.assertEqual(aio.state_waiters.count(), 0)
+
+    @override_settings(MACHINE_LONG_POLL_RECHECK_SECONDS=0.1)
+    async def test_long_poll_sees_changes_made_by_other_processes(self):
+        etag = (await self.request('GET', 'state'))['ETag']
+        poll = asyncio.ensure_future(self.poll(etag, 10))
+        await asyncio.sleep(0.3)
+
+        def change_elsewhere():
+            # what another worker's write leaves behind: new data and a bumped version, no signal in this process
+            Machine.objects.filter(pk=self.machine.pk).update(amount=F('amount') + 10)
+            machine_cache._bump_version(STATE, self.machine.id)
+
+        await sync_to_async(change_elsewhere)()
+        response = await asyncio.wait_for(poll, 5)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['total_amount'], '110.00')
+
+
+@override_settings(ROOT_URLCONF='vending_machine_apis.asgi_urls')
+class StateStreamTests(MachineTestMixin, TransactionTestCase):
+
+    def setUp(self):
+        super(StateStreamTests, self).setUp()
+        self.client = AsyncClient()
+
+    def connect(self, scope_type, machine_id=None):
+        inbox, outbox = asyncio.Queue(), asyncio.Queue()
+        scope = {'type': scope_type, 'path': '/machine/{}/events'.format(machine_id or self.machine.id),
+                 'method': 'GET', 'headers': []}
+        task = asyncio.ensure_future(streams.router(None)(scope, inbox.get, outbox.put))
+        return inbox, outbox, task
+
+    async def insert(self, denomination):
+        body = json.dumps({'denomination': denomination})
+        response = await self.client.generic('PATCH', '/machine/{}/user_insert_currency'.format(self.machine.id),
+                                             body, headers=benchmark.asgi_headers(body))
+        self.assertEqual(response.status_code, 200, response.content)
+
+    async def next_event(self, outbox):
+        body = (await asyncio.wait_for(outbox.get(), 5))['body']
+        lines = dict(line.split(b': ', 1) for line in body.strip().split(b'\n'))
+        return lines[b'id'].decode(), json.loads(lines[b'data'])
+
+    async def test_event_stream_pushes_every_change(self):
+        inbox, outbox, task = self.connect('http')
+        start = await asyncio.wait_for(outbox.get(), 5)
+        self.assertEqual((start['status'], dict(start['headers'])[b'content-type']), (200, b'text/event-stream'))
+        etag, state = await self.next_event(outbox)
+        self.assertEqual(state['total_amount'], '100.00')
+
+        await self.insert(20)
+        etag, state = await self.next_event(outbox)
+        self.assertEqual((state['state'], state['amount'], state['total_amount']),
+                         ('Currency Inserted', 20.0, '120.00'))
+        # the pushed state is the body the state endpoint serves
+        self.assertEqual((await self.client.get('/machine/{}/state'.format(self.machine.id)))['ETag'], etag)
+
+        await inbox.put({'type': 'http.disconnect'})
+        await asyncio.wait_for(task, 5)
+        self.assertEqual(push.broker.count(), 0)
+
+    async def test_websocket_gets_the_same_events(self):
+        inbox, outbox, task = self.connect('websocket')
+        await inbox.put({'type': 'websocket.connect'})
+        self.assertEqual((await asyncio.wait_for(outbox.get(), 5))['type'], 'websocket.accept')
+        first = json.loads((await asyncio.wait_for(outbox.get(), 5))['text'])
+        await self.insert(50)
+        second = json.loads((await asyncio.wait_for(outbox.get(), 5))['text'])
+        self.assertNotEqual(first['etag'], second['etag'])
+        self.assertEqual(second['state']['total_amount'], '150.00')
+
+        await inbox.put({'type': 'websocket.disconnect', 'code': 1000})
+        await asyncio.wait_for(task, 5)
+        self.assertEqual(push.broker.count(), 0)
+
+    async def test_unknown_machine_is_not_found(self):
+        inbox, outbox, task = self.connect('http', machine_id=999)
+        self.assertEqual((await asyncio.wait_for(outbox.get(), 5))['status'], 404)
+        await asyncio.wait_for(task, 5)
+
+        inbox, outbox, task = self.connect('websocket', machine_id=999)
+        await inbox.put({'type': 'websocket.connect'})
+        self.assertEqual(await asyncio.wait_for(outbox.get(), 5), {'type': 'websocket.close', 'code': 4404})
+        await inbox.put({'type': 'websocket.disconnect', 'code': 4404})
+        await asyncio.wait_for(task, 5)
+
+
+class DatabaseProfileTests(TransactionTestCase):
+
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA {}'.format(name))
+            return cursor.fetchone()[0]
+
+    def test_sqlite_connections_are_tuned(self):
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        self.assertEqual(self.pragma('busy_timeout'), 5000)
+        # NORMAL
+        self.assertEqual(self.pragma('synchronous'), 1)
+
+    def test_pragmas_stay_out_of_the_query_count(self):
+        connection.close()
+        with CaptureQueriesContext(connection) as queries:
+            Machine.objects.count()
+        self.assertEqual(len(queries), 1)
+
+
+@skipUnless(connection.vendor == 'sqlite', "reads sqlite's EXPLAIN QUERY PLAN")
+class QueryPlanTests(MachineTestMixin, TestCase):
+    """
+    The reads behind the machine API and the reports must search an index, never scan a table.
+    """
+
+    def setUp(self):
+        super(QueryPlanTests, self).setUp()
+        self.product = self.create_product(quantity=5)
+
+    def assertSearches(self, queryset, index):
+        plan = queryset.explain()
+        self.assertIn(index, plan)
+        self.assertNotRegex(plan, r'\bSCAN\b')
+
+    def transactions(self, **params):
+        serializer = TransactionFilterSerializer(data=params)
+        serializer.is_valid(raise_exception=True)
+        return serializer.filter_queryset(MachineTransaction.objects.filter(machine_id=self.machine.id)).order_by('-id')
+
+    def test_machine_reads(self):
+        self.assertSearches(Machine.objects.select_related('last_transaction').filter(pk=self.machine.id),
+                            'INTEGER PRIMARY KEY')
+        self.assertSearches(Products.objects.filter(machine_id=self.machine.id).order_by('id'),
+                            'machine_products_machine_id')
+        self.assertSearches(self.machine.products.filter(quantity__gt=0), 'products_in_stock_idx')
+
+    def test_transaction_listing(self):
+        self.assertSearches(self.transactions(), 'machine_machinetransaction_machine_id')
+        self.assertSearches(self.transactions(action=MachineTransaction.ACTION_SELECT_ITEM), 'machine_txn_action_idx')
+        self.assertSearches(self.transactions(product=self.product.id), 'machine_txn_product_idx')
+        self.assertSearches(self.transactions(created_after='2020-01-01T00:00:00Z'), 'machine_txn_created_idx')
+
+    def test_reporting_reads(self):
+        since = datetime(2020, 1, 1, tzinfo=dt_timezone.utc)
+        self.assertSearches(MachineTransaction.objects.filter(action=MachineTransaction.ACTION_SELECT_ITEM,
+                                                              created_at__gte=since), 'machine_txn_action_time_idx')
+        self.assertSearches(MachineTransaction.objects.filter(product=self.product, created_at__gte=since),
+                            'machine_txn_product_time_idx')
+
+
+class StandInRedisHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks the handful of Redis commands the shared cache backend sends, against a dict owned by the server.
+    """
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+            self.wfile.write(self.server.execute(args[0].upper().decode(), args[1:]))
+
+
+class StandInRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), StandInRedisHandler)
+        self.data = {}
+        self.expiry = {}
+        self.lock = threading.Lock()
+
+    def live(self, key):
+        if key in self.expiry and self.expiry[key] <= time.time():
+            self.data.pop(key, None)
+            self.expiry.pop(key, None)
+        return key in self.data
+
+    def execute(self, command, args):
+        with self.lock:
+            if command == 'GET':
+                if not self.live(args[0]):
+                    return b'$-1\r\n'
+                return b'$%d\r\n%s\r\n' % (len(self.data[args[0]]), self.data[args[0]])
+            if command == 'SET':
+                key, value, options = args[0], args[1], [option.upper() for option in args[2:]]
+                if b'NX' in options and self.live(key):
+                    return b'$-1\r\n'
+                self.data[key] = value
+                self.expiry.pop(key, None)
+                if b'PX' in options:
+                    self.expiry[key] = time.time() + int(options[options.index(b'PX') + 1]) / 1000
+                return b'+OK\r\n'
+            if command == 'DEL':
+                return b':%d\r\n' % sum(self.data.pop(key, None) is not None for key in args)
+            if command == 'EXISTS':
+                return b':%d\r\n' % self.live(args[0])
+            if command == 'INCRBY':
+                self.data[args[0]] = b'%d' % (int(self.data.get(args[0], 0)) + int(args[1]))
+                return b':%s\r\n' % self.data[args[0]]
+            if command == 'FLUSHDB':
+                self.data.clear()
+                self.expiry.clear()
+                return b'+OK\r\n'
+            return b'-ERR unknown command\r\n'
+
+
+class SharedCacheBackendTests(MachineTestMixin, TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(SharedCacheBackendTests, cls).setUpClass()
+        cls.server = StandInRedisServer()
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super(SharedCacheBackendTests, cls).tearDownClass()
+
+    def setUp(self):
+        location = 'redis://127.0.0.1:{}/0'.format(self.server.server_address[1])
+        settings_override = override_settings(CACHES={'default': {
+            'BACKEND': 'machine.cache_backends.RedisCache', 'LOCATION': location}})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        machine_cache.stats.reset()
+        super(SharedCacheBackendTests, self).setUp()
+
+    def test_backend_round_trips(self):
+        shared = caches['default']
+        shared.set('entry', {'quantity': 3})
+        self.assertEqual(shared.get('entry'), {'quantity': 3})
+        self.assertFalse(shared.add('entry', 'other'))
+        self.assertTrue(shared.add('counter', 1, None))
+        self.assertEqual(shared.incr('counter', 4), 5)
+        with self.assertRaises(ValueError):
+            shared.incr('missing')
+        shared.set('short', 'lived', 0.05)
+        time.sleep(0.1)
+        self.assertIsNone(shared.get('short'))
+        self.assertTrue(shared.delete('entry'))
+        self.assertIsNone(shared.get('entry'))
+
+    def test_state_reads_go_through_the_shared_cache(self):
+        url = '/machine/{}/state'.format(self.machine.id)
+        first = self.client.get(url)
+        with self.assertNumQueries(0):
+            second = self.client.get(url)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(machine_cache.stats.snapshot()['state'], {'hits': 1, 'misses': 1})
+
+        self.patch('user_insert_currency', {'denomination': 20})
+        after_insert = json.loads(self.client.get(url).content)
+        self.assertEqual(after_insert['state'], 'Currency Inserted')
+        self.assertEqual(after_insert['total_amount'], '120.00')
+        self.assertEqual(self.client.get('/machine/cache_stats').json()['state'], {'hits': 1, 'misses': 2})
@@ -0,0 +1,58 @@
+"""
+The machine's state machine, declared once as one rule per action and compiled into a table over every
+`(Machine.STATE_*, MachineTransaction.ACTION_*)` pair the operations in `machine.services` can meet.
+
+Each operation looks its transition up first, with the machine it holds locked, and refuses an illegal one straight
+away with the rule's message, before checking its arguments or loading anything else. An allowed transition names
+the state the machine ends in.
+"""
+from collections import namedtuple
+
+from machine.models import Machine, MachineTransaction
+
+STATES = tuple(state for state, _ in Machine.STATE_CHOICES)
+IN_TRANSACTION = frozenset([Machine.STATE_CURRENCY_INSERTED])
+IDLE = frozenset(STATES) - IN_TRANSACTION
+
+# `allowed` are the states the action may be taken in; `target` the state it leaves the machine in: one state, a
+# `{from_state: state}` map for the states it changes, or None for the state it was in; `sold_out` the state
+# instead, when the action leaves nothing in stock
+Rule = namedtuple('Rule', ['action', 'allowed', 'target', 'refusal', 'sold_out'], defaults=(None,))
+
+# a compiled table cell: `refusal` None when the action is allowed
+Transition = namedtuple('Transition', ['target', 'sold_out', 'refusal'])
+
+RULES = (
+    Rule(MachineTransaction.ACTION_INSERT_DENOMINATION, frozenset(STATES) - {Machine.STATE_OUT_OF_STOCK},
+         Machine.STATE_CURRENCY_INSERTED, "Vending Machine is out of stock"),
+    Rule(MachineTransaction.ACTION_USER_CANCEL, IN_TRANSACTION, Machine.STATE_READY, "No transaction to cancel"),
+    Rule(MachineTransaction.ACTION_SELECT_ITEM, IN_TRANSACTION, Machine.STATE_READY,
+         "Please insert money before selecting any item", sold_out=Machine.STATE_OUT_OF_STOCK),
+    Rule(MachineTransaction.ACTION_MAINTENANCE_WITHRAW_CURRENCY, IDLE, None,
+         "You cannot withdraw money. A transaction is in progress"),
+    Rule(MachineTransaction.ACTION_MAINTENANCE_LOAD_CASH, IDLE, None,
+         "You cannot load cash. A transaction is in progress"),
+    Rule(MachineTransaction.ACTION_MAINTENANCE_ADD_PRODUCT, IDLE, {Machine.STATE_OUT_OF_STOCK: Machine.STATE_READY},
+         "You cannot add products. A transaction is in progress"),
+)
+
+
+def compile_rules(rules):
+    table = {}
+    for rule in rules:
+        for state in STATES:
+            if state not in rule.allowed:
+                table[state, rule.action] = Transition(state, state, rule.refusal)
+                continue
+            if rule.target is None:
+                target = state
+            elif isinstance(rule.target, dict):
+                target = rule.target.get(state, state)
+            else:
+                target = rule.target
+            table[state, rule.action] = Transition(target, rule.sold_out or target, None)
+    return table
+
+
+TABLE = compile_rules(RULES)
+ACTIONS = tuple(rule.action for rule in RULES)
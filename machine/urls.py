@@ -12,9 +12,27 @@ urlpatterns = [
     path('user_cancel_transaction', machine_views.UserCancelTransactionApiView.as_view()),
     path('user_dispense_product', machine_views.UserDispenseProductApiVIew.as_view()),
     path('admin_withdraw', machine_views.AdminCashWithdrawApiView.as_view()),
+    path('admin_load_cash', machine_views.AdminCashLoadApiView.as_view()),
     path('admin_add_product', machine_views.AdminAddProductApiView.as_view()),
+    path('admin_restock', machine_views.AdminBulkRestockApiView.as_view()),
     path('admin_transaction_list', machine_views.TransactionApiView.as_view()),
+    path('admin_transaction_export', machine_views.TransactionExportApiView.as_view()),
+    path('admin_sales_report', machine_views.SalesReportApiView.as_view()),
+    path('cache_stats', machine_views.CacheStatsApiView.as_view()),
+
+    # fleet routes, one set per machine
+    path('<int:machine_id>/products', machine_views.ProductsView.as_view()),
+    path('<int:machine_id>/state', machine_views.MachineStateApiView.as_view()),
+    path('<int:machine_id>/user_insert_currency', machine_views.UserInsertCurrencySerializer.as_view()),
+    path('<int:machine_id>/user_cancel_transaction', machine_views.UserCancelTransactionApiView.as_view()),
+    path('<int:machine_id>/user_dispense_product', machine_views.UserDispenseProductApiVIew.as_view()),
+    path('<int:machine_id>/admin_withdraw', machine_views.AdminCashWithdrawApiView.as_view()),
+    path('<int:machine_id>/admin_load_cash', machine_views.AdminCashLoadApiView.as_view()),
+    path('<int:machine_id>/admin_add_product', machine_views.AdminAddProductApiView.as_view()),
+    path('<int:machine_id>/admin_restock', machine_views.AdminBulkRestockApiView.as_view()),
+    path('<int:machine_id>/ingest_events', machine_views.MachineEventIngestApiView.as_view()),
+    path('<int:machine_id>/admin_transaction_list', machine_views.TransactionApiView.as_view()),
+    path('<int:machine_id>/admin_transaction_export', machine_views.TransactionExportApiView.as_view()),
+    path('<int:machine_id>/admin_sales_report', machine_views.SalesReportApiView.as_view()),
 
 ]
-
-
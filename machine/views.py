@@ -1,56 +1,279 @@
+import csv
+import json
+from itertools import chain, islice
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.http import Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.http import parse_etags
 from rest_framework import generics
-from machine.models import Machine, Products, MachineTransaction
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from machine import cache, idempotency, mailboxes, metrics, projection, rollups
+from machine.archive import CombinedHistory
+from machine.catalog import get_catalog, get_state, invalidate_state
+from machine.models import ArchivedTransaction, Machine, Products, MachineTransaction
+from machine.pagination import TransactionCursorPagination
 from machine.serializers import MachineSerializer, ProductSerializer, WithdrawAmountSerializer, AddProductSerializer, \
-    AddCurrencySerializer, UserCancelTransactionSerializer, UserDispenseProductSerializer, TransactionSerializer
+    AddCurrencySerializer, UserCancelTransactionSerializer, UserDispenseProductSerializer, TransactionSerializer, \
+    TransactionFilterSerializer, BulkRestockSerializer, IngestEventsSerializer, SalesReportSerializer, \
+    LoadCashSerializer, render_catalog, render_machine_state
 
-class ProductsView(generics.ListAPIView):
-    queryset = Products.objects.all()
-    serializer_class = ProductSerializer
 
-class MachineStateApiView(generics.RetrieveAPIView):
-    def get_object(self):
-        return Machine.objects.select_related('last_transaction').last()
+def latest_machine_id():
+    return Machine.objects.values_list('id', flat=True).last()
 
-    serializer_class = MachineSerializer
 
+class MachineObjectMixin(object):
+    """
+    Resolves the machine a request is addressed to. Routes under `machine/<machine_id>/` look the machine up by
+    primary key; the legacy un-prefixed routes keep serving the most recently created machine.
+    """
+
+    def get_machine_id(self):
+        machine_id = self.kwargs.get('machine_id')
+        if machine_id is None:
+            machine_id = latest_machine_id()
+        return machine_id
+
+    def require_machine(self, empty):
+        # an unknown machine has nothing to read, so only an empty answer costs the lookup telling the two apart
+        if empty and not Machine.objects.filter(pk=self.get_machine_id()).exists():
+            raise Http404
 
-class UserInsertCurrencySerializer(generics.UpdateAPIView):
     def get_object(self):
-        return Machine.objects.select_related('last_transaction').last()
+        queryset = Machine.objects.select_related('last_transaction')
+        machine_id = self.kwargs.get('machine_id')
+        if machine_id is None:
+            return queryset.last()
+        return get_object_or_404(queryset, pk=machine_id)
 
-    serializer_class = AddCurrencySerializer
 
+class MachineUpdateApiView(MachineObjectMixin, generics.UpdateAPIView):
+    """
+    Runs the whole update, validation included, in one atomic block holding the machine row lock, so concurrent
+    requests for the same machine apply one after the other and never see each other's half-written state. Requests
+    of this process queue for the machine in its mailbox first and take the lock in the order they arrived.
+    Requests sent with an `Idempotency-Key` header are applied once, retries get the first response back.
+    """
+    claim = None
 
-class UserCancelTransactionApiView(generics.UpdateAPIView):
     def get_object(self):
-        return Machine.objects.select_related('last_transaction').last()
+        try:
+            return Machine.objects.lock(self.get_machine_id())
+        except Machine.DoesNotExist:
+            raise Http404
 
-    serializer_class = UserCancelTransactionSerializer
+    def update(self, request, *args, **kwargs):
+        # a retry is answered before anything reads the database
+        claim = idempotency.Claim.of(request)
+        if claim is not None:
+            replay = claim.acquire()
+            if replay is not None:
+                return replay
+            self.claim = claim
+        # the legacy routes resolve their machine before the lock, nothing may read inside the block ahead of it
+        self.kwargs['machine_id'] = self.get_machine_id()
+        with mailboxes.turn(self.kwargs['machine_id']), transaction.atomic():
+            serializer = self.get_serializer(self.get_object(), data=request.data, partial=kwargs.pop('partial', False))
+            serializer.is_valid(raise_exception=True)
+            machine = serializer.save()
+            # rendered once: the cached state once this commits, the streams' push and, usually, the response
+            body = render_machine_state(machine)
+            invalidate_state(machine.id, body)
+            if serializer.state_response:
+                return HttpResponse(body, content_type='application/json')
+            return Response(serializer.data)
 
+    def handle_exception(self, exc):
+        try:
+            return super().handle_exception(exc)
+        except Exception:
+            if self.claim is not None:
+                self.claim.release()
+            raise
 
-class UserDispenseProductApiVIew(generics.UpdateAPIView):
-    def get_object(self):
-        return Machine.objects.select_related('last_transaction').last()
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if self.claim is not None:
+            # stored once the update has committed, rejections included
+            if hasattr(response, 'render'):
+                response.render()
+            self.claim.complete(response)
+        return response
 
-    serializer_class = UserDispenseProductSerializer
 
+class CachedResponseMixin(object):
 
-class AdminCashWithdrawApiView(generics.UpdateAPIView):
-    def get_object(self):
-        return Machine.objects.select_related('last_transaction').last()
+    def cached_response(self, request, etag, body):
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(body, content_type='application/json')
+        response['ETag'] = etag
+        return response
+
+
+class ProductsView(CachedResponseMixin, MachineObjectMixin, generics.ListAPIView):
+    serializer_class = ProductSerializer
+
+    def get_queryset(self):
+        return Products.objects.filter(machine_id=self.get_machine_id()).order_by('id')
+
+    def list(self, request, *args, **kwargs):
+        # served pre-rendered from the catalog cache, an unchanged poll never reaches the database
+        machine_id = self.get_machine_id()
+        etag, body = get_catalog(machine_id,
+                                 lambda: projection.rendered('catalog_body', machine_id, self.render_catalog))
+        return self.cached_response(request, etag, body)
+
+    def render_catalog(self):
+        body = render_catalog(self.get_machine_id())
+        self.require_machine(body == b'[]')
+        return body
+
+
+class MachineStateApiView(CachedResponseMixin, MachineObjectMixin, generics.RetrieveAPIView):
+    serializer_class = MachineSerializer
+
+    def retrieve(self, request, *args, **kwargs):
+        machine_id = self.get_machine_id()
+        etag, body = get_state(machine_id, lambda: projection.rendered('state_body', machine_id, self.render_state))
+        return self.cached_response(request, etag, body)
+
+    def render_state(self):
+        instance = self.get_object()
+        if instance is None:
+            raise Http404
+        return render_machine_state(instance)
+
+
+class CacheStatsApiView(APIView):
+
+    def get(self, request, *args, **kwargs):
+        return Response(cache.stats.snapshot())
+
+
+class MetricsApiView(APIView):
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(metrics.render(metrics.worker_files.collect()),
+                            content_type='text/plain; version=0.0.4; charset=utf-8')
 
+
+class UserInsertCurrencySerializer(MachineUpdateApiView):
+    serializer_class = AddCurrencySerializer
+
+
+class UserCancelTransactionApiView(MachineUpdateApiView):
+    serializer_class = UserCancelTransactionSerializer
+
+
+class UserDispenseProductApiVIew(MachineUpdateApiView):
+    serializer_class = UserDispenseProductSerializer
+
+
+class AdminCashWithdrawApiView(MachineUpdateApiView):
     serializer_class = WithdrawAmountSerializer
 
 
-class AdminAddProductApiView(generics.UpdateAPIView):
-    def get_object(self):
-        return Machine.objects.select_related('last_transaction').last()
+class AdminCashLoadApiView(MachineUpdateApiView):
+    serializer_class = LoadCashSerializer
 
+
+class AdminAddProductApiView(MachineUpdateApiView):
     serializer_class = AddProductSerializer
 
-class TransactionApiView(generics.ListAPIView):
+
+class AdminBulkRestockApiView(MachineUpdateApiView):
+    serializer_class = BulkRestockSerializer
+
+
+class MachineEventIngestApiView(MachineUpdateApiView):
+    serializer_class = IngestEventsSerializer
+
+
+class TransactionFilterMixin(MachineObjectMixin):
+
+    def get_queryset(self):
+        filter_serializer = TransactionFilterSerializer(data=self.request.query_params)
+        filter_serializer.is_valid(raise_exception=True)
+        machine_id = self.get_machine_id()
+        include_archived = filter_serializer.validated_data['include_archived']
+        if projection.freshness() is not None:
+            return filter_serializer.filter_queryset(projection.transactions(machine_id, include_archived))
+        queryset = MachineTransaction.objects.filter(machine_id=machine_id)
+        if include_archived:
+            queryset = CombinedHistory([queryset, ArchivedTransaction.objects.filter(machine_id=machine_id)])
+        return filter_serializer.filter_queryset(queryset)
+
+
+class TransactionApiView(TransactionFilterMixin, generics.ListAPIView):
     serializer_class = TransactionSerializer
-    queryset = MachineTransaction.objects.all().order_by('-id')
+    pagination_class = TransactionCursorPagination
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        self.require_machine(not page)
+        return page
+
+
+class Echo(object):
+    # file-like sink for csv.writer, hands every row straight back to the response generator
+    def write(self, value):
+        return value
+
+
+class TransactionExportApiView(TransactionFilterMixin, generics.GenericAPIView):
+    EXPORT_FIELDS = ('id', 'created_at', 'action', 'product_id', 'denomination', 'amount', 'quantity',
+                     'total_transaction_amount', 'activity_log')
+    EXPORT_CHUNK_SIZE = 2000
+    CONTENT_TYPES = {
+        'ndjson': 'application/x-ndjson',
+        'csv': 'text/csv',
+    }
+
+    def get(self, request, *args, **kwargs):
+        output = request.query_params.get('output', 'ndjson')
+        if output not in self.CONTENT_TYPES:
+            raise ValidationError({'output': ["Please choose one of {}".format(', '.join(self.CONTENT_TYPES))]})
+        rows = self.get_queryset().order_by('id').values_list(*self.EXPORT_FIELDS).iterator(
+            chunk_size=self.EXPORT_CHUNK_SIZE)
+        first = list(islice(rows, 1))
+        self.require_machine(not first)
+        rows = chain(first, rows)
+        lines = self.render_csv(rows) if output == 'csv' else self.render_ndjson(rows)
+        response = StreamingHttpResponse(lines, content_type=self.CONTENT_TYPES[output])
+        response['Content-Disposition'] = 'attachment; filename="transactions.{}"'.format(output)
+        return response
+
+    def render_ndjson(self, rows):
+        for row in rows:
+            yield json.dumps(dict(zip(self.EXPORT_FIELDS, row)), cls=DjangoJSONEncoder) + '\n'
+
+    def render_csv(self, rows):
+        writer = csv.writer(Echo())
+        yield writer.writerow(self.EXPORT_FIELDS)
+        for row in rows:
+            yield writer.writerow(row)
 
 
+class SalesReportApiView(MachineObjectMixin, APIView):
+    """
+    Dashboard figures for a machine, answered from the hourly or daily rollups (`?period=hour|day`, optional
+    `since` and `until`).
+    """
 
+    def get(self, request, *args, **kwargs):
+        query = SalesReportSerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        machine_id = self.get_machine_id()
+        report = rollups.report(machine_id, **query.validated_data)
+        self.require_machine(not report['buckets'])
+        names = dict(Products.objects.filter(pk__in=[line['product'] for line in report['products']])
+                     .values_list('id', 'name'))
+        for line in report['products']:
+            line['name'] = names.get(line['product'], '')
+        return Response(SalesReportSerializer(dict(query.validated_data, **report)).data)
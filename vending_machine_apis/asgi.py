@@ -3,14 +3,34 @@ ASGI config for vending_machine_apis project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Requests are routed through ``settings.ASGI_ROOT_URLCONF``, which serves the machine API from its async views, and
+the machine event streams are served by ``machine.streams``.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
 """
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'vending_machine_apis.settings')
 
+
+class MachineASGIHandler(ASGIHandler):
+
+    async def get_response_async(self, request):
+        request.urlconf = settings.ASGI_ROOT_URLCONF
+        return await super(MachineASGIHandler, self).get_response_async(request)
+
+
+def get_asgi_application():
+    django.setup(set_prefix=False)
+    # imported once the apps are loaded
+    from machine.streams import router
+    return router(MachineASGIHandler())
+
+
 application = get_asgi_application()
@@ -0,0 +1,15 @@
+"""vending_machine_apis URL Configuration for the ASGI entry point
+
+Same routes as `vending_machine_apis.urls`, with `machine/` served by the async views.
+"""
+from django.contrib import admin
+from django.urls import path, include
+from machine import async_urls as machine_urls
+from machine.views import MetricsApiView
+
+urlpatterns = [
+    path('admin/', admin.site.urls),
+    path('machine/', include(machine_urls)),
+    path('metrics', MetricsApiView.as_view()),
+
+]
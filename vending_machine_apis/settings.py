@@ -40,10 +40,11 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'rest_framework',
     'corsheaders',
-    'machine'
+    'machine.apps.MachineConfig',
 ]
 
 MIDDLEWARE = [
+    'machine.metrics.metrics_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -55,6 +56,8 @@ MIDDLEWARE = [
 ]
 
 ROOT_URLCONF = 'vending_machine_apis.urls'
+# the ASGI entry point routes through this one, the machine API served by its async views
+ASGI_ROOT_URLCONF = 'vending_machine_apis.asgi_urls'
 
 TEMPLATES = [
     {
@@ -77,13 +80,137 @@ WSGI_APPLICATION = 'vending_machine_apis.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
+# VENDING_DB_PROFILE picks the database: 'sqlite' (the default, tuned for concurrent writers through the PRAGMAs in
+# MACHINE_SQLITE_PRAGMAS), 'sqlite-plain' (sqlite's own defaults, a fresh connection per request, to compare against)
+# or 'postgres' (VENDING_DB_NAME, VENDING_DB_USER, VENDING_DB_PASSWORD, VENDING_DB_HOST, VENDING_DB_PORT; needs
+# psycopg2). Connections are kept open for VENDING_DB_CONN_MAX_AGE seconds. Behind a transaction pooling pgbouncer set
+# VENDING_DB_POOLER=pgbouncer, which turns off server-side cursors.
+
+DB_PROFILE = os.environ.get('VENDING_DB_PROFILE', 'sqlite')
+DB_CONN_MAX_AGE = int(os.environ.get('VENDING_DB_CONN_MAX_AGE', 60))
+
+SQLITE_DATABASE = {
+    'ENGINE': 'django.db.backends.sqlite3',
+    'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+    # a file rather than the in-memory default, so threaded tests get real sqlite locking
+    'TEST': {
+        'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3'),
+    },
+}
+DB_PROFILES = {
+    'sqlite': dict(SQLITE_DATABASE, CONN_MAX_AGE=DB_CONN_MAX_AGE),
+    'sqlite-plain': SQLITE_DATABASE,
+    'postgres': {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('VENDING_DB_NAME', 'vending_machine'),
+        'USER': os.environ.get('VENDING_DB_USER', ''),
+        'PASSWORD': os.environ.get('VENDING_DB_PASSWORD', ''),
+        'HOST': os.environ.get('VENDING_DB_HOST', ''),
+        'PORT': os.environ.get('VENDING_DB_PORT', ''),
+        'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+        'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('VENDING_DB_POOLER') == 'pgbouncer',
+        'OPTIONS': {
+            'connect_timeout': 5,
+        },
+    },
+}
 
 DATABASES = {
+    'default': DB_PROFILES[DB_PROFILE],
+    # the read model (machine.projection), a second sqlite file at VENDING_READ_DB whatever the primary is
+    'read': dict(SQLITE_DATABASE, NAME=os.environ.get('VENDING_READ_DB', os.path.join(BASE_DIR, 'read.sqlite3')),
+                 CONN_MAX_AGE=DB_CONN_MAX_AGE, TEST={'NAME': os.path.join(BASE_DIR, 'test_read.sqlite3')}),
+}
+DATABASE_ROUTERS = ['machine.routers.ReadModelRouter']
+# with VENDING_READ_MODEL=1 the catalog, state and transaction reads are served from the read model, which
+# `project_reads` keeps up to date from the primary, as long as it is at most VENDING_READ_MAX_STALENESS seconds
+# behind; further behind, or never projected, they read the primary
+MACHINE_READ_MODEL = os.environ.get('VENDING_READ_MODEL') == '1'
+MACHINE_READ_MAX_STALENESS = float(os.environ.get('VENDING_READ_MAX_STALENESS', 5))
+
+# run on every new sqlite connection by machine.db: WAL lets reads carry on while a write is in progress, writers
+# wait up to busy_timeout ms for the lock instead of failing, and NORMAL sync is safe with WAL
+MACHINE_SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'busy_timeout': 5000,
+    'synchronous': 'normal',
+    'mmap_size': 256 * 1024 * 1024,
+} if DB_PROFILE == 'sqlite' else {}
+# writes to a machine first queue in process, in arrival order, for the machine's turn (machine.mailboxes), and
+# at most VENDING_WRITE_PARALLELISM machines (0: any number) write at once, one on sqlite, which has a single write
+# lock; VENDING_WRITE_QUEUE=0 leaves them all to race for the database lock
+MACHINE_WRITE_QUEUE = os.environ.get('VENDING_WRITE_QUEUE', '1') != '0'
+MACHINE_WRITE_PARALLELISM = int(os.environ.get('VENDING_WRITE_PARALLELISM', 0 if DB_PROFILE == 'postgres' else 1))
+
+
+# Cache
+# VENDING_CACHE_BACKEND picks the backend: 'locmem' (per-process LRU, the default), 'file', or 'redis' for a
+# cache shared by every worker. VENDING_CACHE_LOCATION is the directory or redis://host:port/db url.
+
+CACHE_BACKENDS = {
+    'locmem': 'django.core.cache.backends.locmem.LocMemCache',
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',
+    'redis': 'machine.cache_backends.RedisCache',
+}
+CACHE_DEFAULT_LOCATIONS = {
+    'locmem': 'vending-machine',
+    'file': os.path.join(BASE_DIR, '.cache'),
+    'redis': 'redis://127.0.0.1:6379/0',
+}
+CACHE_BACKEND = os.environ.get('VENDING_CACHE_BACKEND', 'locmem')
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'BACKEND': CACHE_BACKENDS[CACHE_BACKEND],
+        'LOCATION': os.environ.get('VENDING_CACHE_LOCATION', CACHE_DEFAULT_LOCATIONS[CACHE_BACKEND]),
+        'TIMEOUT': int(os.environ.get('VENDING_CACHE_TIMEOUT', 300)),
+        'OPTIONS': {
+            # size bound, entries past it are culled (least recently used first on locmem)
+            'MAX_ENTRIES': int(os.environ.get('VENDING_CACHE_MAX_ENTRIES', 10000)),
+        },
     }
 }
+if CACHE_BACKEND == 'redis':
+    CACHES['default']['OPTIONS'] = {'SOCKET_TIMEOUT': 1}
+
+MACHINE_CACHE_ALIAS = 'default'
+MACHINE_CACHE_TIMEOUTS = {
+    'catalog': 60 * 60,
+    'state': 60 * 60,
+    # how long a write sent with an Idempotency-Key answers its retries
+    'idempotency': int(os.environ.get('VENDING_IDEMPOTENCY_TTL', 24 * 60 * 60)),
+}
+
+
+# Ledger
+# a snapshot is taken every this many entries per machine, bounding how far a state rebuild has to replay
+MACHINE_LEDGER_SNAPSHOT_EVERY = int(os.environ.get('VENDING_LEDGER_SNAPSHOT_EVERY', 1000))
+# compact_rollups leaves entries younger than this for its next run, so slow-to-commit ones are never skipped
+MACHINE_ROLLUP_SETTLE_SECONDS = int(os.environ.get('VENDING_ROLLUP_SETTLE_SECONDS', 10))
+# archive_transactions moves ledger entries older than this out of the hot table
+MACHINE_ARCHIVE_AFTER_DAYS = int(os.environ.get('VENDING_ARCHIVE_AFTER_DAYS', 90))
+
+
+# Metrics
+# VENDING_METRICS_DIR lets the workers of a multi-process server pool their numbers for /metrics;
+# VENDING_SLOW_REQUEST_MS logs the SQL of every request slower than that to the machine.slow_requests logger.
+
+MACHINE_METRICS_DIR = os.environ.get('VENDING_METRICS_DIR') or None
+MACHINE_SLOW_REQUEST_MS = float(os.environ['VENDING_SLOW_REQUEST_MS']) if os.environ.get('VENDING_SLOW_REQUEST_MS') \
+    else None
+
+
+# Async
+# the ASGI entry point runs the machine views on a pool of VENDING_ASYNC_DB_THREADS threads, which also bounds
+# its database connections; a long-poll on state waits at most VENDING_LONG_POLL_MAX_WAIT seconds and re-reads the
+# state cache versions every VENDING_LONG_POLL_RECHECK_SECONDS, which catches changes made by other processes only
+# with a cache shared by every worker (VENDING_CACHE_BACKEND=redis).
+
+MACHINE_ASYNC_DB_THREADS = int(os.environ.get('VENDING_ASYNC_DB_THREADS', 8))
+MACHINE_LONG_POLL_MAX_WAIT = float(os.environ.get('VENDING_LONG_POLL_MAX_WAIT', 30))
+MACHINE_LONG_POLL_RECHECK_SECONDS = float(os.environ.get('VENDING_LONG_POLL_RECHECK_SECONDS', 5))
+# an event stream with nothing to send gets a keepalive comment this often, so proxies do not drop it
+MACHINE_PUSH_KEEPALIVE_SECONDS = float(os.environ.get('VENDING_PUSH_KEEPALIVE_SECONDS', 15))
 
 
 # Password validation
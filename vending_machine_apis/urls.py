@@ -16,9 +16,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from machine import urls as machine_urls
+from machine.views import MetricsApiView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('machine/', include(machine_urls))
+    path('machine/', include(machine_urls)),
+    path('metrics', MetricsApiView.as_view()),
 
 ]